@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""Convert a joblib finalized_model_*.sav into a model bundle directory.
+
+usage: python convert_model.py model/finalized_model_1594757805.sav [bundle_dir]
+
+The bundle is written next to the .sav file unless bundle_dir is given.
+"""
+import os
+import sys
+
+import joblib
+
+from util.model_bundle import save_model_bundle
+
+if __name__ == "__main__":
+    sav_fp = sys.argv[1]
+    if len(sys.argv) > 2:
+        bundle_dir = sys.argv[2]
+    else:
+        bundle_dir = os.path.splitext(sav_fp)[0]
+
+    print(f"Converting {sav_fp} to {bundle_dir}...")
+
+    save_model_bundle(bundle_dir, joblib.load(sav_fp))
+
+    print("Done.")
@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import signal
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np, os, sys
 from scipy.io import loadmat
-from run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier
+from run_12ECG_classifier import load_12ECG_model, run_12ECG_classifier, run_12ECG_classifier_batch
+from util.cpus import available_cpus
+from util.feature_cache import FeatureCache
+from util.worker_pool import WorkerPool
 
 def load_challenge_data(filename):
 
@@ -36,24 +48,327 @@ def save_challenge_predictions(output_directory,filename,scores,labels,classes):
 
 
 
+def run_batched(model, input_directory, input_files, output_directory, batch_size, feature_cache=None):
+    # Score batch_size recordings per classifier call.
+    num_files = len(input_files)
+
+    for batch_start in range(0, num_files, batch_size):
+        batch_files = input_files[batch_start:batch_start + batch_size]
+        print('    {}-{}/{}...'.format(batch_start+1, batch_start+len(batch_files), num_files))
+        records = [load_challenge_data(os.path.join(input_directory,f)) for f in batch_files]
+        outputs = run_12ECG_classifier_batch(records, model, feature_cache=feature_cache)
+        # Save results.
+        for f, (current_label, current_score, classes) in zip(batch_files, outputs):
+            save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+
+
+# Model and feature cache loaded once per pool worker by _init_pool_worker.
+_worker_model = None
+_worker_feature_cache = None
+
+
+def _init_pool_worker(model_input, feature_cache=None):
+    global _worker_model, _worker_feature_cache
+    # interrupts are handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_model = load_12ECG_model(model_input)
+    _worker_feature_cache = feature_cache
+
+
+def _pool_score_file(input_directory, f):
+    # Exceptions are returned rather than raised so one bad record cannot stop the run.
+    try:
+        data,header_data = load_challenge_data(os.path.join(input_directory,f))
+    except Exception:
+        return None, traceback.format_exc()
+    return _pool_score_record(data, header_data)
+
+
+def _pool_score_record(data, header_data):
+    try:
+        # the pool already provides the parallelism, extract the leads serially
+        output = run_12ECG_classifier_batch([(data, header_data)], _worker_model, n_jobs=1, feature_cache=_worker_feature_cache)[0]
+        return output, None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def run_pool(model_input, input_directory, input_files, output_directory, num_workers, record_timeout=None, feature_cache=None):
+    # Persistent worker pool, one record per task, results are written as they complete.
+    # No more records than workers are submitted, so a record starts running when it is
+    # submitted and its record_timeout counts from there. A hung or dead worker takes
+    # its executor down: the executor is replaced, the records that were running when a
+    # worker died are retried one at a time to find the one that killed it, and the
+    # records running alongside a hung one are resubmitted.
+    num_files = len(input_files)
+    failed_files = []
+    num_done = 0
+
+    queued = collections.deque(input_files)
+    suspects = collections.deque()
+    # future to (file, deadline, whether it runs alone)
+    running = {}
+    score_file = functools.partial(_pool_score_file, input_directory)
+
+    def finish(f, output, error):
+        nonlocal num_done
+        num_done += 1
+        print('    {}/{}...'.format(num_done, num_files))
+        if error is not None:
+            print('    Failed to process {}:\n{}'.format(f, error))
+            failed_files.append(f)
+            return
+        current_label, current_score, classes = output
+        # Save results.
+        save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+
+    with WorkerPool(num_workers, _init_pool_worker, (model_input, feature_cache)) as pool:
+        while queued or suspects or running:
+            # records suspected of killing a worker are retried alone
+            alone = bool(suspects)
+            if alone:
+                submissions = [] if running else [suspects.popleft()]
+            else:
+                submissions = [queued.popleft() for _ in range(min(len(queued), num_workers - len(running)))]
+            for f in submissions:
+                _, future = pool.submit(score_file, f)
+                deadline = time.monotonic() + record_timeout if record_timeout is not None else None
+                running[future] = (f, deadline, alone)
+
+            timeout = None
+            if record_timeout is not None:
+                timeout = max(min(deadline for _, deadline, _ in running.values()) - time.monotonic(), 0)
+            done, _ = concurrent.futures.wait(running, timeout, concurrent.futures.FIRST_COMPLETED)
+
+            broken = []
+            for future in done:
+                try:
+                    output, error = future.result()
+                except BrokenProcessPool:
+                    broken.append(future)
+                    continue
+                except Exception:
+                    output, error = None, traceback.format_exc()
+                finish(running.pop(future)[0], output, error)
+
+            now = time.monotonic()
+            timed_out = [future for future, (_, deadline, _) in running.items() if not future.done() and deadline is not None and deadline <= now]
+            for future in timed_out:
+                finish(running.pop(future)[0], None, 'timed out after {} seconds'.format(record_timeout))
+
+            if broken or timed_out:
+                for future in broken:
+                    f, _, alone = running.pop(future)
+                    if alone:
+                        finish(f, None, 'worker process died, e.g. out of memory')
+                    else:
+                        suspects.append(f)
+                if broken:
+                    # any of the records still running may have killed the worker
+                    suspects.extend(f for f, _, _ in running.values())
+                else:
+                    queued.extendleft(reversed([f for f, _, _ in running.values()]))
+                running.clear()
+                pool.restart(pool.executor)
+
+    if failed_files:
+        print('Failed to process {}/{} files: {}'.format(len(failed_files), num_files, ', '.join(failed_files)))
+    return failed_files
+
+
+def _is_input_file(input_directory, f):
+    return os.path.isfile(os.path.join(input_directory, f)) and not f.lower().startswith('.') and f.lower().endswith('mat')
+
+
+async def _discover_files(input_directory, file_queue, watch, poll_interval):
+    # Queue recordings as they appear. When watching, a recording is queued once its .mat
+    # and .hea sizes are unchanged over one poll interval, so partial copies are not read.
+    seen = set()
+    sizes = {}
+    while True:
+        for f in sorted(os.listdir(input_directory)):
+            if f in seen or not _is_input_file(input_directory, f):
+                continue
+            if watch:
+                try:
+                    size = (os.path.getsize(os.path.join(input_directory, f)),
+                            os.path.getsize(os.path.join(input_directory, f.replace('.mat','.hea'))))
+                except OSError:
+                    continue
+                if sizes.get(f) != size:
+                    sizes[f] = size
+                    continue
+                del sizes[f]
+            seen.add(f)
+            await file_queue.put(f)
+        if not watch:
+            return
+        await asyncio.sleep(poll_interval)
+
+
+async def _read_files(loop, io_executor, input_directory, file_queue, record_queue, failed_files):
+    while True:
+        f = await file_queue.get()
+        if f is None:
+            return
+        try:
+            data,header_data = await loop.run_in_executor(io_executor, load_challenge_data, os.path.join(input_directory,f))
+        except Exception:
+            print('    Failed to read {}:\n{}'.format(f, traceback.format_exc()))
+            failed_files.append(f)
+            continue
+        await record_queue.put((f, data, header_data))
+
+
+async def _pool_score(loop, pool, record_timeout, data, header_data):
+    # (output, error, whether the executor broke) of scoring a record on the pool
+    executor, future = pool.submit(_pool_score_record, data, header_data)
+    try:
+        output, error = await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), record_timeout)
+        return output, error, False
+    except asyncio.TimeoutError:
+        # the worker hangs on this record
+        pool.restart(executor)
+        return None, 'timed out after {} seconds'.format(record_timeout), False
+    except BrokenProcessPool:
+        pool.restart(executor)
+        return None, 'worker process died, e.g. out of memory', True
+
+
+async def _score_records(loop, pool, retry_pool, retry_lock, record_queue, output_queue, record_timeout, failed_files):
+    while True:
+        record = await record_queue.get()
+        if record is None:
+            return
+        f, data, header_data = record
+        output, error, broken = await _pool_score(loop, pool, record_timeout, data, header_data)
+        if broken:
+            # the worker may have died on any of the records running alongside, retry
+            # this one alone to find out
+            async with retry_lock:
+                output, error, _ = await _pool_score(loop, retry_pool, record_timeout, data, header_data)
+        if error is not None:
+            print('    Failed to process {}:\n{}'.format(f, error))
+            failed_files.append(f)
+            continue
+        await output_queue.put((f, output))
+
+
+async def _write_outputs(loop, io_executor, output_directory, output_queue):
+    num_written = 0
+    while True:
+        item = await output_queue.get()
+        if item is None:
+            return
+        f, (current_label, current_score, classes) = item
+        # Save results.
+        await loop.run_in_executor(io_executor, save_challenge_predictions, output_directory, f, current_score, current_label, classes)
+        num_written += 1
+        print('    {} {}'.format(num_written, f))
+
+
+async def _stream(model_input, input_directory, output_directory, num_workers, queue_size, watch, poll_interval, record_timeout, feature_cache):
+    loop = asyncio.get_event_loop()
+    file_queue = asyncio.Queue(queue_size)
+    record_queue = asyncio.Queue(queue_size)
+    output_queue = asyncio.Queue(queue_size)
+    failed_files = []
+
+    io_executor = concurrent.futures.ThreadPoolExecutor(2)
+    retry_lock = asyncio.Lock()
+    # the retry pool starts its worker on its first record
+    with WorkerPool(num_workers, _init_pool_worker, (model_input, feature_cache)) as pool, WorkerPool(1, _init_pool_worker, (model_input, feature_cache)) as retry_pool:
+        reader = loop.create_task(_read_files(loop, io_executor, input_directory, file_queue, record_queue, failed_files))
+        # one scorer per worker keeps every worker busy
+        scorers = [loop.create_task(_score_records(loop, pool, retry_pool, retry_lock, record_queue, output_queue, record_timeout, failed_files)) for _ in range(num_workers)]
+        writer = loop.create_task(_write_outputs(loop, io_executor, output_directory, output_queue))
+
+        await _discover_files(input_directory, file_queue, watch, poll_interval)
+
+        # drain the stages in order
+        await file_queue.put(None)
+        await reader
+        for _ in scorers:
+            await record_queue.put(None)
+        await asyncio.gather(*scorers)
+        await output_queue.put(None)
+        await writer
+    io_executor.shutdown()
+
+    return failed_files
+
+
+def run_streaming(model_input, input_directory, output_directory, num_workers, queue_size=16, watch=False, poll_interval=1.0, record_timeout=None, feature_cache=None):
+    # Read, score and write overlap in an asyncio pipeline with bounded queues between the
+    # stages, each output is written as soon as its recording is scored. When watching,
+    # recordings arriving in input_directory are scored until interrupted.
+    failed_files = asyncio.run(_stream(model_input, input_directory, output_directory, num_workers, queue_size, watch, poll_interval, record_timeout, feature_cache))
+    if failed_files:
+        print('Failed to process {} files: {}'.format(len(failed_files), ', '.join(failed_files)))
+    return failed_files
+
+
 if __name__ == '__main__':
     # Parse arguments.
-    if len(sys.argv) != 4:
-        raise Exception('Include the input and output directories as arguments, e.g., python driver.py input output.')
+    parser = argparse.ArgumentParser(description='Run the 12ECG classifier, e.g., python driver.py model input output.')
+    parser.add_argument('model_input')
+    parser.add_argument('input_directory')
+    parser.add_argument('output_directory')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='number of recordings scored together per model call (default: 1)')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='score recordings in a persistent pool of this many worker processes (default: 0, disabled)')
+    parser.add_argument('--record-timeout', type=float, default=None,
+                        help='seconds a pooled recording may take from its submission before it is marked as failed and its worker replaced (default: no limit)')
+    parser.add_argument('--stream', action='store_true',
+                        help='overlap reading, scoring and writing in an asyncio pipeline of --num-workers scoring processes')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep streaming recordings that arrive in input_directory until interrupted, implies --stream')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between input directory scans when watching (default: 1)')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='maximum recordings waiting between streaming stages (default: 16)')
+    parser.add_argument('--feature-cache', default=None,
+                        help='SQLite file caching extracted features across runs (default: disabled)')
+    parser.add_argument('--feature-cache-gib', type=float, default=1.0,
+                        help='feature cache size cap in GiB, least recently used entries are evicted (default: 1)')
+    args = parser.parse_args()
 
-    model_input = sys.argv[1]
-    input_directory = sys.argv[2]
-    output_directory = sys.argv[3]
+    model_input = args.model_input
+    input_directory = args.input_directory
+    output_directory = args.output_directory
 
     # Find files.
     input_files = []
     for f in os.listdir(input_directory):
-        if os.path.isfile(os.path.join(input_directory, f)) and not f.lower().startswith('.') and f.lower().endswith('mat'):
+        if _is_input_file(input_directory, f):
             input_files.append(f)
 
     if not os.path.isdir(output_directory):
         os.mkdir(output_directory)
 
+    feature_cache = None
+    if args.feature_cache:
+        feature_cache = FeatureCache(args.feature_cache, max_bytes=int(args.feature_cache_gib * 1024 ** 3))
+
+    if args.stream or args.watch:
+        num_workers = args.num_workers if args.num_workers > 0 else available_cpus()
+        print('Streaming 12ECG features with {} workers...'.format(num_workers))
+        failed_files = []
+        try:
+            failed_files = run_streaming(model_input, input_directory, output_directory, num_workers, args.queue_size, args.watch, args.poll_interval, args.record_timeout, feature_cache)
+        except KeyboardInterrupt:
+            pass
+        print('Done.')
+        sys.exit(1 if failed_files else 0)
+
+    if args.num_workers > 0:
+        # Each pool worker loads its own copy of the model.
+        print('Extracting 12ECG features with {} workers...'.format(args.num_workers))
+        failed_files = run_pool(model_input, input_directory, input_files, output_directory, args.num_workers, args.record_timeout, feature_cache)
+        print('Done.')
+        sys.exit(1 if failed_files else 0)
+
     # Load model.
     print('Loading 12ECG model...')
     model = load_12ECG_model(model_input)
@@ -62,13 +377,16 @@ if __name__ == '__main__':
     print('Extracting 12ECG features...')
     num_files = len(input_files)
 
-    for i, f in enumerate(input_files):
-        print('    {}/{}...'.format(i+1, num_files))
-        tmp_input_file = os.path.join(input_directory,f)
-        data,header_data = load_challenge_data(tmp_input_file)
-        current_label, current_score,classes = run_12ECG_classifier(data,header_data, model)
-        # Save results.
-        save_challenge_predictions(output_directory,f,current_score,current_label,classes)
+    if args.batch_size > 1:
+        run_batched(model, input_directory, input_files, output_directory, args.batch_size, feature_cache)
+    else:
+        for i, f in enumerate(input_files):
+            print('    {}/{}...'.format(i+1, num_files))
+            tmp_input_file = os.path.join(input_directory,f)
+            data,header_data = load_challenge_data(tmp_input_file)
+            current_label, current_score,classes = run_12ECG_classifier(data,header_data, model, feature_cache)
+            # Save results.
+            save_challenge_predictions(output_directory,f,current_score,current_label,classes)
 
 
     print('Done.')
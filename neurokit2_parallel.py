@@ -1,8 +1,13 @@
 # This file attempts to replicate the
 # neurokit2.ecg_process and ecg_interval_related methods,
 # but vectorized to support multi-lead ECGs without loops.
+import atexit
 import re
+import fractions
 import functools
+import json
+import multiprocessing
+import threading
 import warnings
 
 import neurokit2 as nk
@@ -13,6 +18,8 @@ import scipy.signal
 import tsfresh
 import joblib
 
+import tsfresh_vectorized
+
 
 ECG_LEAD_NAMES = (
     "I",
@@ -851,6 +858,15 @@ KEYS_TSFRESH = [
     "variation_coefficient",
 ]
 
+KEYS_DELINEATE = [
+    "ECG_P_Peaks",
+    "ECG_Q_Peaks",
+    "ECG_S_Peaks",
+    "ECG_T_Peaks",
+    "ECG_P_Onsets",
+    "ECG_T_Offsets",
+]
+
 # FC_PARAMETERS = tsfresh.feature_extraction.EfficientFCParameters()
 FC_PARAMETERS = tsfresh.feature_extraction.ComprehensiveFCParameters()
 
@@ -885,249 +901,836 @@ def parse_comments(r):
     return age, sex, dx
 
 
-def wfdb_record_to_feature_dataframe(r, fc_parameters=None):
-    age, sex, dx = parse_comments(r)
-    r.sig_name = ECG_LEAD_NAMES  # force consistent naming
-    cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
+LEAD_BACKENDS = ("serial", "threads", "processes")
 
-    signal_length, num_leads = cleaned_signals.shape
+# feature families of a lead, "hrv" are its KEYS_INTERVALRELATED features,
+# "hb" and "sig" the tsfresh features of its best heartbeat and full waveform window
+FEATURE_FAMILIES = ("hrv", "hb", "sig")
 
-    # each lead should be processed separately and then combined back together
-    record_features = joblib.Parallel(n_jobs=num_leads, verbose=0)(
-        joblib.delayed(lead_to_feature_dataframe)(
-            r.p_signal[:, i],
-            cleaned_signals[:, i],
-            ECG_LEAD_NAMES[i],
-            r.fs,
-            fc_parameters,
+
+class FeaturePlan:
+    """
+    Which leads, feature families and signal processing stages the features of a
+    model need, and the constant features of the series that fail, see feature_plan.
+
+    fc_parameters: parse_fc_parameters of the model's field names,
+        None for all features of every lead
+    field_names: the model's field names, features outside of them are skipped
+    """
+
+    def __init__(self, fc_parameters=None, field_names=None):
+        self.fc_parameters = fc_parameters or None
+        if self.fc_parameters:
+            self.tsfresh_kwargs = dict(
+                default_fc_parameters={}, kind_to_fc_parameters=self.fc_parameters
+            )
+        else:
+            self.tsfresh_kwargs = dict(default_fc_parameters=FC_PARAMETERS)
+        self.fields = None
+        if field_names is not None:
+            self.fields = set(field_name.split("__")[0] for field_name in field_names)
+
+        self.meta = [k for k in ("age", "sex") if self.needs(k)]
+        self.lead_families = dict(
+            (lead_name, self.families(lead_name)) for lead_name in ECG_LEAD_NAMES
+        )
+
+        # tsfresh features of the placeholder series, stand in for the series that
+        # could not be extracted when fc_parameters are defined
+        self.placeholder_features = {}
+        placeholder_kinds = [
+            f"{lead_name}_{family}"
+            for lead_name, families in self.lead_families.items()
+            for family in ("hb", "sig")
+            if family in families
+        ]
+        if self.fc_parameters and placeholder_kinds:
+            placeholder_df = tsfresh_vectorized.extract_features(
+                [_PLACEHOLDER_SERIES] * len(placeholder_kinds),
+                placeholder_kinds,
+                ids=range(len(placeholder_kinds)),
+                **self.tsfresh_kwargs,
+            )
+            for kind, (_, row) in zip(placeholder_kinds, placeholder_df.iterrows()):
+                self.placeholder_features[kind] = row[
+                    [c for c in placeholder_df.columns if c.startswith(f"{kind}__")]
+                ]
+
+    def needs(self, field):
+        """whether field, a feature name without its tsfresh parameters, is needed"""
+        if self.fc_parameters and field not in self.fc_parameters:
+            return False
+        return self.fields is None or field in self.fields
+
+    def families(self, lead_name):
+        """FEATURE_FAMILIES of lead_name with needed features"""
+        families = []
+        if any(self.needs(f"{lead_name}_{k}") for k in KEYS_INTERVALRELATED):
+            families.append("hrv")
+        families.extend(
+            family for family in ("hb", "sig") if self.needs(f"{lead_name}_{family}")
         )
-        for i in range(num_leads)
+        return frozenset(families)
+
+    def lead_idxs(self):
+        """ECG_LEAD_NAMES indices of the leads with needed features"""
+        return [
+            i
+            for i, lead_name in enumerate(ECG_LEAD_NAMES)
+            if self.lead_families[lead_name]
+        ]
+
+    def peak_lead_idxs(self):
+        """ECG_LEAD_NAMES indices of the leads that need R-peaks, the heartbeat
+        template is only taken from leads with heart rate variability features
+        """
+        return [
+            i
+            for i, lead_name in enumerate(ECG_LEAD_NAMES)
+            if self.lead_families[lead_name] & {"hrv", "hb"}
+        ]
+
+
+_feature_plans = {}
+
+
+def feature_plan(fc_parameters=None, field_names=None):
+    """FeaturePlan of a model, made on first use and kept for the next records"""
+    key = json.dumps([fc_parameters, field_names], sort_keys=True, default=str)
+    if key not in _feature_plans:
+        _feature_plans[key] = FeaturePlan(fc_parameters, field_names=field_names)
+    return _feature_plans[key]
+
+
+def wfdb_record_to_feature_dataframe(
+    r,
+    fc_parameters=None,
+    n_jobs=None,
+    backend=None,
+    heartbeat_template="best",
+    signal_resampling="poly",
+):
+    """n_jobs: number of workers the leads are split over, defaults to one per lead.
+    backend: how the leads are run, one of LEAD_BACKENDS, see _map_leads.
+    Use n_jobs=1 or backend="serial" when the caller already runs records in parallel.
+    heartbeat_template: the heartbeat of the "hb" features, one of HEARTBEAT_TEMPLATES
+    signal_resampling: of the "sig" features, one of SIGNAL_RESAMPLINGS
+    Only the leads and stages the fc_parameters features need are run, see FeaturePlan.
+    """
+    age, sex, dx = parse_comments(r)
+    r.sig_name = ECG_LEAD_NAMES  # force consistent naming
+    plan = feature_plan(fc_parameters)
+    context = SignalContext(
+        r.p_signal,
+        r.fs,
+        heartbeat_template=heartbeat_template,
+        signal_resampling=signal_resampling,
     )
 
-    meta_dict = {}
-    if fc_parameters:
-        if "age" in fc_parameters:
-            meta_dict["age"] = (age,)
-        if "sex" in fc_parameters:
-            meta_dict["sex"] = (sex,)
-    else:
-        meta_dict = {"age": (age,), "sex": (sex,)}
+    # each lead should be processed separately and then combined back together
+    lead_series = _map_leads(
+        [
+            (lead_context, ECG_LEAD_NAMES[i], plan.lead_families[ECG_LEAD_NAMES[i]])
+            for i, lead_context in _lead_contexts(context, plan, r.p_signal.shape[1])
+        ],
+        n_jobs=n_jobs,
+        backend=backend,
+    )
 
+    meta = {"age": age, "sex": sex}
     record_features = pd.concat(
-        [pd.DataFrame(meta_dict)] + record_features, axis=1
+        [pd.DataFrame(dict((k, (meta[k],)) for k in plan.meta))]
+        + _series_to_feature_dataframes(lead_series, plan),
+        axis=1,
     )
 
     return record_features, dx
 
 
 def lead_to_feature_dataframe(
-    raw_signal, cleaned_signal, lead_name, sampling_rate, fc_parameters=None
+    raw_signal,
+    cleaned_signal,
+    lead_name,
+    sampling_rate,
+    fc_parameters=None,
+    heartbeat_template="best",
+    signal_resampling="poly",
 ):
-    signals_df = pd.DataFrame({"ECG_Raw": raw_signal, "ECG_Clean": cleaned_signal})
+    plan = feature_plan(fc_parameters)
+    context = SignalContext(
+        raw_signal[:, None],
+        sampling_rate,
+        cleaned_signals=cleaned_signal[:, None],
+        heartbeat_template=heartbeat_template,
+        signal_resampling=signal_resampling,
+    )
+    lead_series = _lead_to_series(context, lead_name, plan.families(lead_name))
+    return pd.concat(_series_to_feature_dataframes([lead_series], plan), axis=1)
 
-    # Heart Rate Variability Features
-    try:
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            hrv_df, signals_df, rpeaks_info = _lead_to_interval_related_dataframe(
-                signals_df, sampling_rate
-            )
-    except Exception:
-        hrv_df = pd.DataFrame.from_dict(
-            dict((k, (np.nan,)) for k in KEYS_INTERVALRELATED)
+
+def records_to_feature_matrix(
+    records,
+    field_names,
+    fc_parameters=None,
+    n_jobs=None,
+    backend=None,
+    heartbeat_template="best",
+    signal_resampling="poly",
+):
+    """Features of a batch of wfdb records as a (records x field_names) float32
+    matrix, NaN where a feature could not be extracted, and the dx of each record.
+
+    Records of the same sampling rate and shape are cleaned together as one
+    (records x samples x leads) array, and the tsfresh features of every lead of
+    every record are extracted by a single tsfresh_vectorized call.
+    n_jobs: number of workers the leads of all records are split over,
+        defaults to one per lead
+    backend: how the leads are run, one of LEAD_BACKENDS, see _map_leads
+    heartbeat_template: the heartbeat of the "hb" features, one of HEARTBEAT_TEMPLATES
+    signal_resampling: of the "sig" features, one of SIGNAL_RESAMPLINGS
+    """
+    plan = feature_plan(fc_parameters, field_names)
+    dxs = []
+    meta = []
+    for r in records:
+        age, sex, dx = parse_comments(r)
+        r.sig_name = ECG_LEAD_NAMES  # force consistent naming
+        dxs.append(dx)
+        meta.append({"age": age, "sex": sex})
+
+    # records of different lengths are not padded, padding would change the filtering,
+    # the leads of the records of a shape share a SignalContext
+    same_shape = {}
+    for idx, r in enumerate(records):
+        same_shape.setdefault((r.fs, r.p_signal.shape), []).append(idx)
+    lead_args = []
+    lead_records = []
+    for (fs, (_, num_leads)), idxs in same_shape.items():
+        raw_signals = np.stack([records[idx].p_signal for idx in idxs])
+        cleaned = ecg_clean(raw_signals, sampling_rate=fs)
+        context = SignalContext(
+            np.hstack(raw_signals),
+            fs,
+            cleaned_signals=np.hstack(cleaned),
+            heartbeat_template=heartbeat_template,
+            signal_resampling=signal_resampling,
         )
-        signals_df = None
-        rpeaks_info = {}
-    finally:
+        for column, lead_context in _lead_contexts(context, plan, num_leads):
+            lead_name = ECG_LEAD_NAMES[column % num_leads]
+            lead_args.append((lead_context, lead_name, plan.lead_families[lead_name]))
+            lead_records.append(idxs[column // num_leads])
+
+    lead_series = [[] for _ in records]
+    for idx, series in zip(
+        lead_records, _map_leads(lead_args, n_jobs=n_jobs, backend=backend)
+    ):
+        lead_series[idx].append(series)
+
+    ids = []
+    kinds = []
+    series = []
+    for idx, record_lead_series in enumerate(lead_series):
+        record_kinds, record_series = _tsfresh_series(record_lead_series, plan)
+        ids.extend([idx] * len(record_kinds))
+        kinds.extend(record_kinds)
+        series.extend(record_series)
+    ts_df = _extract_tsfresh_features(series, kinds, ids, plan)
+
+    field_idx = dict((field_name, j) for j, field_name in enumerate(field_names))
+    features = np.full((len(records), len(field_names)), np.nan, dtype=np.float32)
+    for idx, record_lead_series in enumerate(lead_series):
+        record_features = dict(meta[idx])
+        for lead_name, interval_related, _, _ in record_lead_series:
+            for k, v in (interval_related or {}).items():
+                record_features[f"{lead_name}_{k}"] = v
+        for k, v in record_features.items():
+            if k in field_idx:
+                features[idx, field_idx[k]] = v
+
+    ts_columns = [c for c in ts_df.columns if c in field_idx]
+    if len(ts_columns):
+        features[np.ix_(ts_df.index, [field_idx[c] for c in ts_columns])] = ts_df[
+            ts_columns
+        ].to_numpy()
+
+    return features, dxs
+
+
+def _map_leads(lead_args, n_jobs=None, backend=None):
+    """_lead_to_series of each tuple of arguments in lead_args, in order.
+    backend
+        "serial": in the calling process
+        "threads": a thread per worker, the numpy and scipy heavy parts release the GIL
+        "processes": a pool of n_jobs processes shared by all calls, started once
+    Defaults to "processes", or "serial" when already inside a worker process
+    (training, driver and server workers) so the CPUs are not oversubscribed.
+    """
+    if backend is None:
+        nested = multiprocessing.current_process().name != "MainProcess"
+        backend = "serial" if nested else "processes"
+    if backend not in LEAD_BACKENDS:
+        raise ValueError(f"backend must be one of {LEAD_BACKENDS}, not {backend!r}")
+    if n_jobs is None:
+        n_jobs = len(ECG_LEAD_NAMES)
+
+    if backend == "serial" or n_jobs == 1:
+        return [_lead_to_series(*args) for args in lead_args]
+    if backend == "threads":
+        return joblib.Parallel(n_jobs=n_jobs, backend="threading", verbose=0)(
+            joblib.delayed(_lead_to_series)(*args) for args in lead_args
+        )
+    return _get_lead_pool(n_jobs).starmap(_lead_to_series, lead_args, chunksize=1)
+
+
+_lead_pools = {}
+_lead_pool_lock = threading.Lock()
+
+
+def _get_lead_pool(n_jobs):
+    """The shared lead worker pool of n_jobs processes, started on first use.
+    There is a pool per n_jobs, a pool is never terminated while another thread
+    may still be mapping on it.
+    """
+    with _lead_pool_lock:
+        if n_jobs not in _lead_pools:
+            _lead_pools[n_jobs] = multiprocessing.Pool(n_jobs)
+        return _lead_pools[n_jobs]
+
+
+@atexit.register
+def _close_lead_pools():
+    with _lead_pool_lock:
+        for pool in _lead_pools.values():
+            pool.terminate()
+        _lead_pools.clear()
+
+
+def _lead_to_series(context, lead_name, families=FEATURE_FAMILIES):
+    """Interval related features, best heartbeat and full waveform window of the lead
+    of a single lead SignalContext, for the FEATURE_FAMILIES in families.
+    They are None when they could not be determined, or are not in families.
+    """
+    # Heart Rate Variability Features, the best heartbeat is only taken from leads
+    # with them
+    interval_related = None
+    if families & {"hrv", "hb"}:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                interval_related = context.interval_related[0]
+        except Exception:
+            pass
+
+    # Heart Beat Template
+    heartbeat = None
+    if "hb" in families and (
+        interval_related is not None or context.heartbeat_template != "best"
+    ):
+        try:
+            heartbeat = context.best_heartbeats[0]
+        except Exception:
+            pass
+
+    # Full Waveform
+    signal = None
+    if "sig" in families:
+        try:
+            signal = _signal_window(
+                context.cleaned_signals[:, 0],
+                sampling_rate=context.sampling_rate,
+                resampling=context.signal_resampling,
+            )
+        except Exception:
+            pass
+
+    return lead_name, interval_related, heartbeat, signal
+
+
+def _series_to_feature_dataframes(lead_series, plan):
+    """Features of the _lead_to_series of each lead, the tsfresh features of every
+    lead come from a single tsfresh_vectorized.extract_features call.
+    Returns a list of dataframes, the HRV, heartbeat and signal features of each lead.
+    """
+    kinds, series = _tsfresh_series(lead_series, plan)
+    ts_df = _extract_tsfresh_features(series, kinds, [0] * len(kinds), plan)
+
+    kind_columns = {}
+    for column in ts_df.columns:
+        kind_columns.setdefault(column.split("__")[0], []).append(column)
+
+    feature_dfs = []
+    for lead_name, interval_related, _, _ in lead_series:
         # stick the lead name into all the columns
         hrv_data_dict = {}
-        for k, v in hrv_df.to_dict().items():
+        for k in KEYS_INTERVALRELATED:
             feat_key = f"{lead_name}_{k}"
-            if fc_parameters:
-                # fc_parameters shim exists
-                if feat_key in fc_parameters:
-                    # shim is relevant
-                    hrv_data_dict[feat_key] = v
-            else:
-                # no fc_parameters shim, kludge all
-                hrv_data_dict[feat_key] = v
-        hrv_df = pd.DataFrame(hrv_data_dict)
+            if plan.needs(feat_key):
+                v = np.nan if interval_related is None else interval_related[k]
+                hrv_data_dict[feat_key] = (v,)
+        feature_dfs.append(pd.DataFrame(hrv_data_dict))
 
-    # Heart Beat Template Features
-    try:
-        hb_df = _tsfresh_heartbeat_dataframe(
-            signals_df,
-            rpeaks_info["ECG_R_Peaks"],
-            sampling_rate=sampling_rate,
-            lead_name=lead_name,
-            fc_parameters=fc_parameters,
-        )
-    except Exception:
-        # cannot rely on KEYS_TSFRESH if fc_parameters defined
-        column_value = f"{lead_name}_hb"
-        if fc_parameters:
-            if column_value in fc_parameters:
-                default_fc_parameters = fc_parameters[column_value]
-                hb_df = tsfresh.extract_features(
-                    pd.DataFrame(
-                        {
-                            "lead": [0, 0, 0],
-                            "time": [0, 0.5, 1],
-                            column_value: [0.5, 0.5, 0.5],
-                        }
-                    ),
-                    column_id="lead",
-                    column_sort="time",
-                    column_value=column_value,
-                    show_warnings=False,
-                    disable_progressbar=True,
-                    default_fc_parameters=default_fc_parameters,
-                    n_jobs=0,
-                )
-            else:
-                hb_df = pd.DataFrame()
-        else:
-            hb_df = pd.DataFrame.from_dict(
-                dict((f"{lead_name}_hb__{k}", (np.nan,)) for k in KEYS_TSFRESH)
-            )
+        for kind in (f"{lead_name}_hb", f"{lead_name}_sig"):
+            if kind in kind_columns:
+                feature_dfs.append(ts_df[kind_columns[kind]])
+            elif not plan.fc_parameters and plan.needs(kind):
+                feature_dfs.append(_nan_tsfresh_features(kind))
+
+    return feature_dfs
 
-    # Full Waveform Features
+
+@functools.lru_cache(maxsize=None)
+def _nan_tsfresh_features(kind):
+    """features of a series of kind that could not be extracted without fc_parameters"""
+    return pd.DataFrame.from_dict(
+        dict((f"{kind}__{k}", (np.nan,)) for k in KEYS_TSFRESH)
+    )
+
+
+def _tsfresh_series(lead_series, plan):
+    """(kinds, series) to extract tsfresh features from, for the _lead_to_series of
+    each lead, series is None where the placeholder features of plan stand in
+    """
+    kinds = []
+    series = []
+    for lead_name, _, heartbeat, signal in lead_series:
+        for kind, s in ((f"{lead_name}_hb", heartbeat), (f"{lead_name}_sig", signal)):
+            # tsfresh refuses series with NaN values
+            if s is not None and not np.isnan(s).any():
+                kinds.append(kind)
+                series.append(s)
+            elif kind in plan.placeholder_features:
+                # cannot rely on KEYS_TSFRESH if fc_parameters defined
+                kinds.append(kind)
+                series.append(None)
+    return kinds, series
+
+
+# features of a lead series that could not be extracted, when fc_parameters are defined
+_PLACEHOLDER_SERIES = np.array([0.5, 0.5, 0.5])
+
+
+def _extract_tsfresh_features(series, kinds, ids, plan):
+    """tsfresh features of all series in one tsfresh_vectorized call, one row per id.
+    Series that are None or fail get the placeholder features of plan, or none
+    without fc_parameters, as when each series was extracted on its own.
+    """
+    series = list(series)
     try:
-        sig_df = _tsfresh_signal_dataframe(
-            cleaned_signal,
-            sampling_rate=sampling_rate,
-            lead_name=lead_name,
-            fc_parameters=fc_parameters,
-        )
+        ts_df = _extract_series(series, kinds, ids, plan)
     except Exception:
-        # cannot rely on KEYS_TSFRESH if fc_parameters defined
-        column_value = f"{lead_name}_sig"
-        if fc_parameters:
-            if column_value in fc_parameters:
-                default_fc_parameters = fc_parameters[column_value]
-                sig_df = tsfresh.extract_features(
-                    pd.DataFrame(
-                        {
-                            "lead": [0, 0, 0],
-                            "time": [0, 0.5, 1],
-                            column_value: [0.5, 0.5, 0.5],
-                        }
-                    ),
-                    column_id="lead",
-                    column_sort="time",
-                    column_value=column_value,
-                    show_warnings=False,
-                    disable_progressbar=True,
-                    default_fc_parameters=default_fc_parameters,
-                    n_jobs=0,
+        # find the failing series
+        for j, s in enumerate(series):
+            if s is None:
+                continue
+            try:
+                tsfresh_vectorized.extract_features(
+                    [s], [kinds[j]], **plan.tsfresh_kwargs
                 )
-            else:
-                sig_df = pd.DataFrame()
-        else:
-            sig_df = pd.DataFrame.from_dict(
-                dict((f"{lead_name}_sig__{k}", (np.nan,)) for k in KEYS_TSFRESH)
+            except Exception:
+                series[j] = None
+        ts_df = _extract_series(series, kinds, ids, plan)
+
+    placeholders = {}
+    for sample_id, kind, s in zip(ids, kinds, series):
+        if s is None and kind in plan.placeholder_features:
+            placeholders.setdefault(sample_id, {}).update(
+                plan.placeholder_features[kind]
             )
+    if placeholders:
+        # columns and ids sorted, as tsfresh_vectorized returns them
+        ts_df = ts_df.combine_first(
+            pd.DataFrame.from_dict(placeholders, orient="index")
+        )
+        ts_df.index.name = "id"
+        ts_df.columns.name = "variable"
+    return ts_df
+
+
+def _extract_series(series, kinds, ids, plan):
+    """tsfresh_vectorized features of the series that are not None"""
+    extracted = [(i, k, s) for i, k, s in zip(ids, kinds, series) if s is not None]
+    if not extracted:
+        return pd.DataFrame()
+    ids, kinds, series = zip(*extracted)
+    return tsfresh_vectorized.extract_features(
+        series, kinds, ids=ids, **plan.tsfresh_kwargs
+    )
 
-    return pd.concat([hrv_df, hb_df, sig_df], axis=1)
 
+def _context_stage(compute):
+    """SignalContext property computed on first access and kept for the next one"""
+    name = compute.__name__
 
-def _lead_to_interval_related_dataframe(signals_df, sampling_rate):
-    rpeaks_df, rpeaks_info = nk.ecg_peaks(
-        ecg_cleaned=signals_df["ECG_Clean"].to_numpy(),
-        sampling_rate=sampling_rate,
-        method="neurokit",
-        correct_artifacts=True,
-    )
-    rate = nk.signal_rate(
-        rpeaks_info,
-        sampling_rate=sampling_rate,
-        desired_length=len(signals_df["ECG_Clean"].to_numpy()),
-    )
-    quality = nk.ecg_quality(
-        signals_df["ECG_Clean"].to_numpy(),
-        rpeaks=rpeaks_info["ECG_R_Peaks"],
-        sampling_rate=sampling_rate,
-    )
-    signals_df = pd.concat(
-        [
-            signals_df,
-            rpeaks_df,
-            pd.DataFrame({"ECG_Rate": rate, "ECG_Quality": quality}),
-        ],
-        axis=1,
-    )
-    ir_df = nk.ecg_intervalrelated(signals_df, sampling_rate=sampling_rate)
-    assert all(ir_df.columns == KEYS_INTERVALRELATED)
-    return ir_df, signals_df, rpeaks_info
+    @functools.wraps(compute)
+    def get(context):
+        if name not in context.stages:
+            context.stages[name] = compute(context)
+        return context.stages[name]
 
+    return property(get)
 
-def _tsfresh_heartbeat_dataframe(
-    signals_df, rpeaks, sampling_rate=500, lead_name="X", fc_parameters=None
-):
-    # Determine heart rate windows, get the best heart rate
-    heartbeats = nk.ecg_segment(
-        signals_df.rename(columns={"ECG_Clean": "Signal"}).drop(columns=["ECG_Raw"]),
-        rpeaks=rpeaks,
-        show=False,
-    )
 
-    # get the template with maximum quality and no NaN values in signal
-    best_idx = None
-    best_quality = -1
-    for k, v in heartbeats.items():
-        if not all(np.isfinite(v["Signal"])):
-            continue
-        hb_quality_stats = scipy.stats.describe(v["ECG_Quality"])
-        if hb_quality_stats.mean > best_quality:
-            best_idx = k
-            best_quality = hb_quality_stats.mean
+# heartbeat of a lead: the beat with the best mean quality, or the median or mean beat
+HEARTBEAT_TEMPLATES = ("best", "median", "mean")
 
-    best_heartbeat = heartbeats[best_idx]["Signal"]
-    hb_num_samples = len(best_heartbeat)
-    hb_duration = hb_num_samples / sampling_rate
-    hb_times = np.linspace(0, hb_duration, hb_num_samples).tolist()
+# resampling of the signal window: polyphase filtering of the window only, or FFT
+# resampling of the whole signal, which models trained before "poly" expect
+SIGNAL_RESAMPLINGS = ("poly", "fft")
 
-    column_value = f"{lead_name}_hb"
+# keyword arguments of wfdb_record_to_feature_dataframe, records_to_feature_matrix and
+# lead_to_feature_dataframe that change the features and their defaults, a model is
+# run with the options it was trained with
+FEATURE_OPTIONS = {"heartbeat_template": "best", "signal_resampling": "poly"}
 
-    hb_input_df = pd.DataFrame(
-        {
-            "lead": [0,] * hb_num_samples,
-            "time": hb_times,
-            column_value: best_heartbeat.tolist(),
-        }
-    )
 
-    if fc_parameters:
-        if column_value in fc_parameters:
-            default_fc_parameters = fc_parameters[column_value]
-        else:
-            default_fc_parameters = {}
-    else:
-        default_fc_parameters = FC_PARAMETERS
-
-    hb_df = tsfresh.extract_features(
-        hb_input_df,
-        column_id="lead",
-        column_sort="time",
-        column_value=column_value,
-        show_warnings=False,
-        disable_progressbar=True,
-        default_fc_parameters=default_fc_parameters,
-        n_jobs=0,
-    )
+class SignalContext:
+    """
+    Signals of a record and the signal processing its feature families share.
+    Each stage (R-peaks, heart rate, quality, heartbeat windows, ...) is computed for
+    all leads on first use and kept, later consumers read it instead of redoing it.
+
+    raw_signals: shape should be (signal length, number of leads), the leads may
+        come from many records of the same sampling rate and length
+    cleaned_signals: ecg_clean of raw_signals, when the caller already has it
+    heartbeat_template: one of HEARTBEAT_TEMPLATES, the heartbeat of best_heartbeats
+    signal_resampling: one of SIGNAL_RESAMPLINGS, the resampling of the signal window
+    """
 
-    return hb_df
+    def __init__(
+        self,
+        raw_signals,
+        sampling_rate,
+        cleaned_signals=None,
+        heartbeat_template="best",
+        signal_resampling="poly",
+    ):
+        if heartbeat_template not in HEARTBEAT_TEMPLATES:
+            raise ValueError(
+                f"heartbeat_template should be one of {HEARTBEAT_TEMPLATES}, "
+                f"got {heartbeat_template!r}"
+            )
+        if signal_resampling not in SIGNAL_RESAMPLINGS:
+            raise ValueError(
+                f"signal_resampling should be one of {SIGNAL_RESAMPLINGS}, "
+                f"got {signal_resampling!r}"
+            )
+        self.raw_signals = raw_signals
+        self.sampling_rate = sampling_rate
+        self.heartbeat_template = heartbeat_template
+        self.signal_resampling = signal_resampling
+        self.stages = {}
+        if cleaned_signals is not None:
+            self.stages["cleaned_signals"] = cleaned_signals
+
+    @property
+    def num_leads(self):
+        return self.raw_signals.shape[1]
+
+    def compute(self, *stages):
+        """compute the given stages now, e.g. before the context is split by lead"""
+        for stage in stages:
+            getattr(self, stage)
+        return self
+
+    def lead(self, lead_idx):
+        """context of a single lead, with the stages computed so far"""
+        return self.leads([lead_idx])
+
+    def leads(self, lead_idxs):
+        """context of some of the leads, with the stages computed so far"""
+        context = SignalContext(
+            self.raw_signals[:, lead_idxs],
+            self.sampling_rate,
+            heartbeat_template=self.heartbeat_template,
+            signal_resampling=self.signal_resampling,
+        )
+        for name, value in self.stages.items():
+            context.stages[name] = _lead_stage(value, lead_idxs)
+        return context
+
+    @_context_stage
+    def cleaned_signals(self):
+        return ecg_clean(self.raw_signals, sampling_rate=self.sampling_rate)
+
+    @_context_stage
+    def rpeaks(self):
+        """ecg_peaks of each lead, LeadArrays"""
+        return ecg_peaks(self.cleaned_signals, sampling_rate=self.sampling_rate)
+
+    @_context_stage
+    def rate(self):
+        """heart rate of each lead, LeadArrays, NaN with 3 R-peaks or less as in nk"""
+        rate = signal_rate(
+            self.rpeaks,
+            sampling_rate=self.sampling_rate,
+            desired_length=len(self.cleaned_signals),
+        )
+        rate.values[(self.rpeaks.lengths <= 3)[rate.leads]] = np.nan
+        return rate
+
+    @_context_stage
+    def quality(self):
+        """nk.ecg_quality of each lead, None for the leads it fails on"""
+        quality = []
+        for signal, rpeaks in zip(self.cleaned_signals.T, self.rpeaks):
+            try:
+                quality.append(
+                    nk.ecg_quality(
+                        signal, rpeaks=rpeaks, sampling_rate=self.sampling_rate
+                    )
+                )
+            except Exception:
+                quality.append(None)
+        return quality
+
+    @_context_stage
+    def interval_related(self):
+        """
+        KEYS_INTERVALRELATED of each lead as nk.ecg_intervalrelated computes them
+        from the nk.ecg_peaks, nk.signal_rate and nk.ecg_quality signals of a lead,
+        None for the leads any of them fails on
+        """
+        interval_related = []
+        for rpeaks, rate, quality in zip(self.rpeaks, self.rate, self.quality):
+            # nk.ecg_peaks fails without R-peaks and nk.signal_rate on repeated ones
+            if (
+                len(rpeaks) == 0
+                or (len(rpeaks) > 3 and np.any(np.diff(rpeaks) <= 0))
+                or quality is None
+            ):
+                interval_related.append(None)
+                continue
+
+            try:
+                hrv = nk.hrv({"ECG_R_Peaks": rpeaks}, sampling_rate=self.sampling_rate)
+            except Exception:
+                interval_related.append(None)
+                continue
+            lead_features = {"ECG_Rate_Mean": np.mean(rate)}
+            lead_features.update((k, float(hrv[k])) for k in hrv.columns)
+            if list(lead_features) != KEYS_INTERVALRELATED:
+                lead_features = None
+            interval_related.append(lead_features)
+        return interval_related
+
+    @_context_stage
+    def beat_windows(self):
+        """
+        (starts, ends) of the heartbeat window around each R-peak, LeadArrays, as
+        nk.ecg_segment cuts them with its default 1000 Hz sampling rate. Windows may
+        reach past the signal, leads without a heart rate have none.
+        """
+        sig_len = len(self.cleaned_signals)
+        heart_rate = np.array(
+            [
+                np.mean(rate)
+                for rate in signal_rate(
+                    self.rpeaks, sampling_rate=1000, desired_length=sig_len
+                )
+            ]
+        )
+        heart_rate[self.rpeaks.lengths <= 3] = np.nan
+        has_rate = ~np.isnan(heart_rate)
+
+        # Modulator
+        m = heart_rate / 60
+
+        # Window
+        epochs_start = -0.35 / m
+        epochs_end = 0.5 / m
+
+        # Adjust for high heart rates
+        fast = heart_rate >= 80
+        epochs_start[fast] = epochs_start[fast] - 0.1
+        epochs_end[fast] = epochs_end[fast] + 0.1
+
+        # nk pads the signal by the window length on both sides, the window bounds
+        # are truncated in the padded signal
+        padding = np.zeros(len(heart_rate), dtype=np.int64)
+        padding[has_rate] = ((epochs_end - epochs_start)[has_rate] * 1000).astype(int)
+        peak_leads = self.rpeaks.leads[has_rate[self.rpeaks.leads]]
+        peaks = self.rpeaks.values[has_rate[self.rpeaks.leads]] + padding[peak_leads]
+        lengths = np.where(has_rate, self.rpeaks.lengths, 0)
+        return (
+            LeadArrays.from_lengths(
+                (peaks + epochs_start[peak_leads] * 1000).astype(int)
+                - padding[peak_leads],
+                lengths,
+            ),
+            LeadArrays.from_lengths(
+                (peaks + epochs_end[peak_leads] * 1000).astype(int)
+                - padding[peak_leads],
+                lengths,
+            ),
+        )
+
+    @_context_stage
+    def best_heartbeats(self):
+        """
+        heartbeat_template of the complete heartbeat windows of each lead, by default
+        the cleaned signal of the window with the best mean quality, None for the
+        leads without one
+        """
+        # only the best heartbeat needs the quality
+        best = self.heartbeat_template == "best"
+        qualities = self.quality if best else [None] * self.num_leads
+        heartbeats = []
+        for signal, quality, starts, ends in zip(
+            self.cleaned_signals.T, qualities, *self.beat_windows
+        ):
+            if best and quality is None:
+                heartbeats.append(None)
+            else:
+                heartbeats.append(
+                    _heartbeat_template(
+                        signal, quality, starts, ends, self.heartbeat_template
+                    )
+                )
+        return heartbeats
 
 
-def _tsfresh_signal_dataframe(
+def _lead_stage(value, lead_idxs):
+    """the part of a SignalContext stage belonging to lead_idxs"""
+    if isinstance(value, LeadArrays):
+        return LeadArrays.from_leads([value[i] for i in lead_idxs])
+    if isinstance(value, tuple):
+        return tuple(_lead_stage(v, lead_idxs) for v in value)
+    if isinstance(value, list):
+        return [value[i] for i in lead_idxs]
+    return value[:, lead_idxs]
+
+
+def _lead_contexts(context, plan, num_leads):
+    """
+    (column, single lead context) of the leads of context with features in plan,
+    context holds the num_leads leads of one or more records one after another.
+    The leads that need R-peaks share the R-peaks and heart rate computed together.
+    """
+    lead_idxs = set(plan.lead_idxs())
+    peak_lead_idxs = set(plan.peak_lead_idxs())
+    columns = [c for c in range(context.num_leads) if c % num_leads in lead_idxs]
+    peak_columns = [c for c in columns if c % num_leads in peak_lead_idxs]
+
+    lead_contexts = {}
+    if peak_columns:
+        peak_context = context.leads(peak_columns)
+        try:
+            peak_context.compute("rpeaks", "rate")
+        except Exception:
+            # each lead computes its own, and fails on its own
+            pass
+        for j, c in enumerate(peak_columns):
+            lead_contexts[c] = peak_context.lead(j)
+    return [(c, lead_contexts.get(c) or context.lead(c)) for c in columns]
+
+
+def _beat_matrix(signal, width):
+    """
+    (windows x width) strided view of every window of signal, row i is the window
+    starting at sample i. Indexing it with the starts of the beats copies them.
+    """
+    step = signal.strides[0]
+    return np.lib.stride_tricks.as_strided(
+        signal,
+        shape=(len(signal) - width + 1, width),
+        strides=(step, step),
+        writeable=False,
+    )
+
+
+def _heartbeat_template(signal, quality, starts, ends, template="best"):
+    """
+    heartbeat of the complete and finite windows (starts, ends) of signal: the window
+    with the best mean quality, first one on ties, or the median or mean of the
+    windows of the most common length. None without any such window.
+    quality is only used by the "best" template.
+    """
+    # nk pads the windows reaching past the signal with NaN
+    complete = (starts >= 0) & (ends <= len(signal))
+    starts, ends = starts[complete], ends[complete]
+    widths = ends - starts
+
+    # windows of a lead differ in length by a sample at most, one beat matrix each
+    finite = np.zeros(len(starts), dtype=bool)
+    beat_quality = np.full(len(starts), np.nan)
+    for width in np.unique(widths):
+        beats = widths == width
+        beat_signals = _beat_matrix(signal, width)[starts[beats]]
+        finite[beats] = np.isfinite(beat_signals).all(axis=1)
+        if template == "best":
+            beat_qualities = _beat_matrix(quality, width)[starts[beats]]
+            beat_quality[beats] = beat_qualities.mean(axis=1)
+
+    if template == "best":
+        # NaN quality never is the best
+        usable = finite & (beat_quality > -1)
+        if not usable.any():
+            return None
+        best = np.argmax(np.where(usable, beat_quality, -np.inf))
+        return signal[slice(starts[best], ends[best])].copy()
+
+    if not finite.any():
+        return None
+    values, counts = np.unique(widths[finite], return_counts=True)
+    width = values[np.argmax(counts)]
+    beats = _beat_matrix(signal, width)[starts[finite & (widths == width)]]
+    if template == "median":
+        return np.median(beats, axis=0)
+    return beats.mean(axis=0)
+
+
+def _signal_window(
     cleaned_signal,
     sampling_rate=500,
-    lead_name="X",
     mod_fs=500,
     get_num_samples=2000,
-    fc_parameters=None,
+    resampling="poly",
 ):
-    # convert sampling rate to mod_fs
+    """
+    Middle get_num_samples of the cleaned signal (along the first axis), resampled
+    to mod_fs. Only the window and the margins of the resampling filter are
+    resampled, with a polyphase filter.
+    resampling: one of SIGNAL_RESAMPLINGS, "fft" resamples the whole signal first
+    """
+    if resampling == "fft":
+        return _fft_signal_window(
+            cleaned_signal, sampling_rate, mod_fs, get_num_samples
+        )
+
+    up, down = _resample_factors(sampling_rate, mod_fs)
+    if up == down:
+        len_mod_fs = len(cleaned_signal)
+    else:
+        len_mod_fs = int(len(cleaned_signal) / sampling_rate * mod_fs)
+
+    # drop 1 second from the start and ends of the cleaned signals
+    start = mod_fs
+    end = max(len_mod_fs - mod_fs, start)
+
+    # if over get_num_samples, take middle
+    if end - start > get_num_samples:
+        mid_point = start + int((end - start) / 2)
+        start = mid_point - get_num_samples // 2
+        end = mid_point + get_num_samples // 2
+
+    if up == down or start == end:
+        return cleaned_signal[start:end]
+
+    # resampled sample i is at sample i * down / up of the signal, the cropped signal
+    # starts at a multiple of down for its resampled samples to be the same ones
+    h = _resample_filter(up, down)
+    margin = len(h) // (2 * up) + 2
+    first = max((start * down // up - margin) // down * down, 0)
+    last = (end * down + up - 1) // up + margin
+    resampled = scipy.signal.resample_poly(
+        cleaned_signal[first:last], up, down, axis=0, window=h
+    )
+    offset = first // down * up
+    return resampled[start - offset : end - offset]  # noqa: E203
+
+
+def _fft_signal_window(cleaned_signal, sampling_rate, mod_fs, get_num_samples):
+    """_signal_window as models trained before polyphase resampling saw it"""
     len_mod_fs = int(len(cleaned_signal) / sampling_rate * mod_fs)
     cleaned_signal = scipy.signal.resample(cleaned_signal, len_mod_fs)
 
@@ -1138,40 +1741,28 @@ def _tsfresh_signal_dataframe(
     if len(cleaned_signal) > get_num_samples:
         mid_point = int(len(cleaned_signal) / 2)
         cleaned_signal = cleaned_signal[
-            mid_point
-            - get_num_samples // 2 : mid_point  # noqa: E203
+            mid_point - get_num_samples // 2 : mid_point  # noqa: E203
             + get_num_samples // 2
         ]
-    num_samples = len(cleaned_signal)
+    return cleaned_signal
 
-    duration = num_samples / mod_fs
-    # convert to tsfresh compatible dataframe
 
-    times = np.linspace(0, duration, num_samples).tolist()
-    column_value = f"{lead_name}_sig"
-    sig_input_df = pd.DataFrame(
-        {"lead": [0,] * num_samples, "time": times, column_value: cleaned_signal,}
-    )
+@functools.lru_cache(maxsize=None)
+def _resample_factors(sampling_rate, mod_fs):
+    """(up, down) rational resampling factors from sampling_rate to mod_fs"""
+    ratio = fractions.Fraction(mod_fs) / fractions.Fraction(sampling_rate)
+    ratio = ratio.limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
 
-    if fc_parameters:
-        if column_value in fc_parameters:
-            default_fc_parameters = fc_parameters[column_value]
-        else:
-            default_fc_parameters = {}
-    else:
-        default_fc_parameters = FC_PARAMETERS
-
-    sig_df = tsfresh.extract_features(
-        sig_input_df,
-        column_id="lead",
-        column_sort="time",
-        column_value=column_value,
-        show_warnings=False,
-        disable_progressbar=True,
-        default_fc_parameters=default_fc_parameters,
-        n_jobs=0,
+
+@functools.lru_cache(maxsize=None)
+def _resample_filter(up, down):
+    """low-pass FIR filter scipy.signal.resample_poly designs for up and down"""
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return scipy.signal.firwin(
+        2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0)
     )
-    return sig_df
 
 
 # it was faster to just do single lead multi-process, rather than single process multi-lead :/
@@ -1180,90 +1771,389 @@ def _tsfresh_signal_dataframe(
 def ecg_clean(ecg_signal, sampling_rate=500):
     """
     parallelized version of nk.ecg_clean(method="neurokit")
-    signal, np.array. shape should be (number of leads, signal length)
+    signal, np.array. shape should be (signal length, number of leads),
+    or (number of records, signal length, number of leads) for a batch of records
     """
+    sos, b, a = _ecg_clean_filters(sampling_rate)
 
     # Remove slow drift with highpass Butterworth.
+    clean = np.swapaxes(scipy.signal.sosfiltfilt(sos, ecg_signal, axis=-2), -1, -2)
+
+    # DC offset removal with 50hz powerline filter (convolve average kernel)
+    clean = np.swapaxes(scipy.signal.filtfilt(b, a, clean, method="pad", axis=-1), -1, -2)
+
+    return clean
+
+
+@functools.lru_cache(maxsize=None)
+def _ecg_clean_filters(sampling_rate):
+    """
+    (sos, b, a) of the ecg_clean filters, designed once per sampling rate as the
+    records only come in a few (257, 500, 1000 Hz)
+    """
     sos = scipy.signal.butter(
         5, [0.5,], btype="highpass", output="sos", fs=sampling_rate
     )
-    clean = scipy.signal.sosfiltfilt(sos, ecg_signal, axis=0).T
-
-    # DC offset removal with 50hz powerline filter (convolve average kernel)
     if sampling_rate >= 100:
         b = np.ones(int(sampling_rate / 50))
     else:
         b = np.ones(2)
-    a = [
-        len(b),
-    ]
-    clean = scipy.signal.filtfilt(b, a, clean, method="pad", axis=1).T
+    a = (len(b),)
+    return sos, b, a
 
-    return clean
 
+class LeadArrays:
+    """
+    ragged array of per-lead values (peaks, rates, qualities, ...),
+    the values of all leads are stored one after another in one flat array and
+    the values of lead i are values[offsets[i]:offsets[i + 1]]
+    """
+
+    __slots__ = ("values", "offsets")
+
+    def __init__(self, values, offsets):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_lengths(cls, values, lengths):
+        return cls(values, np.r_[0, np.cumsum(lengths, dtype=np.int64)])
+
+    @classmethod
+    def from_leads(cls, lead_values):
+        return cls.from_lengths(
+            np.concatenate(lead_values), [len(v) for v in lead_values]
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, lead_idx):
+        start, end = self.offsets[lead_idx], self.offsets[lead_idx + 1]
+        return self.values[start:end]
+
+    def __iter__(self):
+        return iter(np.split(self.values, self.offsets[1:-1]))
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def leads(self):
+        """lead index of each value"""
+        return np.repeat(np.arange(len(self)), self.lengths)
 
-def ecg_peaks(ecg_signal, sampling_rate=500, ecg_lead_names=ECG_LEAD_NAMES):
+    def reduce(self, ufunc, empty=np.nan):
+        """ufunc reduction of the values of each lead, empty for leads without values"""
+        lengths = self.lengths
+        reduced = np.full(len(self), empty, dtype=np.result_type(self.values, empty))
+        reduced[lengths > 0] = ufunc.reduceat(
+            self.values, self.offsets[:-1][lengths > 0]
+        )
+        return reduced
+
+
+def ecg_peaks(ecg_signal, sampling_rate=500):
     """
-    somewhat parallelized version of nk.ecg_peaks(method='neurokit', correct_artifacts=True)
+    parallelized version of nk.ecg_peaks(method='neurokit', correct_artifacts=True)
 
-    each lead may have different dimensioned peaks anyways,
-    so parallelization of the peak fixing/detection is not trivial
+    returns the R-peaks of all leads as LeadArrays
     """
 
     # nk.ecg_findpeaks()
-    lead_rpeaks = _ecg_findpeaks_neurokit(ecg_signal, sampling_rate=sampling_rate)
-
-    signals = []
-    info = {}
+    rpeaks = _ecg_findpeaks_neurokit(ecg_signal, sampling_rate=sampling_rate)
 
     # correct artifacts
-    signals_info = map(
-        functools.partial(
-            _ecg_peaks_partial,
-            sampling_rate=sampling_rate,
-            lead_rpeaks=lead_rpeaks,
-            ecg_signal=ecg_signal,
-            ecg_lead_names=ecg_lead_names,
-        ),
-        enumerate(lead_rpeaks),
-    )
+    return ecg_fixpeaks(rpeaks, sampling_rate=sampling_rate)
 
-    signals, info = zip(*signals_info)
-    signals = pd.concat(signals)
-    return signals, info
 
+def ecg_fixpeaks(rpeaks, sampling_rate=500):
+    """
+    multi-lead version of nk.signal_fixpeaks(iterative=True, method="Kubios")
 
-def _ecg_peaks_partial(
-    lead_idx_rpeaks,
-    sampling_rate=500,
-    lead_rpeaks=None,
-    ecg_signal=None,
-    ecg_lead_names=None,
+    rpeaks: LeadArrays of the sorted R-peaks of each lead
+    returns the corrected R-peaks as LeadArrays
+    """
+    counts = rpeaks.lengths
+    rpeaks = rpeaks.values
+    num_leads = len(counts)
+
+    artifacts, num_artifacts = _find_artifacts(rpeaks, counts, sampling_rate)
+    rpeaks, counts = _correct_artifacts(rpeaks, counts, artifacts)
+
+    # each lead is corrected again until its number of artifacts is the same as
+    # two passes before, as nk does
+    artifact_history = [np.full(num_leads, np.inf), num_artifacts]
+    iterating = np.ones(num_leads, dtype=bool)
+    while iterating.any():
+        artifacts, num_artifacts = _find_artifacts(rpeaks, counts, sampling_rate)
+        artifacts = dict(
+            (k, (leads[iterating[leads]], idcs[iterating[leads]]))
+            for k, (leads, idcs) in artifacts.items()
+        )
+        rpeaks, counts = _correct_artifacts(rpeaks, counts, artifacts)
+
+        artifact_history.append(num_artifacts)
+        if len(artifact_history) > 3:
+            iterating &= artifact_history[-1] != artifact_history[-3]
+
+    return LeadArrays.from_lengths(rpeaks, counts)
+
+
+def _find_artifacts(
+    peaks,
+    counts,
+    sampling_rate,
+    c1=0.13,
+    c2=0.17,
+    alpha=5.2,
+    window_width=91,
+    medfilt_order=11,
 ):
-    lead_idx, rpeaks = lead_idx_rpeaks
+    """Kubios artifacts of the peaks of every lead, as nk _find_artifacts.
+    counts: number of peaks of each lead
+    Returns a dict of the (leads, indices) of each artifact type, sorted by lead and
+    index, and the number of artifacts of each lead.
+    """
+    num_leads = len(counts)
+
+    # each lead has at least one period, as np.ediff1d(peaks, to_begin=0)
+    sizes = np.maximum(counts, 1)
+    starts = _group_starts(sizes)
+    lead_of = np.repeat(np.arange(num_leads), sizes)
+    pos = _group_ranks(sizes)
+
+    rr = np.zeros(len(pos))
+    has_prev = pos > 0
+    peak_idx = _group_starts(counts)[lead_of[has_prev]] + pos[has_prev]
+    rr[has_prev] = peaks[peak_idx] - peaks[peak_idx - 1]
+    rr = rr / sampling_rate
+    rr[starts] = _mean_of_rest(rr, starts)
+
+    drrs = np.zeros(len(pos))
+    drrs[has_prev] = rr[1:][has_prev[1:]] - rr[:-1][has_prev[1:]]
+    drrs[starts] = _mean_of_rest(drrs, starts)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drrs /= _artifact_threshold(drrs, lead_of, pos, alpha, window_width)
+
+        # neighbouring differences within each lead, reflected at the lead edges
+        prev_drrs = drrs[starts[lead_of] + _reflect(pos - 1, sizes[lead_of])]
+        next_drrs = drrs[starts[lead_of] + _reflect(pos + 1, sizes[lead_of])]
+        next2_drrs = drrs[starts[lead_of] + _reflect(pos + 2, sizes[lead_of])]
+        s12 = np.where(
+            drrs > 0,
+            np.maximum(prev_drrs, next_drrs),
+            np.where(drrs < 0, np.minimum(prev_drrs, next_drrs), 0.0),
+        )
+        s22 = np.where(
+            drrs >= 0,
+            np.minimum(next_drrs, next2_drrs),
+            np.where(drrs < 0, np.maximum(next_drrs, next2_drrs), 0.0),
+        )
 
-    _, rpeaks = nk.signal_fixpeaks(
-        {"ECG_R_Peaks": rpeaks},
-        sampling_rate=sampling_rate,
-        iterative=True,
-        method="Kubios",
+        medrr = _rolling_leads(rr, lead_of, pos, medfilt_order).median()
+        medrr = medrr.to_numpy()[pos, lead_of]
+        mrrs = rr - medrr
+        mrrs[mrrs < 0] = mrrs[mrrs < 0] * 2
+        th2 = _artifact_threshold(mrrs, lead_of, pos, alpha, window_width)
+        mrrs /= th2
+
+        # classification of each period, as in Figure 1
+        big_drrs = np.abs(drrs) > 1
+        big_mrrs = np.abs(mrrs) > 3
+        ectopic = np.logical_or(
+            np.logical_and(drrs > 1, s12 < (-c1 * drrs - c2)),
+            np.logical_and(drrs < -1, s12 > (-c1 * drrs + c2)),
+        )
+        eq3 = np.logical_and(drrs > 1, s22 < -1)
+        eq5 = np.logical_and(drrs < -1, s22 > 1)
+        next_rr = np.r_[rr[1:], np.nan]
+        eq6 = np.abs(rr / 2 - medrr) < th2
+        eq7 = np.abs(rr + next_rr - medrr) < th2
+        next_abs_drrs = np.r_[np.abs(drrs[1:]), np.nan]
+        second_candidate = next_abs_drrs < np.r_[next_abs_drrs[1:], np.nan]
+
+    # the periods nk loops over, and whether a period is a long/short candidate
+    visitable = pos < sizes[lead_of] - 2
+    not_small = np.logical_not(np.abs(drrs) <= 1)
+    longshort_path = np.logical_and.reduce(
+        (
+            visitable,
+            not_small,
+            np.logical_not(ectopic),
+            np.logical_or(big_drrs, big_mrrs),
+        )
     )
 
-    # rpeaks not guaranteed to be sorted in increasing order?
-    rpeaks = np.sort(rpeaks)
-    lead_rpeaks[lead_idx] = rpeaks
-    rpeaks_info = {"ECG_R_Peaks": rpeaks}
+    # a period with two long/short candidates makes nk skip the next period
+    skips_next = np.logical_and(longshort_path, second_candidate)
+    follows_skip = np.r_[False, skips_next[:-1]]
+    follows_skip[starts] = False
+    run_start = np.logical_and(skips_next, np.logical_not(follows_skip))
+    run_start_idx = np.maximum.accumulate(
+        np.where(run_start, np.arange(len(pos)), 0)
+    )
+    visited = np.logical_or(
+        np.logical_not(follows_skip),
+        (np.arange(len(pos)) - np.r_[0, run_start_idx[:-1]]) % 2 == 0,
+    )
+    visited = np.logical_and(visited, visitable)
+
+    is_ectopic = np.logical_and.reduce((visited, not_small, ectopic))
+    candidate = np.logical_and(visited, longshort_path)
+    candidate[1:] |= np.logical_and(candidate, skips_next)[:-1]
+    candidate &= np.logical_or.reduce((eq3, big_mrrs, eq5))
+    is_extra = np.logical_and.reduce((candidate, eq5, eq7))
+    is_missed = np.logical_and.reduce(
+        (candidate, np.logical_not(is_extra), eq3, eq6)
+    )
+    is_longshort = np.logical_and.reduce(
+        (candidate, np.logical_not(is_extra), np.logical_not(is_missed))
+    )
 
-    # nk.signal_formatpeaks()
-    if len(rpeaks) > 0:
-        instant_peaks = nk.signal_formatpeaks(
-            rpeaks_info, desired_length=len(ecg_signal), peak_indices=rpeaks_info
+    artifacts = dict(
+        (k, (lead_of[is_artifact], pos[is_artifact]))
+        for k, is_artifact in (
+            ("ectopic", is_ectopic),
+            ("missed", is_missed),
+            ("extra", is_extra),
+            ("longshort", is_longshort),
         )
-    else:
-        instant_peaks = pd.DataFrame({"ECG_R_Peaks": [0.0,] * len(ecg_signal)})
-    instant_peaks["ECG_Sig_Name"] = ecg_lead_names[lead_idx]
+    )
+    num_artifacts = np.bincount(
+        lead_of[np.logical_or.reduce((is_ectopic, is_missed, is_extra, is_longshort))],
+        minlength=num_leads,
+    )
+    return artifacts, num_artifacts
+
+
+def _mean_of_rest(values, starts):
+    """mean of the values after the first of each group, as np.mean does it"""
+    return [
+        np.mean(group[1:]) if len(group) > 1 else np.nan
+        for group in np.split(values, starts[1:])
+    ]
 
-    return instant_peaks, rpeaks_info
+
+def _reflect(pos, sizes):
+    """positions one or two past the edges of a group reflected back into it,
+    as np.pad(mode="reflect"), clipped for groups too small to reflect into
+    """
+    pos = np.where(pos < 0, -pos, pos)
+    pos = np.where(pos > sizes - 1, 2 * (sizes - 1) - pos, pos)
+    return np.clip(pos, 0, sizes - 1)
+
+
+def _rolling_leads(values, lead_of, pos, window):
+    """centered pandas rolling window over the values of each lead, the leads are
+    NaN padded columns so they roll as separate series would
+    """
+    padded = np.full((np.max(pos) + 1, np.max(lead_of) + 1), np.nan)
+    padded[pos, lead_of] = values
+    return pd.DataFrame(padded).rolling(window, center=True, min_periods=1)
+
+
+def _artifact_threshold(values, lead_of, pos, alpha, window_width):
+    rolling = _rolling_leads(np.abs(values), lead_of, pos, window_width)
+    q1 = rolling.quantile(0.25).to_numpy()[pos, lead_of]
+    q3 = rolling.quantile(0.75).to_numpy()[pos, lead_of]
+    return alpha * ((q3 - q1) / 2)
+
+
+def _correct_artifacts(peaks, counts, artifacts):
+    """nk _correct_artifacts of the peaks of every lead, returns (peaks, counts)"""
+    extra = artifacts["extra"]
+    missed = artifacts["missed"]
+    ectopic = artifacts["ectopic"]
+    longshort = artifacts["longshort"]
+
+    if len(extra[1]):
+        peaks = np.delete(peaks, _group_starts(counts)[extra[0]] + extra[1])
+        counts = counts - np.bincount(extra[0], minlength=len(counts))
+        missed = _update_indices(extra, missed, -1)
+        ectopic = _update_indices(extra, ectopic, -1)
+        longshort = _update_indices(extra, longshort, -1)
+
+    if len(missed[1]):
+        peaks, counts = _correct_missed(missed, peaks, counts)
+        ectopic = _update_indices(missed, ectopic, 1)
+        longshort = _update_indices(missed, longshort, 1)
+
+    if len(ectopic[1]):
+        peaks, counts = _correct_misaligned(ectopic, peaks, counts)
+
+    if len(longshort[1]):
+        peaks, counts = _correct_misaligned(longshort, peaks, counts)
+
+    return peaks, counts
+
+
+def _correct_missed(missed, peaks, counts):
+    leads, idcs = missed
+    valid = np.logical_and(idcs > 1, idcs < counts[leads])
+    leads = leads[valid]
+    peak_idx = _group_starts(counts)[leads] + idcs[valid]
+
+    prev_peaks = peaks[peak_idx - 1]
+    next_peaks = peaks[peak_idx]
+    added_peaks = prev_peaks + (next_peaks - prev_peaks) / 2
+    peaks = np.insert(peaks, peak_idx, added_peaks)
+    return peaks, counts + np.bincount(leads, minlength=len(counts))
+
+
+def _correct_misaligned(misaligned, peaks, counts):
+    leads, idcs = misaligned
+    num_leads = len(counts)
+    valid = np.logical_and(idcs > 1, idcs < counts[leads] - 1)
+    leads = leads[valid]
+    peak_idx = _group_starts(counts)[leads] + idcs[valid]
+
+    prev_peaks = peaks[peak_idx - 1]
+    next_peaks = peaks[peak_idx + 1]
+    half_ibi = (next_peaks - prev_peaks) / 2
+    peaks_interp = prev_peaks + half_ibi
+
+    peak_leads = np.repeat(np.arange(num_leads), counts)
+    kept = np.ones(len(peaks), dtype=bool)
+    kept[peak_idx] = False
+    peak_leads = np.concatenate((peak_leads[kept], leads))
+    peaks = np.concatenate((peaks[kept], peaks_interp)).astype(int)
+    order = np.lexsort((peaks, peak_leads))
+    return peaks[order], np.bincount(peak_leads, minlength=num_leads)
+
+
+def _update_indices(source, update, update_by):
+    """nk _update_indices for the artifacts of every lead, each source index of a
+    lead shifts the update indices of that lead larger than it, one after another.
+    The updated indices of a lead are unique and sorted, as np.unique in nk.
+    """
+    source_leads, source_idcs = source
+    update_leads, update_idcs = update
+    if not len(source_idcs) or not len(update_idcs):
+        return update
+
+    num_leads = max(np.max(source_leads), np.max(update_leads)) + 1
+    source_rank = _group_ranks(np.bincount(source_leads, minlength=num_leads))
+    for rank in range(np.max(source_rank) + 1):
+        lead_source = np.full(num_leads, np.iinfo(np.int64).max)
+        lead_source[source_leads[source_rank == rank]] = source_idcs[
+            source_rank == rank
+        ]
+        update_idcs = np.where(
+            update_idcs > lead_source[update_leads],
+            update_idcs + update_by,
+            update_idcs,
+        )
+
+    # deleted peaks can move two indices onto one, e.g. extra [5, 6] and
+    # ectopic [7, 8] give [6, 6], which would delete one peak and add two
+    order = np.lexsort((update_idcs, update_leads))
+    update_leads, update_idcs = update_leads[order], update_idcs[order]
+    unique = np.ones(len(update_idcs), dtype=bool)
+    unique[1:] = (np.diff(update_leads) != 0) | (np.diff(update_idcs) != 0)
+    return update_leads[unique], update_idcs[unique]
 
 
 def _ecg_findpeaks_neurokit(
@@ -1279,6 +2169,8 @@ def _ecg_findpeaks_neurokit(
 
     The `signal` must be the highpass-filtered raw ECG with a lowcut of .5 Hz.
 
+    The QRS of all leads are searched for their most prominent peak together,
+    only the minimum delay between peaks of a lead is enforced one peak at a time.
     """
     # Compute the ECG's gradient as well as the gradient threshold. Run with
     # show=True in order to get an idea of the threshold.
@@ -1291,96 +2183,318 @@ def _ecg_findpeaks_neurokit(
     gradthreshold = gradthreshweight * avggrad
     mindelay = int(np.rint(sampling_rate * mindelay))
 
-    # Identify start and end of QRS complexes.
-    qrs = smoothgrad > gradthreshold
-    beg_qrs, beg_qrs_leads = np.where(
-        np.logical_and(np.logical_not(qrs[0:-1]), qrs[1:])
+    signal_len, num_leads = signal.shape
+
+    # Identify start and end of QRS complexes, ordered by lead and then sample.
+    qrs = (smoothgrad > gradthreshold).T
+    beg_leads, beg_qrs = np.where(
+        np.logical_and(np.logical_not(qrs[:, 0:-1]), qrs[:, 1:])
     )
-    end_qrs, end_qrs_leads = np.where(
-        np.logical_and(qrs[0:-1], np.logical_not(qrs[1:]))
+    end_leads, end_qrs = np.where(
+        np.logical_and(qrs[:, 0:-1], np.logical_not(qrs[:, 1:]))
     )
 
-    # group indices per lead index
-    beg_qrs_map = {}
-    for sig_idx, lead_idx in zip(beg_qrs, beg_qrs_leads):
-        sig_idxs = beg_qrs_map.get(lead_idx, np.empty(0, dtype=np.int64))
-        beg_qrs_map[lead_idx] = np.append(sig_idxs, sig_idx)
-
-    end_qrs_map = {}
-    for sig_idx, lead_idx in zip(end_qrs, end_qrs_leads):
-        sig_idxs = end_qrs_map.get(lead_idx, np.empty(0, dtype=np.int64))
-        end_qrs_map[lead_idx] = np.append(sig_idxs, sig_idx)
-
-    signal_len, num_leads = signal.shape
+    # Throw out QRS-ends that precede first QRS-start.
+    num_beg = np.bincount(beg_leads, minlength=num_leads)
+    first_beg = np.zeros(num_leads, dtype=np.int64)
+    first_beg[num_beg > 0] = beg_qrs[_group_starts(num_beg)[num_beg > 0]]
+    after_first_beg = end_qrs > first_beg[end_leads]
+    end_leads = end_leads[after_first_beg]
+    end_qrs = end_qrs[after_first_beg]
+    num_end = np.bincount(end_leads, minlength=num_leads)
+
+    # Pair the i-th QRS-start of each lead with its i-th QRS-end.
+    num_qrs = np.minimum(num_beg, num_end)
+    beg_qrs = beg_qrs[_group_ranks(num_beg) < num_qrs[beg_leads]]
+    end_qrs = end_qrs[_group_ranks(num_end) < num_qrs[end_leads]]
+    qrs_leads = np.repeat(np.arange(num_leads), num_qrs)
+
+    # Identify R-peaks within QRS (ignore QRS that are too short).
+    len_qrs = end_qrs - beg_qrs
+    with np.errstate(invalid="ignore", divide="ignore"):
+        min_len = (
+            np.bincount(qrs_leads, weights=len_qrs, minlength=num_leads)
+            / num_qrs
+            * minlenweight
+        )
+    long_enough = np.logical_not(len_qrs < min_len[qrs_leads])
+    qrs_leads = qrs_leads[long_enough]
+    beg_qrs = beg_qrs[long_enough]
+    len_qrs = len_qrs[long_enough]
+
+    no_peaks = LeadArrays(np.empty(0, dtype=int), np.zeros(num_leads + 1))
+    if not len(len_qrs):
+        return no_peaks
+
+    # Find local maxima and their prominence within all QRS at once, the QRS are
+    # concatenated into one array of segments.
+    seg_starts = _group_starts(len_qrs)
+    seg_of = np.repeat(np.arange(len(len_qrs)), len_qrs)
+    seg_pos = _group_ranks(len_qrs)
+    data = signal[beg_qrs[seg_of] + seg_pos, qrs_leads[seg_of]]
+    locmax = _segment_local_maxima(data, seg_pos, len_qrs[seg_of])
+    if not len(locmax):
+        return no_peaks
+    prominences = _segment_prominences(
+        data, locmax, seg_starts[seg_of[locmax]], len_qrs[seg_of[locmax]]
+    )
 
-    lead_peaks = []
-    for lead_idx in range(num_leads):
-        beg_qrs = beg_qrs_map.get(lead_idx, np.zeros(1))
-        end_qrs = end_qrs_map.get(lead_idx, np.zeros(1))
+    # Identify most prominent local maximum of each QRS.
+    locmax_seg = seg_of[locmax]
+    qrs_with_locmax, first_locmax = np.unique(locmax_seg, return_index=True)
+    max_prominence = np.maximum.reduceat(prominences, first_locmax)
+    is_max = prominences == np.repeat(
+        max_prominence, np.diff(np.r_[first_locmax, len(locmax)])
+    )
+    first_max = np.unique(locmax_seg[is_max], return_index=True)[1]
+    most_prominent = locmax[is_max][first_max]
+    candidates = beg_qrs[qrs_with_locmax] + seg_pos[most_prominent]
+
+    # Enforce minimum delay between peaks, each peak depends on the previous kept peak.
+    candidate_leads = qrs_leads[qrs_with_locmax]
+    kept = np.zeros(len(candidates), dtype=bool)
+    last_peaks = [0] * num_leads
+    for idx, (lead_idx, peak) in enumerate(
+        zip(candidate_leads.tolist(), candidates.tolist())
+    ):
+        if peak - last_peaks[lead_idx] > mindelay:
+            kept[idx] = True
+            last_peaks[lead_idx] = peak
+
+    return LeadArrays.from_lengths(
+        candidates[kept].astype(int),  # Convert to int
+        np.bincount(candidate_leads[kept], minlength=num_leads),
+    )
 
-        # Throw out QRS-ends that precede first QRS-start.
-        end_qrs = end_qrs[end_qrs > beg_qrs[0]]
 
-        # Identify R-peaks within QRS (ignore QRS that are too short).
-        num_qrs = min(beg_qrs.size, end_qrs.size)
-        min_len = np.mean(end_qrs[:num_qrs] - beg_qrs[:num_qrs]) * minlenweight
-        peaks = [0]
+def _group_starts(group_sizes):
+    """Index of the first element of each group, for groups stored one after another"""
+    return np.cumsum(group_sizes) - group_sizes
 
-        for i in range(num_qrs):
 
-            beg = beg_qrs[i]
-            end = end_qrs[i]
-            len_qrs = end - beg
+def _group_ranks(group_sizes):
+    """Position of each element within its group, for groups stored one after another"""
+    return np.arange(np.sum(group_sizes)) - np.repeat(
+        _group_starts(group_sizes), group_sizes
+    )
 
-            if len_qrs < min_len:
-                continue
 
-            # Find local maxima and their prominence within QRS.
-            data = signal[beg:end, lead_idx]
-            locmax, props = scipy.signal.find_peaks(data, prominence=(None, None))
+def _segment_local_maxima(data, seg_pos, seg_len):
+    """scipy.signal.find_peaks local maxima of each segment of data, as indices
+    into data. Flat peaks give their middle sample, as scipy does.
+    seg_pos, seg_len: position within and length of the segment of each sample
+    """
+    # runs of equal samples within a segment
+    run_start = np.flatnonzero(
+        np.r_[True, np.logical_or(data[1:] != data[:-1], seg_pos[1:] == 0)]
+    )
+    run_end = np.r_[run_start[1:], len(data)] - 1
 
-            if locmax.size > 0:
-                # Identify most prominent local maximum.
-                peak = beg + locmax[np.argmax(props["prominences"])]
-                # Enforce minimum delay between peaks.
-                if peak - peaks[-1] > mindelay:
-                    peaks.append(peak)
+    # a run is a local maximum when the samples either side of it are lower
+    inner = np.logical_and(
+        seg_pos[run_start] > 0, seg_pos[run_end] < seg_len[run_end] - 1
+    )
+    run_start = run_start[inner]
+    run_end = run_end[inner]
+    is_max = np.logical_and(
+        data[run_start - 1] < data[run_start], data[run_end + 1] < data[run_end]
+    )
+    return (run_start[is_max] + run_end[is_max]) // 2
 
-        peaks.pop(0)
 
-        lead_peaks.append(np.asarray(peaks).astype(int))  # Convert to int
-    return lead_peaks
+def _segment_prominences(data, peaks, seg_start, seg_len):
+    """scipy.signal.peak_prominences of each peak within its own segment of data.
+    peaks: indices into data, seg_start, seg_len: segment of each peak
+    """
+    # every sample of its segment, for each peak
+    peak_of = np.repeat(np.arange(len(peaks)), seg_len)
+    pos = _group_ranks(seg_len)
+    values = data[seg_start[peak_of] + pos]
+    peak_pos = (peaks - seg_start)[peak_of]
+    heights = data[peaks]
+    higher = values > heights[peak_of]
+    groups = _group_starts(seg_len)
+
+    # the bases extend from the peak until a higher sample, or the segment edge
+    left_end = (
+        np.maximum.reduceat(
+            np.where(np.logical_and(higher, pos < peak_pos), pos, -1), groups
+        )
+        + 1
+    )
+    right_end = (
+        np.minimum.reduceat(
+            np.where(np.logical_and(higher, pos > peak_pos), pos, seg_len[peak_of]),
+            groups,
+        )
+        - 1
+    )
+    left_min = np.minimum.reduceat(
+        np.where(
+            np.logical_and(pos >= left_end[peak_of], pos <= peak_pos), values, np.inf
+        ),
+        groups,
+    )
+    right_min = np.minimum.reduceat(
+        np.where(
+            np.logical_and(pos >= peak_pos, pos <= right_end[peak_of]), values, np.inf
+        ),
+        groups,
+    )
+    return heights - np.maximum(left_min, right_min)
 
 
 def signal_rate(all_r_peaks, sampling_rate=500, desired_length=None):
     """
-    somewhat parallelized version of nk.signal_rate(interpolation_method="monotone_cubic")
+    vectorized version of nk.signal_rate(interpolation_method="monotone_cubic")
 
-    all_r_peaks: infos from ecg_peaks return
+    all_r_peaks: LeadArrays of the sorted R-peaks of each lead, from ecg_peaks return,
+        the leads may come from many records
+    desired_length: number of samples of each lead, one for all leads or one per lead
+    returns the rate of each lead as LeadArrays
     """
+    num_leads = len(all_r_peaks)
+    desired_lengths = np.broadcast_to(
+        np.asarray(desired_length, dtype=np.int64), (num_leads,)
+    )
 
-    rate = dict(
-        map(
-            functools.partial(
-                _signal_rate_partial,
-                sampling_rate=sampling_rate,
-                desired_length=desired_length,
+    # edge case if peaks desired length request is larger than max peak index
+    peak_leads = all_r_peaks.leads
+    in_lead = all_r_peaks.values < desired_lengths[peak_leads]
+    peak_leads = peak_leads[in_lead]
+    peaks = LeadArrays.from_lengths(
+        all_r_peaks.values[in_lead], np.bincount(peak_leads, minlength=num_leads)
+    )
+
+    # needs at least 3 peaks to compute rate, otherwise NaN,
+    # leads with repeated peaks are left to the scipy.interpolate.interp1d fallback
+    repeated = (peak_leads[1:] == peak_leads[:-1]) & (np.diff(peaks.values) <= 0)
+    increasing = np.bincount(peak_leads[1:][repeated], minlength=num_leads) == 0
+    enough = peaks.lengths >= 3
+
+    rate = LeadArrays.from_lengths(
+        np.full(np.sum(desired_lengths), np.nan), desired_lengths
+    )
+    batched = enough & increasing
+    if batched.any():
+        rate.values[batched[rate.leads]] = _monotone_cubic_rate(
+            LeadArrays.from_lengths(
+                peaks.values[batched[peak_leads]], peaks.lengths[batched]
             ),
-            enumerate(all_r_peaks),
+            desired_lengths[batched],
+            sampling_rate,
+        )
+    for lead_idx in np.flatnonzero(enough & ~increasing):
+        rate[lead_idx][:] = _signal_rate_partial(
+            peaks[lead_idx],
+            sampling_rate=sampling_rate,
+            desired_length=desired_lengths[lead_idx],
         )
-    )
 
     return rate
 
 
-def _signal_rate_partial(kv, sampling_rate=500, desired_length=None):
-    k, v = kv
-    peaks = v["ECG_R_Peaks"]
+def _monotone_cubic_rate(peaks, desired_lengths, sampling_rate):
+    """
+    rate of leads with at least 3 strictly increasing peaks, the period between peaks
+    is interpolated as scipy.interpolate.PchipInterpolator does and held constant
+    before the first and after the last peak of each lead
+    returns the rates of all leads one after another
+    """
+    starts = peaks.offsets[:-1]
+    ends = peaks.offsets[1:] - 1
+    x = peaks.values.astype(float)
+    peak_leads = peaks.leads
+
+    # Calculate period in sec, based on peak to peak difference, the first peak of
+    # each lead gets the mean of all periods of its lead.
+    period = np.zeros(len(x))
+    period[1:] = np.diff(peaks.values) / sampling_rate
+    period[starts] = _mean_of_rest(period, starts)
+
+    # segments between consecutive peaks of a lead
+    left = np.delete(np.arange(len(x)), ends)
+    hk = x[left + 1] - x[left]
+    mk = (period[left + 1] - period[left]) / hk
+
+    # derivatives at the peaks, weighted harmonic mean of the neighbouring slopes
+    # within a lead and one-sided three-point estimates at its first and last peak
+    dk = np.zeros(len(x))
+    inner = np.delete(np.arange(len(x)), np.r_[starts, ends])
+    before = inner - peak_leads[inner] - 1
+    after = before + 1
+    condition = (
+        (np.sign(mk[after]) != np.sign(mk[before]))
+        | (mk[after] == 0)
+        | (mk[before] == 0)
+    )
+    w1 = 2 * hk[after] + hk[before]
+    w2 = hk[after] + 2 * hk[before]
+    with np.errstate(divide="ignore"):
+        whmean = (w1 / mk[before] + w2 / mk[after]) / (w1 + w2)
+    dk[inner[~condition]] = 1.0 / whmean[~condition]
+
+    first = starts - np.arange(len(starts))
+    last = ends - np.arange(len(ends)) - 1
+    dk[starts] = _pchip_edge_case(hk[first], hk[first + 1], mk[first], mk[first + 1])
+    dk[ends] = _pchip_edge_case(hk[last], hk[last - 1], mk[last], mk[last - 1])
+
+    # cubic hermite coefficients of each segment
+    t = (dk[left] + dk[left + 1] - 2 * mk) / hk
+    c0 = t / hk
+    c1 = (mk - dk[left]) / hk - t
+    c2 = dk[left]
+    c3 = period[left]
+
+    # each sample falls in the segment of the last peak at or before it, samples
+    # outside of the peaks are clipped to the first or last peak of their lead
+    sample_leads = np.repeat(np.arange(len(starts)), desired_lengths)
+    samples = np.clip(
+        _group_ranks(desired_lengths),
+        peaks.values[starts][sample_leads],
+        peaks.values[ends][sample_leads],
+    )
+    stride = np.max(desired_lengths)
+    segment = (
+        np.searchsorted(
+            peak_leads * stride + peaks.values,
+            sample_leads * stride + samples,
+            side="right",
+        )
+        - 1
+    )
+    segment = np.minimum(segment, ends[sample_leads] - 1) - sample_leads
+
+    # evaluated term by term as scipy.interpolate.PPoly does
+    s = samples - x[left][segment]
+    period = c3[segment] + c2[segment] * s
+    period += c1[segment] * (s * s)
+    period += c0[segment] * (s * s * s)
+
+    return 60 / period
+
+
+def _pchip_edge_case(h0, h1, m0, m1):
+    """one-sided three-point estimate of the derivative at the end of a pchip"""
+    d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+
+    # try to preserve shape
+    mask = np.sign(d) != np.sign(m0)
+    mask2 = (np.sign(m0) != np.sign(m1)) & (np.abs(d) > 3.0 * np.abs(m0))
+    mmm = (~mask) & mask2
+
+    d[mask] = 0.0
+    d[mmm] = 3.0 * m0[mmm]
+
+    return d
+
+
+def _signal_rate_partial(peaks, sampling_rate=500, desired_length=None):
 
     # Sanity checks.
     if len(peaks) < 3:
         # needs at least 3 peaks to compute rate, otherwise NaN
-        return k, np.full(desired_length, np.nan)
+        return np.full(desired_length, np.nan)
 
     # edge case if peaks desired length request is larger than max peak index
     while desired_length <= peaks[-1]:
@@ -1388,7 +2502,7 @@ def _signal_rate_partial(kv, sampling_rate=500, desired_length=None):
 
     if len(peaks) < 3:
         # needs at least 3 peaks to compute rate, otherwise NaN
-        return k, np.full(desired_length, np.nan)
+        return np.full(desired_length, np.nan)
 
     peaks = np.sort(peaks)
 
@@ -1417,84 +2531,69 @@ def _signal_rate_partial(kv, sampling_rate=500, desired_length=None):
         period[: peaks[0]] = period[peaks[0]]
         period[peaks[-1] :] = period[peaks[-1]]  # noqa: E203
 
-    return k, 60 / period
+    return 60 / period
 
 
 def ecg_quality(ecg_signal, all_r_peaks, sampling_rate=500):
     """somewhat parallelized version of nk.ecg_quality
-    all_r_peaks: infos from ecg_peaks return
+    all_r_peaks: LeadArrays from ecg_peaks return
+    returns the quality of each lead as LeadArrays
     """
-    sig_len, num_leads = ecg_signal.shape
-    quality = dict(
-        map(
-            functools.partial(_ecg_quality_partial, sampling_rate=sampling_rate),
-            zip(ecg_signal.T, all_r_peaks, range(num_leads)),
-        )
+    quality = map(
+        functools.partial(_ecg_quality_partial, sampling_rate=sampling_rate),
+        zip(ecg_signal.T, all_r_peaks),
     )
 
-    return quality
+    return LeadArrays.from_leads(list(quality))
 
 
-def _ecg_quality_partial(sig_info_idx, sampling_rate=500):
-    signal, info, lead_idx = sig_info_idx
-    rpeaks = info["ECG_R_Peaks"]
+def _ecg_quality_partial(sig_rpeaks, sampling_rate=500):
+    signal, rpeaks = sig_rpeaks
     if len(rpeaks) == 0:
         quality = np.full(len(signal), np.nan)
     else:
         try:
-            quality = nk.ecg_quality(
-                signal, rpeaks=info["ECG_R_Peaks"], sampling_rate=sampling_rate
-            )
+            quality = nk.ecg_quality(signal, rpeaks=rpeaks, sampling_rate=sampling_rate)
         except Exception:
             quality = np.full(len(signal), np.nan)
-    return lead_idx, quality
+    return quality
 
 
-def ecg_delineate(
-    ecg_signal, all_r_peaks, sampling_rate=500, ecg_lead_names=ECG_LEAD_NAMES
-):
+def ecg_delineate(ecg_signal, all_r_peaks, sampling_rate=500):
     """somewhat parallelized version of nk.ecg_delinate,
     calculates P, Q, S, T peaks, P onsets, T offsets
+    all_r_peaks: LeadArrays from ecg_peaks return
+    returns a dict of the samples of each of KEYS_DELINEATE as LeadArrays,
+    NaN where nk found no wave for a heartbeat
     """
-    delineate_info = map(
-        functools.partial(_ecg_delineate_partial, sampling_rate=sampling_rate),
-        zip(ecg_signal.T, all_r_peaks, ecg_lead_names),
+    lead_infos = list(
+        map(
+            functools.partial(_ecg_delineate_partial, sampling_rate=sampling_rate),
+            zip(ecg_signal.T, all_r_peaks),
+        )
+    )
+    return dict(
+        (
+            k,
+            LeadArrays.from_leads(
+                [np.asarray(info[k], dtype=float) for info in lead_infos]
+            ),
+        )
+        for k in KEYS_DELINEATE
     )
-    delinate_dfs, delineate_infos = zip(*delineate_info)
-    delinate_dfs = pd.concat(delinate_dfs)
-    return delinate_dfs, delineate_infos
 
 
-def _ecg_delineate_partial(sig_info_idx_name, sampling_rate=500):
-    signal, info, lead_name = sig_info_idx_name
-    sig_len = len(signal)
+def _ecg_delineate_partial(sig_rpeaks, sampling_rate=500):
+    signal, rpeaks = sig_rpeaks
     try:
-        ref = nk.ecg_delineate(
-            ecg_cleaned=signal, rpeaks=info, sampling_rate=sampling_rate
+        _, info = nk.ecg_delineate(
+            ecg_cleaned=signal,
+            rpeaks={"ECG_R_Peaks": rpeaks},
+            sampling_rate=sampling_rate,
         )
     except Exception:
-        ref = (
-            pd.DataFrame(
-                {
-                    "ECG_P_Peaks": [0.0,] * sig_len,
-                    "ECG_Q_Peaks": [0.0,] * sig_len,
-                    "ECG_S_Peaks": [0.0,] * sig_len,
-                    "ECG_T_Peaks": [0.0,] * sig_len,
-                    "ECG_P_Onsets": [0.0,] * sig_len,
-                    "ECG_T_Offsets": [0.0,] * sig_len,
-                }
-            ),
-            {
-                "ECG_P_Peaks": [],
-                "ECG_Q_Peaks": [],
-                "ECG_S_Peaks": [],
-                "ECG_T_Peaks": [],
-                "ECG_P_Onsets": [],
-                "ECG_T_Offsets": [],
-            },
-        )
-    ref[0]["ECG_Sig_Name"] = lead_name
-    return ref
+        info = dict((k, []) for k in KEYS_DELINEATE)
+    return info
 
 
 def ecg_intervalrelated(proc_df, sampling_rate=500, ecg_lead_names=ECG_LEAD_NAMES):
@@ -1551,32 +2650,28 @@ def get_intervalrelated_features(
     # interval related features from parallel neurokit2
     sig_len, num_leads = cleaned_signals.shape
 
-    df_sig_names = []
-    for ln in ECG_LEAD_NAMES:
-        df_sig_names += [ln,] * sig_len
-
-    peaks_df, peaks_info = ecg_peaks(
-        cleaned_signals, sampling_rate=sampling_rate, ecg_lead_names=ecg_lead_names
-    )
+    rpeaks = ecg_peaks(cleaned_signals, sampling_rate=sampling_rate)
 
     # non-df outputs...
-    rate = signal_rate(peaks_info, sampling_rate=sampling_rate, desired_length=sig_len)
-    quality = ecg_quality(cleaned_signals, peaks_info, sampling_rate=sampling_rate)
-
-    rate_values = np.concatenate([rate[lead_idx] for lead_idx in range(num_leads)])
-    quality_values = np.concatenate(
-        [quality[lead_idx] for lead_idx in range(num_leads)]
-    )
+    rate = signal_rate(rpeaks, sampling_rate=sampling_rate, desired_length=sig_len)
+    quality = ecg_quality(cleaned_signals, rpeaks, sampling_rate=sampling_rate)
+    instant_peaks = np.zeros(sig_len * num_leads)
+    instant_peaks[rpeaks.leads * sig_len + rpeaks.values] = 1.0
 
     proc_df = pd.DataFrame(
         {
             "ECG_Raw": raw_signals.flatten(order="F"),
             "ECG_Clean": cleaned_signals.flatten(order="F"),
-            "ECG_Sig_Name": df_sig_names,
-            "ECG_R_Peaks": peaks_df["ECG_R_Peaks"],
-            "ECG_Rate": rate_values,
-            "ECG_Quality": quality_values,
-        }
+            # lead name codes, rather than a string per sample
+            "ECG_Sig_Name": pd.Categorical.from_codes(
+                np.repeat(np.arange(num_leads), sig_len), categories=ECG_LEAD_NAMES
+            ),
+            "ECG_R_Peaks": instant_peaks,
+            "ECG_Rate": rate.values,
+            "ECG_Quality": quality.values,
+        },
+        # each lead is indexed by sample
+        index=np.tile(np.arange(sig_len), num_leads),
     )
     ir_features = ecg_intervalrelated(proc_df, sampling_rate=sampling_rate)
     return ir_features, proc_df
@@ -1591,25 +2686,19 @@ def best_heartbeats_from_ecg_signal(
     for lead_name in ecg_lead_names:
         try:
             lead_df = proc_df[proc_df["ECG_Sig_Name"] == lead_name]
-            heartbeats = nk.ecg_segment(
-                lead_df.rename(columns={"ECG_Clean": "Signal"}).drop(
-                    columns=["ECG_Raw"]
-                ),
-                rpeaks=np.where(lead_df["ECG_R_Peaks"] > 0)[0],
-                show=False,
+            context = SignalContext(
+                lead_df[["ECG_Raw"]].to_numpy(),
+                sampling_rate,
+                cleaned_signals=lead_df[["ECG_Clean"]].to_numpy(),
             )
+            context.stages["rpeaks"] = LeadArrays.from_leads(
+                [np.where(lead_df["ECG_R_Peaks"] > 0)[0]]
+            )
+            context.stages["quality"] = [lead_df["ECG_Quality"].to_numpy()]
 
-            best_idx = None
-            best_quality = -1
-            for k, v in heartbeats.items():
-                if not all(np.isfinite(v["Signal"])):
-                    continue
-                hb_quality_stats = scipy.stats.describe(v["ECG_Quality"])
-                if hb_quality_stats.mean > best_quality:
-                    best_idx = k
-                    best_quality = hb_quality_stats.mean
-
-            best_heartbeat = heartbeats[best_idx]["Signal"]
+            best_heartbeat = context.best_heartbeats[0]
+            if best_heartbeat is None:
+                raise ValueError(f"no complete heartbeat in lead {lead_name}")
             hb_num_samples = len(best_heartbeat)
             hb_duration = hb_num_samples / sampling_rate
             hb_times = np.linspace(0, hb_duration, hb_num_samples).tolist()
@@ -1644,25 +2733,15 @@ def signal_to_tsfresh_df(
     get_num_samples=2000,
     mod_fs=500,
 ):
-    # convert sampling rate to mod_fs
-    if sampling_rate != mod_fs:
-        len_mod_fs = int(len(cleaned_signals) / sampling_rate * mod_fs)
-        cleaned_signals = scipy.signal.resample(cleaned_signals, len_mod_fs)
-
-    # drop 1 second from the start and ends of the cleaned signals
-    cleaned_signals = cleaned_signals[mod_fs:-mod_fs]
+    # middle get_num_samples, resampled to mod_fs
+    cleaned_signals = _signal_window(
+        cleaned_signals,
+        sampling_rate=sampling_rate,
+        mod_fs=mod_fs,
+        get_num_samples=get_num_samples,
+    )
     num_samples, num_leads = cleaned_signals.shape
 
-    # if over get_num_samples, take middle
-    if num_samples > get_num_samples:
-        mid_point = int(num_samples / 2)
-        cleaned_signals = cleaned_signals[
-            mid_point
-            - get_num_samples // 2 : mid_point  # noqa: E203
-            + get_num_samples // 2
-        ]
-        num_samples, num_leads = cleaned_signals.shape
-
     duration = num_samples / mod_fs
     # convert to tsfresh compatible dataframe
     df_sig_names = []
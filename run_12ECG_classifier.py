@@ -1,61 +1,176 @@
 #!/usr/bin/env python
-import functools
 import json
 import os
 
 import joblib
+import pandas as pd
 
 from util import parse_fc_parameters
-from util.evaluate_12ECG_score import is_number
+from util.classifier import MultiClassPredictor
+from util.model_bundle import is_model_bundle, load_model_bundle
 from util.raw_to_wfdb import convert_to_wfdb_record
-from neurokit2_parallel import wfdb_record_to_feature_dataframe
+from neurokit2_parallel import records_to_feature_matrix, wfdb_record_to_feature_dataframe
 
 
-def run_12ECG_classifier(data, header_data, loaded_model):
+def run_12ECG_classifier(data, header_data, loaded_model, feature_cache=None):
     # Use your classifier here to obtain a label and score for each class.
-    r = convert_to_wfdb_record(data, header_data)
-    models, fc_parameters = loaded_model
-    record_features, _ = wfdb_record_to_feature_dataframe(r, fc_parameters=fc_parameters)
-
-    field_names = models["field_names"]
-    # xgboost does not like out of order dataframes....
-    record_features = record_features.reindex(field_names, axis=1)
-
-    featured_classifier_run = functools.partial(
-        _partial_run_classifier, record_features=record_features
-    )
-
-    # parallel
-    # output = joblib.Parallel(n_jobs=-1, verbose=0)(
-    #     joblib.delayed(featured_classifier_run)(kv)
-    #     for kv in loaded_model.items()
-    #     if is_number(kv[0])
-    # )
-
-    # map
-    output = map(
-        featured_classifier_run, [kv for kv in models.items() if is_number(kv[0])]
+    predictor, fc_parameters = loaded_model
+    record_features = _record_features(
+        data,
+        header_data,
+        predictor.field_names,
+        fc_parameters,
+        feature_cache=feature_cache,
+        feature_options=predictor.feature_options,
     )
 
-    labels, scores, classes = zip(*output)
+    labels, scores = predictor.predict(record_features)
 
     # force labels to be integers
-    labels = list(map(int, labels))
+    labels = list(map(int, labels[0]))
 
     # return current_label, current_score, classes
-    return labels, scores, classes
+    return labels, tuple(scores[0]), predictor.classes
+
+
+def run_12ECG_classifier_batch(
+    records, loaded_model, n_jobs=None, feature_cache=None, backend=None
+):
+    """Batched version of run_12ECG_classifier.
+    records: iterable of (data, header_data) tuples
+    n_jobs: workers the leads of the batch are split over (default one per lead)
+    backend: how the lead workers run, see neurokit2_parallel.LEAD_BACKENDS
+    feature_cache: optional util.feature_cache.FeatureCache
+    Features of all records are stacked into one matrix, so the predictor
+    runs once per batch rather than once per record. Without a feature_cache
+    the whole batch is extracted together by records_to_feature_matrix.
+    Returns a list of (labels, scores, classes), one per record.
+    """
+    predictor, fc_parameters = loaded_model
+
+    if feature_cache is None:
+        features, _ = records_to_feature_matrix(
+            [convert_to_wfdb_record(data, header_data) for data, header_data in records],
+            predictor.field_names,
+            fc_parameters=fc_parameters,
+            n_jobs=n_jobs,
+            backend=backend,
+            **predictor.feature_options
+        )
+        batch_features = pd.DataFrame(features, columns=predictor.field_names)
+    else:
+        batch_features = pd.concat(
+            [
+                _record_features(
+                    data,
+                    header_data,
+                    predictor.field_names,
+                    fc_parameters,
+                    n_jobs=n_jobs,
+                    feature_cache=feature_cache,
+                    backend=backend,
+                    feature_options=predictor.feature_options,
+                )
+                for data, header_data in records
+            ],
+            ignore_index=True,
+        )
+
+    return classify_features(batch_features, predictor)
+
+
+def classify_features(batch_features, predictor):
+    """Features of a batch of records, aligned to predictor.field_names,
+    to a list of (labels, scores, classes), one per record.
+    """
+    # shape (num_records, num_classes)
+    labels, scores = predictor.predict(batch_features)
+
+    return [
+        (list(map(int, record_labels)), tuple(record_scores), predictor.classes)
+        for record_labels, record_scores in zip(labels, scores)
+    ]
+
+
+def extract_record_features(
+    data,
+    header_data,
+    fc_parameters=None,
+    n_jobs=None,
+    feature_cache=None,
+    backend=None,
+    feature_options=None,
+):
+    """Raw challenge data to (single row features dataframe, dx).
+    Consults the feature_cache first when one is given, hits skip extraction.
+    feature_options: extraction options, see neurokit2_parallel.FEATURE_OPTIONS
+    """
+    feature_options = feature_options or {}
+    if feature_cache is not None:
+        cache_key = feature_cache.record_key(
+            data, header_data, fc_parameters, feature_options
+        )
+        cached = feature_cache.get(cache_key)
+        if cached is not None:
+            features, dx = cached
+            return pd.DataFrame(dict((k, (v,)) for k, v in features.items())), dx
 
+    r = convert_to_wfdb_record(data, header_data)
+    record_features, dx = wfdb_record_to_feature_dataframe(
+        r,
+        fc_parameters=fc_parameters,
+        n_jobs=n_jobs,
+        backend=backend,
+        **feature_options
+    )
+
+    if feature_cache is not None:
+        features = dict((k, v[0]) for (k, v) in record_features.to_dict().items())
+        feature_cache.put(cache_key, (features, dx))
+
+    return record_features, dx
+
+
+def _record_features(
+    data,
+    header_data,
+    field_names,
+    fc_parameters,
+    n_jobs=None,
+    feature_cache=None,
+    backend=None,
+    feature_options=None,
+):
+    record_features, _ = extract_record_features(
+        data,
+        header_data,
+        fc_parameters=fc_parameters,
+        n_jobs=n_jobs,
+        feature_cache=feature_cache,
+        backend=backend,
+        feature_options=feature_options,
+    )
 
-def _partial_run_classifier(kv, record_features=None):
-    class_val, model = kv
-    label = model.predict(record_features)[0]
-    score = model.predict_proba(record_features)[0][1]
-    return label, score, str(class_val)
+    # xgboost does not like out of order dataframes....
+    return record_features.reindex(field_names, axis=1)
 
 
 def load_12ECG_model(input_directory, limit_features_to=1000):
-    # load the most recent model from disk
-    model_fps = tuple(sorted(os.listdir(input_directory)))
+    # load the most recent model from disk, the output directory of training also
+    # holds the extracted features, prefer the bundle when a .sav was converted
+    model_fps = tuple(
+        sorted(
+            (
+                fp
+                for fp in os.listdir(input_directory)
+                if fp.startswith("finalized_model_") and not fp.endswith(".tmp")
+            ),
+            key=lambda fp: (
+                os.path.splitext(fp)[0],
+                os.path.isdir(os.path.join(input_directory, fp)),
+            ),
+        )
+    )
 
     print(f"Loading {model_fps[-1]} from {input_directory}...")
 
@@ -68,6 +183,12 @@ def load_12ECG_model(input_directory, limit_features_to=1000):
     important_fields = importance_data["sorted_keys"][:limit_features_to]
     fc_parameters = parse_fc_parameters(important_fields)
 
-    loaded_model = (joblib.load(filename), fc_parameters)
+    # all class models behind one predictor, see util.classifier.MultiClassPredictor
+    if is_model_bundle(filename):
+        predictor = load_model_bundle(filename)
+    else:
+        # joblib .sav files of earlier versions, see convert_model.py
+        predictor = MultiClassPredictor.from_models(joblib.load(filename))
+    loaded_model = (predictor, fc_parameters)
 
     return loaded_model
@@ -0,0 +1,504 @@
+#!/usr/bin/env python
+"""Long lived 12ECG classifier service over HTTP on localhost.
+
+The model is loaded once and feature extraction runs in a pool of warm worker
+processes, so requests skip the model load and library import startup cost.
+Each request is extracted as it arrives, and the extracted requests are grouped
+into batches scored with a single predictor call.
+
+    python serve_12ECG_classifier.py model --port 8012
+
+Endpoints:
+    POST /predict   JSON {"header": <.hea file text>, "mat": <base64 .mat file bytes>}
+                    responds {"labels": [...], "scores": [...], "classes": [...]}
+    GET  /metrics   queue depth and throughput counters, Prometheus text format
+    GET  /health    responds "ok" once the model is loaded
+"""
+import argparse
+import base64
+import collections
+import functools
+import io
+import json
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer
+
+import numpy as np
+import pandas as pd
+from scipy.io import loadmat
+
+from run_12ECG_classifier import (
+    classify_features,
+    extract_record_features,
+    load_12ECG_model,
+)
+from util.cpus import available_cpus
+from util.feature_cache import FeatureCache
+from util.log import configure_logging
+from util.worker_pool import WorkerPool
+
+# Feature extraction settings, set once per pool worker by _init_worker.
+_worker_fc_parameters = None
+_worker_field_names = None
+_worker_feature_cache = None
+_worker_feature_options = None
+
+
+def _init_worker(fc_parameters, field_names, feature_cache=None, feature_options=None):
+    global _worker_fc_parameters, _worker_field_names, _worker_feature_cache
+    global _worker_feature_options
+    _worker_fc_parameters = fc_parameters
+    _worker_field_names = field_names
+    _worker_feature_cache = feature_cache
+    _worker_feature_options = feature_options
+
+
+def _extract_features(data, header_data):
+    # Exceptions are returned rather than raised so one bad record cannot fail its batch.
+    try:
+        # the pool already provides the parallelism, extract the leads serially
+        record_features, _ = extract_record_features(
+            data,
+            header_data,
+            fc_parameters=_worker_fc_parameters,
+            n_jobs=1,
+            feature_cache=_worker_feature_cache,
+            feature_options=_worker_feature_options,
+        )
+        # xgboost does not like out of order dataframes....
+        return record_features.reindex(_worker_field_names, axis=1), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def parse_challenge_data(header_text, mat_bytes):
+    """Raw .hea text and .mat bytes to (data, header_data), as driver.load_challenge_data"""
+    data = np.asarray(loadmat(io.BytesIO(mat_bytes))["val"], dtype=np.float64)
+    # universal newlines, like reading the header file in text mode
+    header_data = io.StringIO(header_text, newline=None).readlines()
+    return data, header_data
+
+
+class _Request:
+    """A submitted record on its way through the service"""
+
+    def __init__(self, data, header_data, deadline):
+        self.data = data
+        self.header_data = header_data
+        self.deadline = deadline
+        self.future = Future()
+        # the WorkerPool executor and future of the feature extraction, while running
+        self.executor = None
+        self.extraction = None
+        # extracted on the retry pool, alone
+        self.alone = False
+
+
+class InferenceService:
+    """Extracts the features of each submitted record in a warm process pool as
+    soon as it arrives, and scores the extracted records in batches with one
+    predictor call each.
+
+    Extracted records wait for a batch until batch_size of them are pending or the
+    first of them has waited batch_wait seconds, so a slow record only delays its
+    own response. A record fails once record_timeout seconds have passed since it
+    was submitted. A hung worker is replaced; so is a worker that died, after which
+    the records it may have died on are extracted again one at a time.
+    """
+
+    def __init__(
+        self,
+        model_input,
+        num_workers=None,
+        batch_size=8,
+        batch_wait=0.05,
+        record_timeout=None,
+        feature_cache=None,
+    ):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.record_timeout = record_timeout
+
+        self.predictor, fc_parameters = load_12ECG_model(model_input)
+
+        if num_workers is None:
+            num_workers = available_cpus()
+        initargs = (
+            fc_parameters,
+            self.predictor.field_names,
+            feature_cache,
+            self.predictor.feature_options,
+        )
+        self._pool = WorkerPool(num_workers, _init_worker, initargs)
+        # the records that were running when a worker died are retried on their own,
+        # its worker starts on the first retry
+        self._retry_pool = WorkerPool(1, _init_worker, initargs)
+        # fork the workers before any threads are started
+        self._pool.submit(int)[1].result()
+
+        # dispatcher state, only touched by the dispatcher thread
+        self._running = set()
+        self._suspects = collections.deque()
+        self._retrying = None
+
+        self._events = queue.Queue()
+        self._extracted = queue.Queue()
+        self._metrics_lock = threading.Lock()
+        self._in_flight = 0
+        self.counters = {
+            "records_total": 0,
+            "failures_total": 0,
+            "batches_total": 0,
+            "batch_seconds_total": 0.0,
+            "worker_restarts_total": 0,
+        }
+
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        self._batcher = threading.Thread(target=self._run, daemon=True)
+        self._batcher.start()
+
+    def submit(self, data, header_data):
+        """Returns a Future of the (labels, scores, classes) of the record"""
+        deadline = None
+        if self.record_timeout is not None:
+            deadline = default_timer() + self.record_timeout
+        request = _Request(data, header_data, deadline)
+        with self._metrics_lock:
+            self._in_flight += 1
+        self._events.put(("submit", request, None))
+        return request.future
+
+    def queue_depth(self):
+        """Extracted records waiting for a batch"""
+        return self._extracted.qsize()
+
+    def metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self.counters)
+            metrics["in_flight"] = self._in_flight
+        metrics["queue_depth"] = self.queue_depth()
+        return metrics
+
+    def close(self):
+        self._events.put(None)
+        self._dispatcher.join()
+        self._extracted.put(None)
+        self._batcher.join()
+        self._pool.close(terminate=True)
+        self._retry_pool.close(terminate=True)
+
+    def _dispatch(self):
+        # Submits the extraction of each record, routes the extracted records to the
+        # batcher and fails the records that time out or kill their worker.
+        while True:
+            try:
+                event = self._events.get(timeout=self._until_next_deadline())
+            except queue.Empty:
+                event = ()
+            if event is None:
+                break
+            if event:
+                kind, request, extraction = event
+                if kind == "submit":
+                    self._extract(request, self._pool)
+                else:
+                    self._extraction_done(request, extraction)
+            self._expire()
+            if self._retrying is None and self._suspects:
+                self._extract(self._suspects.popleft(), self._retry_pool, alone=True)
+
+        closed = list(self._running) + list(self._suspects)
+        if self._retrying is not None:
+            closed.append(self._retrying)
+        for request in closed:
+            self._fail(request, "the service was closed")
+
+    def _extract(self, request, pool, alone=False):
+        request.executor, request.extraction = pool.submit(
+            _extract_features, request.data, request.header_data
+        )
+        request.alone = alone
+        if alone:
+            self._retrying = request
+        else:
+            self._running.add(request)
+        # called from the executor's thread, the dispatcher handles it
+        request.extraction.add_done_callback(
+            functools.partial(self._on_extraction_done, request)
+        )
+
+    def _on_extraction_done(self, request, extraction):
+        self._events.put(("done", request, extraction))
+
+    def _extraction_done(self, request, extraction):
+        if extraction is not request.extraction or request.future.done():
+            # resubmitted or failed since
+            return
+        self._forget(request)
+
+        try:
+            record_features, error = extraction.result()
+        except BrokenProcessPool:
+            if request.alone:
+                self._restart(self._retry_pool, request.executor)
+                self._fail(request, "worker process died, e.g. out of memory")
+            else:
+                # the worker may have died on any of the records running alongside,
+                # whatever they extract on the broken executor is dropped
+                suspects = [request] + list(self._running)
+                self._running.clear()
+                for suspect in suspects:
+                    suspect.extraction = None
+                self._suspects.extend(suspects)
+                self._restart(self._pool, request.executor)
+            return
+        except Exception:
+            record_features, error = None, traceback.format_exc()
+
+        if error is not None:
+            self._fail(request, error)
+        else:
+            self._extracted.put((record_features, request.future))
+
+    def _expire(self):
+        now = default_timer()
+        expired = [
+            request
+            for request in list(self._running) + list(self._suspects) + [self._retrying]
+            if request is not None
+            and request.deadline is not None
+            and request.deadline <= now
+        ]
+        for request in expired:
+            if request in self._suspects:
+                self._suspects.remove(request)
+            else:
+                self._forget(request)
+            self._fail(request, f"timed out after {self.record_timeout} seconds")
+
+            extraction = request.extraction
+            if extraction is None or extraction.done() or extraction.cancel():
+                # it was not running
+                continue
+            # a worker hangs on the record, the records running alongside start over
+            if request.alone:
+                self._restart(self._retry_pool, request.executor)
+            elif request.executor is self._pool.executor:
+                self._restart(self._pool, request.executor)
+                running = list(self._running)
+                self._running.clear()
+                for other in running:
+                    self._extract(other, self._pool)
+
+    def _until_next_deadline(self):
+        deadlines = [
+            request.deadline
+            for request in list(self._running) + list(self._suspects) + [self._retrying]
+            if request is not None and request.deadline is not None
+        ]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - default_timer(), 0)
+
+    def _forget(self, request):
+        if request is self._retrying:
+            self._retrying = None
+        else:
+            self._running.discard(request)
+
+    def _restart(self, pool, executor):
+        pool.restart(executor)
+        with self._metrics_lock:
+            self.counters["worker_restarts_total"] += 1
+
+    def _fail(self, request, error):
+        request.future.set_exception(RuntimeError(error))
+        with self._metrics_lock:
+            self._in_flight -= 1
+            self.counters["records_total"] += 1
+            self.counters["failures_total"] += 1
+
+    def _run(self):
+        while True:
+            extracted = self._extracted.get()
+            if extracted is None:
+                return
+
+            batch = [extracted]
+            deadline = default_timer() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    extracted = self._extracted.get(
+                        timeout=max(deadline - default_timer(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if extracted is None:
+                    # score what was collected, then stop
+                    self._extracted.put(None)
+                    break
+                batch.append(extracted)
+
+            self._score_batch(batch)
+
+    def _score_batch(self, batch):
+        start = default_timer()
+        num_failures = 0
+        try:
+            outputs = classify_features(
+                pd.concat([features for features, _ in batch], ignore_index=True),
+                self.predictor,
+            )
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            num_failures = len(batch)
+
+        with self._metrics_lock:
+            self._in_flight -= len(batch)
+            self.counters["records_total"] += len(batch)
+            self.counters["failures_total"] += num_failures
+            self.counters["batches_total"] += 1
+            self.counters["batch_seconds_total"] += default_timer() - start
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, "text/plain", b"ok\n")
+        elif self.path == "/metrics":
+            lines = [
+                f"ecg_classifier_{k} {v}"
+                for k, v in sorted(self.server.service.metrics().items())
+            ]
+            self._respond(200, "text/plain", ("\n".join(lines) + "\n").encode())
+        else:
+            self._respond_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._respond_json(404, {"error": f"unknown path {self.path}"})
+            return
+
+        try:
+            content_length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(content_length))
+            data, header_data = parse_challenge_data(
+                payload["header"], base64.b64decode(payload["mat"])
+            )
+        except Exception as e:
+            self._respond_json(400, {"error": f"invalid payload: {e!r}"})
+            return
+
+        future = self.server.service.submit(data, header_data)
+        try:
+            labels, scores, classes = future.result()
+        except Exception as e:
+            self._respond_json(500, {"error": str(e)})
+            return
+
+        self._respond_json(
+            200,
+            {
+                "labels": labels,
+                "scores": [float(s) for s in scores],
+                "classes": list(classes),
+            },
+        )
+
+    def _respond_json(self, status, body):
+        self._respond(status, "application/json", json.dumps(body).encode())
+
+    def _respond(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(service, host="127.0.0.1", port=8012):
+    server = ThreadingHTTPServer((host, port), _RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve the 12ECG classifier over HTTP, e.g., python serve_12ECG_classifier.py model"
+    )
+    parser.add_argument("model_input")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8012)
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=None,
+        help="feature extraction worker processes (default: one per available CPU)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=8,
+        help="maximum number of extracted recordings scored together per model call (default: 8)",
+    )
+    parser.add_argument(
+        "--batch-wait",
+        type=float,
+        default=0.05,
+        help="seconds an extracted recording waits for others to fill its batch (default: 0.05)",
+    )
+    parser.add_argument(
+        "--record-timeout",
+        type=float,
+        default=None,
+        help="seconds from a recording's submission before it fails and its worker is replaced (default: no limit)",
+    )
+    parser.add_argument(
+        "--feature-cache",
+        default=None,
+        help="SQLite file caching extracted features across runs (default: disabled)",
+    )
+    parser.add_argument(
+        "--feature-cache-gib",
+        type=float,
+        default=1.0,
+        help="feature cache size cap in GiB, least recently used entries are evicted (default: 1)",
+    )
+    args = parser.parse_args()
+
+    logger = configure_logging()
+
+    feature_cache = None
+    if args.feature_cache:
+        feature_cache = FeatureCache(
+            args.feature_cache, max_bytes=int(args.feature_cache_gib * 1024 ** 3)
+        )
+
+    logger.info("Loading 12ECG model...")
+    service = InferenceService(
+        args.model_input,
+        num_workers=args.num_workers,
+        batch_size=args.batch_size,
+        batch_wait=args.batch_wait,
+        record_timeout=args.record_timeout,
+        feature_cache=feature_cache,
+    )
+    server = serve(service, args.host, args.port)
+    logger.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,106 @@
+import pickle
+import unittest
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from xgboost import XGBClassifier
+
+from util.classifier import (
+    LEGACY_FEATURE_OPTIONS,
+    BoosterClassifier,
+    MultiClassPredictor,
+)
+
+
+class TestBoosterClassifier(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.features = pd.DataFrame(
+            rng.normal(size=(200, 4)), columns=["age", "sex", "I_HRV_RMSSD", "II_HRV_RMSSD"]
+        )
+        self.features.iloc[::7, 2] = np.nan
+        self.labels = (self.features["age"] + rng.normal(size=200) * 0.5) > 0
+        self.weights = np.where(self.labels, 2.0, 1.0)
+
+    def test_matches_xgbclassifier(self):
+        sklearn_model = XGBClassifier(booster="dart", verbosity=0, random_state=0)
+        sklearn_model.fit(
+            self.features,
+            self.labels,
+            sample_weight=self.weights,
+            eval_set=[(self.features, self.labels)],
+            sample_weight_eval_set=[self.weights],
+            early_stopping_rounds=5,
+            verbose=False,
+        )
+
+        classes = np.unique(self.labels)
+        dmatrix = xgb.DMatrix(self.features, missing=np.nan)
+        dmatrix.set_label(np.searchsorted(classes, self.labels))
+        dmatrix.set_weight(self.weights)
+        booster = xgb.train(
+            {
+                "objective": "binary:logistic",
+                "booster": "dart",
+                "verbosity": 0,
+                "random_state": 0,
+            },
+            dmatrix,
+            num_boost_round=100,
+            evals=[(dmatrix, "validation_0")],
+            early_stopping_rounds=5,
+            verbose_eval=False,
+        )
+        model = BoosterClassifier(booster, classes)
+
+        self.assertEqual(model.best_ntree_limit, sklearn_model.best_ntree_limit)
+        np.testing.assert_array_equal(
+            model.predict_proba(self.features), sklearn_model.predict_proba(self.features)
+        )
+        np.testing.assert_array_equal(
+            model.predict(self.features), sklearn_model.predict(self.features)
+        )
+
+        # models are saved with joblib, must survive pickling
+        restored = pickle.loads(pickle.dumps(model, protocol=0))
+        np.testing.assert_array_equal(
+            restored.predict_proba(self.features), model.predict_proba(self.features)
+        )
+
+
+class TestMultiClassPredictor(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.features = pd.DataFrame(
+            rng.normal(size=(100, 3)), columns=["age", "sex", "I_HRV_RMSSD"]
+        )
+
+        self.models = {"field_names": self.features.columns.to_list()}
+        for idx, sc in enumerate(["164889003", "164890007"]):
+            labels = (self.features.iloc[:, idx] + rng.normal(size=100) * 0.5) > 0
+            self.models[sc] = XGBClassifier(verbosity=0, n_estimators=10).fit(
+                self.features, labels
+            )
+        # no positive examples
+        self.models["713422000"] = XGBClassifier(verbosity=0, n_estimators=10).fit(
+            self.features, np.zeros(100, dtype=bool)
+        )
+
+    def test_matches_class_models(self):
+        predictor = MultiClassPredictor.from_models(self.models)
+        self.assertEqual(predictor.classes, ("164889003", "164890007", "713422000"))
+        self.assertEqual(predictor.field_names, ["age", "sex", "I_HRV_RMSSD"])
+        # models saved without their feature options
+        self.assertEqual(predictor.feature_options, LEGACY_FEATURE_OPTIONS)
+
+        labels, scores = predictor.predict(self.features)
+        self.assertEqual(labels.shape, (100, 3))
+        for idx, sc in enumerate(predictor.classes):
+            np.testing.assert_array_equal(
+                scores[:, idx], self.models[sc].predict_proba(self.features)[:, 1]
+            )
+            np.testing.assert_array_equal(
+                labels[:, idx], self.models[sc].predict(self.features).astype(bool)
+            )
+        self.assertFalse(labels[:, 2].any())
@@ -0,0 +1,20 @@
+import os
+import unittest
+from unittest import mock
+
+from util.cpus import available_cpus
+
+
+class TestAvailableCpus(unittest.TestCase):
+    def test_available_cpus(self):
+        self.assertGreaterEqual(available_cpus(), 1)
+        self.assertLessEqual(available_cpus(), os.cpu_count())
+
+    def test_no_sched_getaffinity(self):
+        # macOS and Windows
+        with mock.patch("util.cpus.os") as mock_os:
+            del mock_os.sched_getaffinity
+            mock_os.cpu_count.return_value = 3
+            self.assertEqual(available_cpus(), 3)
+            mock_os.cpu_count.return_value = None
+            self.assertEqual(available_cpus(), 1)
@@ -0,0 +1,134 @@
+import itertools
+import os
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from driver import load_challenge_data
+from util.feature_cache import FeatureCache, extraction_version
+
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_fp = os.path.join(self.tmp_dir.name, "features.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_record_key(self):
+        data, header_data = load_challenge_data("tests/data/Q0001.mat")
+        fc_parameters = {"I_sig": {"abs_energy": None}}
+
+        key = FeatureCache.record_key(data, header_data, fc_parameters)
+        self.assertEqual(
+            key,
+            FeatureCache.record_key(
+                data.copy(), list(header_data), {"I_sig": {"abs_energy": None}}
+            ),
+        )
+
+        # signal, header and feature selection changes all change the key
+        altered_data = data.copy()
+        altered_data[0, 0] += 1
+        self.assertNotEqual(
+            key, FeatureCache.record_key(altered_data, header_data, fc_parameters)
+        )
+        self.assertNotEqual(
+            key, FeatureCache.record_key(data, header_data[:-1], fc_parameters)
+        )
+        self.assertNotEqual(key, FeatureCache.record_key(data, header_data, None))
+        self.assertNotEqual(
+            key,
+            FeatureCache.record_key(
+                data, header_data, fc_parameters, {"heartbeat_template": "mean"}
+            ),
+        )
+
+        # so do changes to the feature extraction code
+        with mock.patch(
+            "util.feature_cache.extraction_version", return_value="changed"
+        ):
+            self.assertNotEqual(
+                key, FeatureCache.record_key(data, header_data, fc_parameters)
+            )
+
+    def test_extraction_version(self):
+        version = extraction_version()
+        self.assertEqual(len(version), 64)
+
+        extraction_version.cache_clear()
+        with mock.patch(
+            "util.feature_cache.EXTRACTION_MODULES", ("neurokit2_parallel",)
+        ):
+            self.assertNotEqual(extraction_version(), version)
+        extraction_version.cache_clear()
+        self.assertEqual(extraction_version(), version)
+
+    def test_get_put(self):
+        cache = FeatureCache(self.cache_fp)
+        self.assertIsNone(cache.get("missing"))
+
+        features = {"age": 53.0, "sex": 0.0, "I_HRV_RMSSD": np.nan}
+        cache.put("record", (features, [164867002, 427084000]))
+        self.assertIn("record", cache)
+        self.assertEqual(len(cache), 1)
+
+        cached_features, cached_dx = cache.get("record")
+        self.assertEqual(cached_dx, [164867002, 427084000])
+        self.assertEqual(list(cached_features.keys()), list(features.keys()))
+        self.assertTrue(np.isnan(cached_features["I_HRV_RMSSD"]))
+        cache.close()
+
+        # cache persists between instances
+        self.assertIn("record", FeatureCache(self.cache_fp))
+
+    def test_lru_eviction(self):
+        value = np.zeros(1000)
+        entry_bytes = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        # every access one tick later
+        cache = FeatureCache(
+            self.cache_fp,
+            max_bytes=entry_bytes * 3,
+            clock=itertools.count().__next__,
+        )
+
+        cache.put("a", value)
+        cache.put("b", value)
+        cache.put("c", value)
+        # touch "a", so "b" becomes the least recently used entry
+        cache.get("a")
+        cache.put("d", value)
+
+        self.assertEqual(len(cache), 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertIn("d", cache)
+
+    def test_total_bytes(self):
+        cache = FeatureCache(self.cache_fp, max_bytes=10 ** 6)
+        sizes = dict(
+            (key, len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+            for key, value in (("a", np.zeros(10)), ("b", np.zeros(100)))
+        )
+        cache.put("a", np.zeros(10))
+        cache.put("b", np.zeros(100))
+        self.assertEqual(cache.total_bytes(), sizes["a"] + sizes["b"])
+        # replacing an entry counts its new size only
+        cache.put("a", np.zeros(100))
+        self.assertEqual(cache.total_bytes(), 2 * sizes["b"])
+
+        # caches written before the running total was kept sum it once
+        cache.conn.execute("DROP TABLE meta")
+        cache.conn.commit()
+        cache.close()
+        cache = FeatureCache(self.cache_fp, max_bytes=sizes["b"])
+        self.assertEqual(cache.total_bytes(), 2 * sizes["b"])
+        cache.put("c", np.zeros(10))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes(), sizes["a"])
+        cache.close()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from util.feature_store import FeatureStore
+
+
+class TestFeatureStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store_fp = os.path.join(self.tmp_dir.name, "features.h5")
+        self.fieldnames = ["I_HRV_RMSSD", "age", "sex"]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_append_and_load(self):
+        with FeatureStore(self.store_fp, fieldnames=self.fieldnames, chunk_rows=2) as store:
+            store.append("tests/data/Q0001.hea", {"age": 53.0, "sex": 0.0, "I_HRV_RMSSD": 12.5})
+            store.append("tests/data/Q0010.hea", {"age": 40.0, "sex": 1.0})
+            store.append("tests/data/Q0012.hea", {"age": 61.0, "sex": 1.0, "I_HRV_RMSSD": 3.0})
+            self.assertEqual(len(store), 3)
+
+        # resume with a new instance
+        with FeatureStore(self.store_fp) as store:
+            self.assertEqual(store.fieldnames, self.fieldnames)
+            self.assertEqual(
+                store.header_files(),
+                ["tests/data/Q0001.hea", "tests/data/Q0010.hea", "tests/data/Q0012.hea"],
+            )
+
+            features_df = store.to_dataframe()
+
+        self.assertEqual(features_df.shape, (3, 3))
+        self.assertEqual(features_df.index.name, "header_file")
+        self.assertEqual(features_df.columns.to_list(), self.fieldnames)
+        self.assertEqual(features_df.loc["tests/data/Q0001.hea", "I_HRV_RMSSD"], 12.5)
+        # missing features are stored as NaN
+        self.assertTrue(np.isnan(features_df.loc["tests/data/Q0010.hea", "I_HRV_RMSSD"]))
+        self.assertEqual(features_df["age"].to_list(), [53.0, 40.0, 61.0])
+
+    def test_buffered_rows_visible(self):
+        with FeatureStore(self.store_fp, fieldnames=self.fieldnames, buffer_rows=10) as store:
+            store.append("tests/data/Q0001.hea", {"age": 53.0})
+            self.assertEqual(store._h5["header_file"].shape, (0,))
+            self.assertEqual(store.header_files(), ["tests/data/Q0001.hea"])
+            self.assertEqual(store.to_dataframe().shape, (1, 3))
+
+    def test_append_written_to_disk(self):
+        store = FeatureStore(self.store_fp, fieldnames=self.fieldnames)
+        store.append("tests/data/Q0001.hea", {"age": 53.0})
+        store.append("tests/data/Q0010.hea", {"age": 40.0})
+
+        # each append is on disk before the store is flushed or closed
+        self.assertEqual(store._h5["header_file"].shape, (2,))
+        self.assertEqual(store._h5["features"][1, 1], 40.0)
+        store.close()
+
+    def test_invalid_fieldnames(self):
+        with self.assertRaises(ValueError):
+            FeatureStore(self.store_fp)
+
+        with FeatureStore(self.store_fp, fieldnames=self.fieldnames) as store:
+            with self.assertRaises(ValueError):
+                store.append("tests/data/Q0001.hea", {"weight": 80.0})
+
+        with self.assertRaises(ValueError):
+            FeatureStore(self.store_fp, fieldnames=["age"])
@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from xgboost import XGBClassifier
+
+from util.classifier import LEGACY_FEATURE_OPTIONS, MultiClassPredictor
+from util.model_bundle import (
+    MANIFEST_FILENAME,
+    is_model_bundle,
+    load_model_bundle,
+    save_model_bundle,
+)
+
+
+class TestModelBundle(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bundle_dir = os.path.join(self.tmp_dir.name, "finalized_model_1")
+
+        rng = np.random.RandomState(0)
+        self.features = pd.DataFrame(
+            rng.normal(size=(100, 3)), columns=["age", "sex", "I_HRV_RMSSD"]
+        )
+        self.features.iloc[::5, 2] = np.nan
+
+        self.models = {
+            "train_records": [f"tests/data/A{i:04d}.hea" for i in range(100)],
+            "eval_records": [],
+            "field_names": self.features.columns.to_list(),
+            "feature_options": {"heartbeat_template": "median"},
+        }
+        labels = (self.features["age"] + rng.normal(size=100) * 0.5) > 0
+        model = XGBClassifier(booster="dart", verbosity=0, n_estimators=20)
+        self.models["164889003"] = model.fit(
+            self.features,
+            labels,
+            eval_set=[(self.features, labels)],
+            early_stopping_rounds=3,
+            verbose=False,
+        )
+        self.models["713422000"] = XGBClassifier(verbosity=0, n_estimators=5).fit(
+            self.features, np.zeros(100, dtype=bool)
+        )
+        self.models["auroc"] = 0.5
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_save_and_load(self):
+        save_model_bundle(self.bundle_dir, self.models)
+        self.assertTrue(is_model_bundle(self.bundle_dir))
+        self.assertFalse(os.path.exists(self.bundle_dir + ".tmp"))
+
+        with open(os.path.join(self.bundle_dir, MANIFEST_FILENAME)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["metrics"], {"auroc": 0.5})
+        self.assertEqual(
+            [c["code"] for c in manifest["classes"]], ["164889003", "713422000"]
+        )
+
+        predictor = load_model_bundle(self.bundle_dir)
+        expected = MultiClassPredictor.from_models(self.models)
+        self.assertEqual(predictor.classes, expected.classes)
+        self.assertEqual(predictor.field_names, expected.field_names)
+        self.assertEqual(predictor.ntree_limits, expected.ntree_limits)
+        self.assertEqual(predictor.feature_options, {"heartbeat_template": "median"})
+
+        labels, scores = predictor.predict(self.features)
+        expected_labels, expected_scores = expected.predict(self.features)
+        np.testing.assert_array_equal(scores, expected_scores)
+        np.testing.assert_array_equal(labels, expected_labels)
+
+    def test_unsupported_version(self):
+        save_model_bundle(self.bundle_dir, self.models)
+        manifest_fp = os.path.join(self.bundle_dir, MANIFEST_FILENAME)
+        with open(manifest_fp) as f:
+            manifest = json.load(f)
+        manifest["format_version"] = 0
+        with open(manifest_fp, "w") as f:
+            json.dump(manifest, f)
+
+        with self.assertRaises(ValueError):
+            load_model_bundle(self.bundle_dir)
+
+    def test_legacy_feature_options(self):
+        # bundles written before the feature options were recorded
+        save_model_bundle(self.bundle_dir, self.models)
+        manifest_fp = os.path.join(self.bundle_dir, MANIFEST_FILENAME)
+        with open(manifest_fp) as f:
+            manifest = json.load(f)
+        del manifest["feature_options"]
+        with open(manifest_fp, "w") as f:
+            json.dump(manifest, f)
+
+        predictor = load_model_bundle(self.bundle_dir)
+        self.assertEqual(predictor.feature_options, LEGACY_FEATURE_OPTIONS)
@@ -1,9 +1,14 @@
+import json
+import threading
+import time
 import unittest
+import warnings
 from glob import glob
 
 import numpy as np
 import pandas as pd
 import joblib
+import scipy.signal
 import tsfresh
 import wfdb
 
@@ -13,9 +18,15 @@ from neurokit2_parallel import (
     ECG_LEAD_NAMES,
     KEYS_INTERVALRELATED,
     KEYS_TSFRESH,
+    KEYS_DELINEATE,
+    LEAD_BACKENDS,
+    LeadArrays,
+    SignalContext,
+    feature_plan,
     FC_PARAMETERS,
     ecg_clean,
     ecg_peaks,
+    ecg_fixpeaks,
     signal_rate,
     ecg_quality,
     ecg_delineate,
@@ -25,7 +36,14 @@ from neurokit2_parallel import (
     signal_to_tsfresh_df,
     lead_to_feature_dataframe,
     parse_comments,
+    records_to_feature_matrix,
+    _correct_artifacts,
+    _ecg_findpeaks_neurokit,
+    _signal_window,
+    _get_lead_pool,
+    wfdb_record_to_feature_dataframe,
 )
+from util.parse_fc_parameters import parse_fc_parameters
 
 
 class TestNeurokit2Parallel(unittest.TestCase):
@@ -84,26 +102,80 @@ class TestNeurokit2Parallel(unittest.TestCase):
                         )
                         pass
 
-                signals, info = ecg_peaks(
-                    cleaned_signals, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-                )
+                rpeaks = ecg_peaks(cleaned_signals, sampling_rate=r.fs)
+                self.assertEqual(len(rpeaks), num_leads)
                 for lead_idx, output_peak in enumerate(output_peaks):
                     ref_signal, ref_info = output_peak
-                    par_signal = signals[
-                        signals["ECG_Sig_Name"] == r.sig_name[lead_idx]
-                    ]
-                    par_info = info[lead_idx]
+                    par_rpeaks = rpeaks[lead_idx]
 
-                    self.assertTrue(
-                        (par_signal["ECG_R_Peaks"] == ref_signal["ECG_R_Peaks"]).all()
-                    )
-                    self.assertTrue(
-                        (ref_info["ECG_R_Peaks"] == par_info["ECG_R_Peaks"]).all()
+                    np.testing.assert_array_equal(
+                        par_rpeaks, np.where(ref_signal["ECG_R_Peaks"] == 1)[0]
                     )
+                    self.assertTrue((ref_info["ECG_R_Peaks"] == par_rpeaks).all())
             except Exception:
                 raise Exception(mat_record_fp)
 
+    def test_ecg_fixpeaks(self):
+        rng = np.random.default_rng(0)
+        lead_rpeaks = []
+        for num_peaks in [0, 1, 2, 3, 20, 40, 60, 80, 100, 120, 140, 160]:
+            rr = rng.normal(400, 30, num_peaks)
+            if num_peaks > 10:
+                # missed, extra and misaligned beats
+                rr[3] *= 2
+                rr[7] /= 2
+                rr[9] *= 0.6
+                rr[10] *= 1.4
+            lead_rpeaks.append(np.cumsum(rr).astype(int))
+        rpeaks = ecg_fixpeaks(LeadArrays.from_leads(lead_rpeaks), sampling_rate=500)
+        for lead_idx, par_rpeaks in enumerate(rpeaks):
+            _, ref = nk.signal_fixpeaks(
+                {"ECG_R_Peaks": lead_rpeaks[lead_idx]},
+                sampling_rate=500,
+                iterative=True,
+                method="Kubios",
+            )
+            np.testing.assert_array_equal(par_rpeaks, np.sort(ref))
+
+    def test_correct_adjacent_artifacts(self):
+        peaks = np.arange(0, 4000, 200)
+        peaks[8] += 60
+        counts = np.array([20, 20])
+        artifacts = {
+            # lead 0: extra peaks next to ectopic ones, which meet at index 6
+            "extra": (np.array([0, 0]), np.array([5, 6])),
+            "missed": (np.array([], dtype=int), np.array([], dtype=int)),
+            "ectopic": (np.array([0, 0, 1]), np.array([7, 8, 4])),
+            "longshort": (np.array([], dtype=int), np.array([], dtype=int)),
+        }
+        corrected, corrected_counts = _correct_artifacts(
+            np.concatenate([peaks, peaks]), counts, artifacts
+        )
+        np.testing.assert_array_equal(corrected_counts, [18, 20])
+        lead_peaks = np.split(corrected, np.cumsum(corrected_counts)[:-1])
+
+        # peaks 5 and 6 deleted, peak 7 (now 5) moved between its neighbours
+        expected = np.delete(peaks, [5, 6])
+        expected[6] = expected[5] + (expected[7] - expected[5]) // 2
+        np.testing.assert_array_equal(lead_peaks[0], expected)
+        self.assertEqual(lead_peaks[0][6], 1600)
+        np.testing.assert_array_equal(lead_peaks[1], peaks)
+
+    def test_ecg_findpeaks_neurokit(self):
+        for mat_record_fp in self.all_mat_records:
+            r = wfdb.rdrecord(mat_record_fp.rsplit(".mat")[0])
+            cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
+
+            lead_rpeaks = _ecg_findpeaks_neurokit(cleaned_signals, sampling_rate=r.fs)
+            self.assertEqual(len(lead_rpeaks), cleaned_signals.shape[1])
+            for lead_idx, rpeaks in enumerate(lead_rpeaks):
+                ref = nk.ecg_findpeaks(
+                    cleaned_signals[:, lead_idx], sampling_rate=r.fs, method="neurokit"
+                )["ECG_R_Peaks"]
+                np.testing.assert_array_equal(rpeaks, ref)
+
     def test_signal_rate(self):
+        record_rpeaks, record_lengths, record_rates = [], [], []
         # for mat_record_fp in self.all_mat_records:
         for mat_record_fp in [
             "tests/data/E00793.mat",
@@ -114,23 +186,22 @@ class TestNeurokit2Parallel(unittest.TestCase):
             cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
             sig_len, num_leads = cleaned_signals.shape
 
-            signals, info = ecg_peaks(
-                cleaned_signals, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-            )
+            rpeaks = ecg_peaks(cleaned_signals, sampling_rate=r.fs)
 
             ref_rates = {}
             for lead_idx, sig_name in enumerate(r.sig_name):
-                # par_signal = signals[
-                #     signals["ECG_Sig_Name"] == r.sig_name[lead_idx]
-                # ]
-                par_info = info[lead_idx]
+                par_info = {
+                    "ECG_R_Peaks": rpeaks[lead_idx]
+                }
 
                 ref_rate = nk.signal_rate(
                     par_info, sampling_rate=r.fs, desired_length=sig_len
                 )
                 ref_rates[lead_idx] = ref_rate
 
-            par_rate = signal_rate(info, sampling_rate=r.fs, desired_length=sig_len)
+            par_rate = signal_rate(
+                rpeaks, sampling_rate=r.fs, desired_length=sig_len
+            )
             for k, ref_rate in ref_rates.items():
                 if not (par_rate[k] == ref_rate).all():
                     # check that they are both all NaN
@@ -144,6 +215,19 @@ class TestNeurokit2Parallel(unittest.TestCase):
                         f"{mat_record_fp} lead_idx {lead_idx}",
                     )
 
+            record_rpeaks.extend(rpeaks)
+            record_lengths.extend([sig_len] * num_leads)
+            record_rates.extend(par_rate)
+
+        # leads of many records in one shot
+        batch_rate = signal_rate(
+            LeadArrays.from_leads(record_rpeaks),
+            sampling_rate=500,
+            desired_length=record_lengths,
+        )
+        for lead_rate, par_rate in zip(batch_rate, record_rates):
+            np.testing.assert_array_equal(lead_rate, par_rate)
+
     def test_ecg_quality(self):
         # for mat_record_fp in self.all_mat_records:
         for mat_record_fp in [
@@ -155,22 +239,24 @@ class TestNeurokit2Parallel(unittest.TestCase):
             cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
             sig_len, num_leads = cleaned_signals.shape
 
-            signals, info = ecg_peaks(
-                cleaned_signals, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-            )
+            rpeaks = ecg_peaks(cleaned_signals, sampling_rate=r.fs)
 
             ref_quality = {}
             for lead_idx, sig_name in enumerate(r.sig_name):
                 ecg_cleaned = cleaned_signals[:, lead_idx]
-                rpeaks = info[lead_idx]["ECG_R_Peaks"]
+                lead_rpeaks = rpeaks[lead_idx]
 
                 try:
-                    ref = nk.ecg_quality(ecg_cleaned, rpeaks=rpeaks, sampling_rate=r.fs)
+                    ref = nk.ecg_quality(
+                        ecg_cleaned, rpeaks=lead_rpeaks, sampling_rate=r.fs
+                    )
                 except Exception:
                     ref = np.full(sig_len, np.nan)
                 ref_quality[lead_idx] = ref
 
-            par_quality = ecg_quality(cleaned_signals, info, sampling_rate=r.fs)
+            par_quality = ecg_quality(
+                cleaned_signals, rpeaks, sampling_rate=r.fs
+            )
 
             for k, v in ref_quality.items():
                 if not (par_quality[k] == v).all():
@@ -196,65 +282,27 @@ class TestNeurokit2Parallel(unittest.TestCase):
             cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
             sig_len, num_leads = cleaned_signals.shape
 
-            signals, info = ecg_peaks(
-                cleaned_signals, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-            )
+            rpeaks = ecg_peaks(cleaned_signals, sampling_rate=r.fs)
+
+            par_delineate_info = ecg_delineate(cleaned_signals, rpeaks, sampling_rate=r.fs)
+            self.assertEqual(list(par_delineate_info.keys()), KEYS_DELINEATE)
 
-            ref_delineate = []
             for lead_idx, sig_name in enumerate(r.sig_name):
                 ecg_cleaned = cleaned_signals[:, lead_idx]
-                rpeaks = info[lead_idx]
 
                 try:
-                    ref = nk.ecg_delineate(
-                        ecg_cleaned=ecg_cleaned, rpeaks=rpeaks, sampling_rate=r.fs
+                    _, ref_info = nk.ecg_delineate(
+                        ecg_cleaned=ecg_cleaned,
+                        rpeaks={"ECG_R_Peaks": rpeaks[lead_idx]},
+                        sampling_rate=r.fs,
                     )
                 except Exception:
-                    ref = (
-                        pd.DataFrame(
-                            {
-                                "ECG_P_Peaks": [0.0,] * sig_len,
-                                "ECG_Q_Peaks": [0.0,] * sig_len,
-                                "ECG_S_Peaks": [0.0,] * sig_len,
-                                "ECG_T_Peaks": [0.0,] * sig_len,
-                                "ECG_P_Onsets": [0.0,] * sig_len,
-                                "ECG_T_Offsets": [0.0,] * sig_len,
-                            }
-                        ),
-                        {
-                            "ECG_P_Peaks": [],
-                            "ECG_Q_Peaks": [],
-                            "ECG_S_Peaks": [],
-                            "ECG_T_Peaks": [],
-                            "ECG_P_Onsets": [],
-                            "ECG_T_Offsets": [],
-                        },
-                    )
-                ref_delineate.append(ref)
-
-            par_delineate_df, par_delineate_info = ecg_delineate(
-                cleaned_signals, info, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-            )
+                    ref_info = dict((key, []) for key in KEYS_DELINEATE)
 
-            for lead_idx, output_ref in enumerate(ref_delineate):
-                ref_delineate, ref_info = output_ref
-                par_delineate_df_inst = par_delineate_df[
-                    par_delineate_df["ECG_Sig_Name"] == r.sig_name[lead_idx]
-                ]
-                par_delineate_info_inst = par_delineate_info[lead_idx]
-
-                self.assertTrue(ref_info == par_delineate_info_inst)
-
-                for key in [
-                    "ECG_P_Peaks",
-                    "ECG_Q_Peaks",
-                    "ECG_S_Peaks",
-                    "ECG_T_Peaks",
-                    "ECG_P_Onsets",
-                    "ECG_T_Offsets",
-                ]:
-                    self.assertTrue(
-                        (par_delineate_df_inst[key] == ref_delineate[key]).all()
+                for key in KEYS_DELINEATE:
+                    np.testing.assert_array_equal(
+                        par_delineate_info[key][lead_idx],
+                        np.asarray(ref_info[key], dtype=float),
                     )
 
     def test_ecg_intervalrelated(self):
@@ -272,13 +320,15 @@ class TestNeurokit2Parallel(unittest.TestCase):
             for ln in ECG_LEAD_NAMES:
                 df_sig_names += [ln,] * sig_len
 
-            peaks_df, peaks_info = ecg_peaks(
-                cleaned_signals, sampling_rate=r.fs, ecg_lead_names=r.sig_name
-            )
+            rpeaks = ecg_peaks(cleaned_signals, sampling_rate=r.fs)
 
             # non-df outputs...
-            rate = signal_rate(peaks_info, sampling_rate=r.fs, desired_length=sig_len)
-            quality = ecg_quality(cleaned_signals, peaks_info, sampling_rate=r.fs)
+            rate = signal_rate(
+                rpeaks, sampling_rate=r.fs, desired_length=sig_len
+            )
+            quality = ecg_quality(cleaned_signals, rpeaks, sampling_rate=r.fs)
+            instant_peaks = np.zeros((num_leads, sig_len))
+            instant_peaks[rpeaks.leads, rpeaks.values] = 1.0
 
             rate_values = np.concatenate(
                 [rate[lead_idx] for lead_idx in range(num_leads)]
@@ -292,7 +342,7 @@ class TestNeurokit2Parallel(unittest.TestCase):
                     "ECG_Raw": r.p_signal.flatten(order="F"),
                     "ECG_Clean": cleaned_signals.flatten(order="F"),
                     "ECG_Sig_Name": df_sig_names,
-                    "ECG_R_Peaks": peaks_df["ECG_R_Peaks"],
+                    "ECG_R_Peaks": instant_peaks.flatten(),
                     "ECG_Rate": rate_values,
                     "ECG_Quality": quality_values,
                 }
@@ -397,6 +447,176 @@ class TestNeurokit2Parallel(unittest.TestCase):
                 [k.split("sig__")[1] for k in hb_feats.columns] == KEYS_TSFRESH
             )
 
+    def test_signal_window(self):
+        r = wfdb.rdrecord("tests/data/HR00599")  # 20846 samples
+        cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
+
+        # no resampling at mod_fs, middle 2000 samples without the first second
+        mid_point = 500 + int((len(cleaned_signals) - 1000) / 2)
+        np.testing.assert_array_equal(
+            _signal_window(cleaned_signals, sampling_rate=500),
+            cleaned_signals[mid_point - 1000 : mid_point + 1000],  # noqa: E203
+        )
+
+        # the cropped signal resamples as the whole signal does
+        for sampling_rate, up, down, num_samples in (
+            (257, 500, 257, 20846),
+            (1000, 1, 2, 20846),
+            (257, 500, 257, 900),
+        ):
+            signal = cleaned_signals[:num_samples]
+            window = _signal_window(signal, sampling_rate=sampling_rate)
+
+            len_mod_fs = int(len(signal) / sampling_rate * 500)
+            resampled = scipy.signal.resample_poly(signal, up, down)[:len_mod_fs]
+            resampled = resampled[500:-500]
+            if len(resampled) > 2000:
+                mid_point = int(len(resampled) / 2)
+                resampled = resampled[mid_point - 1000 : mid_point + 1000]  # noqa: E203
+            self.assertEqual(window.shape, (min(len_mod_fs - 1000, 2000), 12))
+            np.testing.assert_array_equal(window, resampled)
+
+            # legacy models resample the whole signal with an FFT
+            resampled = scipy.signal.resample(signal, len_mod_fs)[500:-500]
+            if len(resampled) > 2000:
+                mid_point = int(len(resampled) / 2)
+                resampled = resampled[mid_point - 1000 : mid_point + 1000]  # noqa: E203
+            np.testing.assert_array_equal(
+                _signal_window(signal, sampling_rate=sampling_rate, resampling="fft"),
+                resampled,
+            )
+
+        with self.assertRaises(ValueError):
+            SignalContext(r.p_signal, r.fs, signal_resampling="linear")
+
+    def test_signal_context(self):
+        r = wfdb.rdrecord("tests/data/Q2428")  # test leads with no detected R-peaks
+        context = SignalContext(r.p_signal, r.fs)
+        sig_len, num_leads = context.cleaned_signals.shape
+
+        for lead_idx in range(num_leads):
+            cleaned = context.cleaned_signals[:, lead_idx]
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                try:
+                    rpeaks_df, rpeaks_info = nk.ecg_peaks(
+                        cleaned, sampling_rate=r.fs, correct_artifacts=True
+                    )
+                    rate = nk.signal_rate(
+                        rpeaks_info, sampling_rate=r.fs, desired_length=sig_len
+                    )
+                    quality = nk.ecg_quality(
+                        cleaned, rpeaks=rpeaks_info["ECG_R_Peaks"], sampling_rate=r.fs
+                    )
+                    signals_df = pd.concat(
+                        [
+                            pd.DataFrame({"Signal": cleaned}),
+                            rpeaks_df,
+                            pd.DataFrame({"ECG_Rate": rate, "ECG_Quality": quality}),
+                        ],
+                        axis=1,
+                    )
+                    ir_df = nk.ecg_intervalrelated(signals_df, sampling_rate=r.fs)
+                except Exception:
+                    self.assertIsNone(context.interval_related[lead_idx])
+                    continue
+
+            np.testing.assert_array_equal(
+                context.rpeaks[lead_idx], rpeaks_info["ECG_R_Peaks"]
+            )
+            np.testing.assert_array_equal(context.rate[lead_idx], rate)
+            np.testing.assert_array_equal(context.quality[lead_idx], quality)
+            self.assertEqual(
+                list(context.interval_related[lead_idx]), list(ir_df.columns)
+            )
+            np.testing.assert_array_equal(
+                list(context.interval_related[lead_idx].values()), ir_df.iloc[0]
+            )
+
+            heartbeats = nk.ecg_segment(
+                signals_df, rpeaks=rpeaks_info["ECG_R_Peaks"], show=False
+            )
+            starts, ends = context.beat_windows
+            np.testing.assert_array_equal(
+                starts[lead_idx], [hb["Index"].iloc[0] for hb in heartbeats.values()]
+            )
+            np.testing.assert_array_equal(
+                ends[lead_idx], [hb["Index"].iloc[-1] + 1 for hb in heartbeats.values()]
+            )
+            best_heartbeat = max(
+                (hb for hb in heartbeats.values() if np.isfinite(hb["Signal"]).all()),
+                key=lambda hb: hb["ECG_Quality"].mean(),
+            )
+            np.testing.assert_array_equal(
+                context.best_heartbeats[lead_idx], best_heartbeat["Signal"]
+            )
+
+            # a single lead context keeps the stages computed so far
+            lead_context = context.lead(lead_idx)
+            self.assertIs(
+                lead_context.stages["best_heartbeats"][0],
+                context.best_heartbeats[lead_idx],
+            )
+            np.testing.assert_array_equal(
+                lead_context.rpeaks.values, context.rpeaks[lead_idx]
+            )
+
+    def test_heartbeat_templates(self):
+        r = wfdb.rdrecord("tests/data/E00793")
+        best = SignalContext(r.p_signal, r.fs)
+        sig_len = len(best.cleaned_signals)
+        starts, ends = best.beat_windows
+
+        for template, reduce in (("median", np.median), ("mean", np.mean)):
+            context = SignalContext(
+                r.p_signal,
+                r.fs,
+                cleaned_signals=best.cleaned_signals,
+                heartbeat_template=template,
+            )
+            self.assertEqual(context.lead(0).heartbeat_template, template)
+            for lead_idx, heartbeat in enumerate(context.best_heartbeats):
+                signal = best.cleaned_signals[:, lead_idx]
+                beats = [
+                    signal[start:end]
+                    for start, end in zip(starts[lead_idx], ends[lead_idx])
+                    if start >= 0 and end <= sig_len
+                ]
+                # beats of the most common length
+                widths, counts = np.unique(list(map(len, beats)), return_counts=True)
+                width = widths[np.argmax(counts)]
+                expected = reduce([b for b in beats if len(b) == width], axis=0)
+                np.testing.assert_allclose(heartbeat, expected)
+
+            # only the best heartbeat depends on the quality
+            context.stages["quality"] = [None] * context.num_leads
+            del context.stages["best_heartbeats"]
+            self.assertTrue(all(hb is not None for hb in context.best_heartbeats))
+        best.stages["quality"] = [None] * best.num_leads
+        self.assertTrue(all(hb is None for hb in best.best_heartbeats))
+
+        with self.assertRaises(ValueError):
+            SignalContext(r.p_signal, r.fs, heartbeat_template="first")
+
+        # the template reaches the heartbeat features of the entry points
+        field_names = ["I_hb__abs_energy", "I_hb__maximum"]
+        fc_parameters = parse_fc_parameters(field_names)
+        best_features, _ = wfdb_record_to_feature_dataframe(
+            r, fc_parameters=fc_parameters
+        )
+        median_features, _ = wfdb_record_to_feature_dataframe(
+            r, fc_parameters=fc_parameters, heartbeat_template="median"
+        )
+        self.assertFalse(
+            np.allclose(best_features[field_names], median_features[field_names])
+        )
+        features, _ = records_to_feature_matrix(
+            [r], field_names, fc_parameters=fc_parameters, heartbeat_template="median"
+        )
+        np.testing.assert_array_equal(
+            features[0], median_features[field_names].to_numpy(dtype=np.float32)[0]
+        )
+
     def test_lead_to_feature_dataframe(self):
         for mat_record_fp in [
             "tests/data/E00793.mat",
@@ -423,3 +643,118 @@ class TestNeurokit2Parallel(unittest.TestCase):
 
             self.assertEqual(record_features.shape, (1, 18950))  # Comprehensive FC
             # self.assertEqual(record_features.shape, (1, 18806))  # Efficient FC
+
+    def test_records_to_feature_matrix(self):
+        with open("importances_rank.json") as f:
+            field_names = json.load(f)["sorted_keys"][:1000]
+        fc_parameters = parse_fc_parameters(field_names)
+
+        records = [
+            wfdb.rdrecord(mat_record_fp.rsplit(".mat")[0])
+            for mat_record_fp in [
+                "tests/data/E00009.mat",
+                "tests/data/Q2428.mat",  # test leads with no detected R-peaks
+                "tests/data/E00015.mat",  # same shape as E00009, cleaned together
+            ]
+        ]
+
+        # records of the same shape clean as they do one at a time
+        np.testing.assert_array_equal(
+            ecg_clean(np.stack([records[0].p_signal, records[2].p_signal])),
+            np.stack(
+                [ecg_clean(records[0].p_signal), ecg_clean(records[2].p_signal)]
+            ),
+        )
+
+        features, dxs = records_to_feature_matrix(
+            records, field_names, fc_parameters=fc_parameters
+        )
+        self.assertEqual(features.shape, (len(records), len(field_names)))
+        self.assertEqual(features.dtype, np.float32)
+
+        for idx, r in enumerate(records):
+            record_features, dx = wfdb_record_to_feature_dataframe(
+                r, fc_parameters=fc_parameters
+            )
+            self.assertEqual(dxs[idx], dx)
+            np.testing.assert_array_equal(
+                features[idx],
+                record_features.reindex(field_names, axis=1)
+                .to_numpy(dtype=np.float32)[0],
+            )
+
+    def test_feature_plan(self):
+        with open("importances_rank.json") as f:
+            sorted_keys = json.load(f)["sorted_keys"]
+        field_names = sorted_keys[:12]  # age, sex and lead I HRV and heartbeat
+        fc_parameters = parse_fc_parameters(field_names)
+
+        plan = feature_plan(fc_parameters)
+        self.assertIs(feature_plan(fc_parameters), plan)  # one plan per model
+        self.assertEqual(plan.meta, ["age", "sex"])
+        self.assertEqual(plan.lead_families["I"], {"hrv", "hb"})
+        self.assertEqual(plan.lead_idxs(), [0])
+        self.assertEqual(plan.peak_lead_idxs(), [0])
+        self.assertEqual(list(plan.placeholder_features), ["I_hb"])
+        self.assertEqual(feature_plan(fc_parameters, field_names[:3]).lead_idxs(), [0])
+        self.assertEqual(feature_plan(fc_parameters, field_names[:2]).lead_idxs(), [])
+
+        # skipped leads and stages do not change the features that are kept
+        r = wfdb.rdrecord("tests/data/Q2428")
+        record_features, _ = wfdb_record_to_feature_dataframe(
+            r, fc_parameters=fc_parameters
+        )
+        expected, _ = wfdb_record_to_feature_dataframe(
+            r, fc_parameters=parse_fc_parameters(sorted_keys[:1000])
+        )
+        self.assertTrue(set(field_names) <= set(record_features.columns))
+        pd.testing.assert_frame_equal(
+            record_features[field_names], expected[field_names]
+        )
+
+    def test_lead_backends(self):
+        with open("importances_rank.json") as f:
+            fc_parameters = parse_fc_parameters(json.load(f)["sorted_keys"][:1000])
+
+        r = wfdb.rdrecord("tests/data/E00793")
+        expected, _ = wfdb_record_to_feature_dataframe(
+            r, fc_parameters=fc_parameters, backend="serial"
+        )
+        for backend in LEAD_BACKENDS:
+            # the shared process pool is reused by the second call
+            for _ in range(2):
+                record_features, _ = wfdb_record_to_feature_dataframe(
+                    r, fc_parameters=fc_parameters, n_jobs=4, backend=backend
+                )
+                pd.testing.assert_frame_equal(
+                    record_features, expected, check_exact=True
+                )
+
+        with self.assertRaises(ValueError):
+            wfdb_record_to_feature_dataframe(r, backend="loky")
+
+    def test_lead_pools(self):
+        # a thread asking for another n_jobs does not stop the pool of a thread
+        # still mapping on it
+        mapping = threading.Event()
+        results = {}
+
+        def slow_map():
+            pool = _get_lead_pool(2)
+            result = pool.map_async(time.sleep, [0.5] * 4)
+            mapping.set()
+            results[2] = result.get(30)
+
+        def other_map():
+            mapping.wait(30)
+            results[3] = _get_lead_pool(3).map(abs, [-1, -2, -3])
+
+        threads = [threading.Thread(target=f) for f in (slow_map, other_map)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+
+        self.assertEqual(results, {2: [None] * 4, 3: [1, 2, 3]})
+        self.assertIs(_get_lead_pool(2), _get_lead_pool(2))
+        self.assertIsNot(_get_lead_pool(2), _get_lead_pool(3))
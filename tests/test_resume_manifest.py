@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+
+from util.resume_manifest import ResumeManifest
+
+
+class TestResumeManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.manifest_fp = os.path.join(self.tmp_dir.name, "manifest.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_mark_and_reload(self):
+        with ResumeManifest(self.manifest_fp) as manifest:
+            manifest.mark_in_progress("a.hea")
+            manifest.mark_completed("a.hea")
+            manifest.mark_in_progress("b.hea")
+            manifest.mark_failed("b.hea", "Traceback...")
+            manifest.mark_in_progress("c.hea")
+
+        # simulate a line cut short by an interrupted write
+        with open(self.manifest_fp, "a") as f:
+            f.write('["d.hea", "comp')
+
+        with ResumeManifest(self.manifest_fp) as manifest:
+            self.assertEqual(manifest.state("a.hea"), ResumeManifest.COMPLETED)
+            self.assertEqual(manifest.state("b.hea"), ResumeManifest.FAILED)
+            self.assertEqual(manifest.details["b.hea"], "Traceback...")
+            self.assertEqual(manifest.state("c.hea"), ResumeManifest.IN_PROGRESS)
+            self.assertIsNone(manifest.state("d.hea"))
+            self.assertNotIn("d.hea", manifest)
+
+    def test_reconcile(self):
+        with ResumeManifest(self.manifest_fp) as manifest:
+            manifest.mark_completed("a.hea")
+            # completed, but the row never reached the feature store
+            manifest.mark_completed("b.hea")
+            manifest.mark_failed("c.hea")
+            # interrupted
+            manifest.mark_in_progress("d.hea")
+
+            # e.hea was extracted by a run without a manifest
+            num_dropped = manifest.reconcile({"a.hea", "e.hea"})
+
+        self.assertEqual(num_dropped, 2)
+        with ResumeManifest(self.manifest_fp) as manifest:
+            self.assertEqual(len(manifest), 3)
+            self.assertCountEqual(
+                manifest.header_files(ResumeManifest.COMPLETED), ["a.hea", "e.hea"]
+            )
+            self.assertEqual(manifest.header_files(ResumeManifest.FAILED), ["c.hea"])
+            self.assertIsNone(manifest.state("b.hea"))
+            self.assertIsNone(manifest.state("d.hea"))
+
+        # compacted to one line per record
+        with open(self.manifest_fp) as f:
+            self.assertEqual(len(f.readlines()), 3)
@@ -0,0 +1,193 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from xgboost import XGBClassifier
+
+from driver import load_challenge_data
+from serve_12ECG_classifier import InferenceService, parse_challenge_data, serve
+from util.model_bundle import save_model_bundle
+
+FIELD_NAMES = ["age", "sex", "I_HRV_RMSSD"]
+
+
+def _fake_extract_features(data, header_data):
+    # the first header line tells the pool worker how the extraction goes
+    command = header_data[0].strip()
+    if command == "hang":
+        time.sleep(60)
+    elif command == "die":
+        os._exit(1)
+    elif command == "fail":
+        return None, "extraction failed"
+    elif command == "slow":
+        time.sleep(2)
+    return pd.DataFrame(dict((k, (float(data[0, 0]),)) for k in FIELD_NAMES)), None
+
+
+class TestServe12ECGClassifier(unittest.TestCase):
+    def test_parse_challenge_data(self):
+        data, header_data = load_challenge_data("tests/data/Q0001.mat")
+
+        with open("tests/data/Q0001.hea", "r") as f:
+            header_text = f.read()
+        with open("tests/data/Q0001.mat", "rb") as f:
+            mat_bytes = f.read()
+        parsed_data, parsed_header_data = parse_challenge_data(header_text, mat_bytes)
+
+        self.assertEqual(parsed_data.dtype, np.float64)
+        np.testing.assert_array_equal(parsed_data, data)
+        self.assertEqual(parsed_header_data, header_data)
+
+        # windows line endings are read as the header file would be
+        _, crlf_header_data = parse_challenge_data(
+            header_text.replace("\n", "\r\n"), mat_bytes
+        )
+        self.assertEqual(crlf_header_data, header_data)
+
+
+class TestInferenceService(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        features = pd.DataFrame(rng.normal(size=(100, 3)), columns=FIELD_NAMES)
+        models = {
+            "train_records": [],
+            "eval_records": [],
+            "field_names": FIELD_NAMES,
+        }
+        labels = (features["age"] + rng.normal(size=100) * 0.5) > 0
+        models["164889003"] = XGBClassifier(verbosity=0, n_estimators=5).fit(
+            features, labels
+        )
+        save_model_bundle(os.path.join(cls.tmp_dir.name, "finalized_model_1"), models)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def setUp(self):
+        # the pool workers are forked with the fake extraction
+        patcher = mock.patch(
+            "serve_12ECG_classifier._extract_features", _fake_extract_features
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _service(self, **kwargs):
+        service = InferenceService(self.tmp_dir.name, num_workers=2, **kwargs)
+        self.addCleanup(service.close)
+        return service
+
+    @staticmethod
+    def _record(value, command="ok"):
+        return np.full((12, 10), value, dtype=np.float64), [command + "\n"]
+
+    def test_batching(self):
+        service = self._service(batch_size=4, batch_wait=0.5)
+        values = np.linspace(-2, 2, 8)
+        futures = [service.submit(*self._record(v)) for v in values]
+        outputs = [future.result(30) for future in futures]
+
+        labels, scores = service.predictor.predict(
+            pd.DataFrame(dict((k, values) for k in FIELD_NAMES))
+        )
+        for idx, (record_labels, record_scores, classes) in enumerate(outputs):
+            self.assertEqual(classes, ("164889003",))
+            self.assertEqual(record_labels, list(map(int, labels[idx])))
+            np.testing.assert_array_equal(record_scores, scores[idx])
+
+        metrics = service.metrics()
+        self.assertEqual(metrics["records_total"], 8)
+        self.assertEqual(metrics["failures_total"], 0)
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertGreaterEqual(metrics["batches_total"], 2)
+        self.assertLess(metrics["batches_total"], 8)
+
+    def test_slow_record(self):
+        # a slow extraction does not hold back the records submitted after it
+        service = self._service(batch_size=4, batch_wait=0.05)
+        slow = service.submit(*self._record(1.0, "slow"))
+        fast = [service.submit(*self._record(v)) for v in (0.0, 0.5, -0.5)]
+        for future in fast:
+            future.result(30)
+        self.assertFalse(slow.done())
+        slow.result(30)
+
+    def test_failures(self):
+        service = self._service(record_timeout=3)
+        failed = service.submit(*self._record(0.0, "fail"))
+        with self.assertRaisesRegex(RuntimeError, "extraction failed"):
+            failed.result(30)
+
+        # the worker is replaced and the record running alongside is retried
+        died = service.submit(*self._record(0.0, "die"))
+        alongside = service.submit(*self._record(0.5, "slow"))
+        with self.assertRaisesRegex(RuntimeError, "worker process died"):
+            died.result(30)
+        alongside.result(30)
+
+        hung = service.submit(*self._record(0.0, "hang"))
+        with self.assertRaisesRegex(RuntimeError, "timed out after 3 seconds"):
+            hung.result(30)
+        service.submit(*self._record(0.5)).result(30)
+
+        metrics = service.metrics()
+        self.assertEqual(metrics["records_total"], 5)
+        self.assertEqual(metrics["failures_total"], 3)
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertGreaterEqual(metrics["worker_restarts_total"], 3)
+
+    def test_http(self):
+        service = self._service()
+        server = serve(service, port=0)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.shutdown)
+        url = "http://{}:{}".format(*server.server_address)
+
+        with open("tests/data/Q0001.hea", "r") as f:
+            header_text = f.read()
+        with open("tests/data/Q0001.mat", "rb") as f:
+            mat = base64.b64encode(f.read()).decode()
+
+        def request(path, payload=None):
+            body = None if payload is None else json.dumps(payload).encode()
+            try:
+                with urllib.request.urlopen(url + path, body, timeout=30) as response:
+                    return response.status, response.read()
+            except urllib.error.HTTPError as e:
+                return e.code, e.read()
+
+        self.assertEqual(request("/health"), (200, b"ok\n"))
+
+        status, body = request("/predict", {"header": header_text, "mat": mat})
+        self.assertEqual(status, 200)
+        body = json.loads(body)
+        self.assertEqual(body["classes"], ["164889003"])
+        self.assertEqual(len(body["scores"]), 1)
+
+        status, body = request("/predict", {"header": "fail\n", "mat": mat})
+        self.assertEqual(status, 500)
+        self.assertIn("extraction failed", json.loads(body)["error"])
+
+        status, _ = request("/predict", {"header": header_text})
+        self.assertEqual(status, 400)
+        status, _ = request("/unknown")
+        self.assertEqual(status, 404)
+
+        status, body = request("/metrics")
+        self.assertEqual(status, 200)
+        self.assertIn(b"ecg_classifier_records_total 2\n", body)
+        self.assertIn(b"ecg_classifier_failures_total 1\n", body)
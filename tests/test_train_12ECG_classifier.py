@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+
+from train_12ECG_classifier import _determine_sample_weights
+
+
+class TestDetermineSampleWeights(unittest.TestCase):
+    def setUp(self):
+        self.scored_codes = ["164889003", "164890007", "713422000"]
+        # weight of the diagnosis (col) against the class (row)
+        self.all_weights = np.array(
+            [[1.0, 0.5, 0.4], [0.5, 1.0, 0.6], [0.4, 0.6, 1.0]]
+        )
+
+    def test_labels_and_weights(self):
+        data_set = [
+            [164889003],
+            ["164890007", 426783006],
+            [426783006],
+            [713422000, 164889003],
+            [],
+        ]
+        labels, weights = _determine_sample_weights(
+            data_set, self.scored_codes, self.all_weights
+        )
+
+        self.assertEqual(labels.shape, (5, 3))
+        np.testing.assert_array_equal(
+            labels,
+            [
+                [True, True, False],
+                [True, True, True],
+                [False, False, False],
+                [True, True, True],
+                [False, False, False],
+            ],
+        )
+        np.testing.assert_array_equal(
+            weights,
+            [
+                [1.0, 0.5, 1.0],
+                [0.5, 1.0, 0.6],
+                [1.0, 1.0, 1.0],
+                [1.0, 0.6, 1.0],
+                [1.0, 1.0, 1.0],
+            ],
+        )
+
+    def test_weight_threshold(self):
+        labels, weights = _determine_sample_weights(
+            [[164889003]], self.scored_codes, self.all_weights, weight_threshold=0.3
+        )
+        np.testing.assert_array_equal(labels, [[True, True, True]])
+        np.testing.assert_array_equal(weights, [[1.0, 0.5, 0.4]])
@@ -0,0 +1,131 @@
+import json
+import unittest
+import warnings
+
+import numpy as np
+import pandas as pd
+import tsfresh
+import wfdb
+
+from neurokit2_parallel import ECG_LEAD_NAMES, FC_PARAMETERS, ecg_clean
+from tsfresh_vectorized import extract_features
+from util.parse_fc_parameters import parse_fc_parameters
+
+
+def _tsfresh_extract_features(series, kinds, **kwargs):
+    long_df = pd.concat(
+        [
+            pd.DataFrame(
+                {"id": 0, "kind": kind, "time": np.arange(len(s)), "value": s}
+            )
+            for kind, s in zip(kinds, series)
+        ]
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return tsfresh.extract_features(
+            long_df,
+            column_id="id",
+            column_sort="time",
+            column_kind="kind",
+            column_value="value",
+            disable_progressbar=True,
+            n_jobs=0,
+            **kwargs,
+        )
+
+
+class TestTsfreshVectorized(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        r = wfdb.rdrecord("tests/data/Q0001")
+        cls.cleaned_signals = ecg_clean(r.p_signal, sampling_rate=r.fs)
+
+    def assertParity(self, series, kinds, **kwargs):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            features = extract_features(series, kinds, **kwargs)
+        expected = _tsfresh_extract_features(series, kinds, **kwargs)
+
+        self.assertEqual(features.columns.to_list(), expected.columns.to_list())
+        self.assertEqual(features.index.to_list(), [0])
+        np.testing.assert_allclose(features.values, expected.values, rtol=1e-10)
+        return features
+
+    def test_comprehensive_fc_parameters(self):
+        # full waveform window, heartbeat sized window and a few leads together
+        self.assertParity(
+            [
+                self.cleaned_signals[1000:3000, 0],
+                self.cleaned_signals[1000:3000, 6],
+                self.cleaned_signals[500:850, 1],
+            ],
+            ["I_sig", "V1_sig", "II_hb"],
+            default_fc_parameters=FC_PARAMETERS,
+        )
+
+    def test_degenerate_series(self):
+        self.assertParity(
+            [
+                np.full(50, 0.5),
+                np.round(self.cleaned_signals[:300, 1] * 3),
+                np.array([1.0, 2.0, 1.0, 3.0, 0.0]),
+                np.array([0.5, 0.5, 0.5]),
+            ],
+            ["constant", "discrete", "short", "fallback"],
+            default_fc_parameters=FC_PARAMETERS,
+        )
+
+    def test_importances_fc_parameters(self):
+        with open("importances_rank.json") as f:
+            important_fields = json.load(f)["sorted_keys"][:1000]
+        fc_parameters = parse_fc_parameters(important_fields)
+
+        # leads share a length, heartbeats may not
+        series = list(self.cleaned_signals[1000:3000].T) + [
+            self.cleaned_signals[500:1000, i][: 340 + 10 * i] for i in range(12)
+        ]
+        kinds = [f"{lead}_sig" for lead in ECG_LEAD_NAMES] + [
+            f"{lead}_hb" for lead in ECG_LEAD_NAMES
+        ]
+        batch_features = self.assertParity(
+            series,
+            kinds,
+            default_fc_parameters={},
+            kind_to_fc_parameters=fc_parameters,
+        )
+
+        # (samples x leads) matrix input
+        features = extract_features(
+            self.cleaned_signals[1000:3000],
+            kinds[:12],
+            default_fc_parameters={},
+            kind_to_fc_parameters=fc_parameters,
+        )
+        expected = extract_features(
+            series[:12],
+            kinds[:12],
+            default_fc_parameters={},
+            kind_to_fc_parameters=fc_parameters,
+        )
+        pd.testing.assert_frame_equal(features, expected)
+
+        # a lead extracts the same on its own as batched with the others
+        for kind, s in zip(kinds, series):
+            lead_features = extract_features(
+                [s],
+                [kind],
+                default_fc_parameters={},
+                kind_to_fc_parameters=fc_parameters,
+            )
+            pd.testing.assert_frame_equal(
+                lead_features, batch_features[lead_features.columns], check_exact=True
+            )
+
+    def test_no_features(self):
+        features = extract_features([[0.5, 0.5, 0.5]], ["X_hb"], default_fc_parameters={})
+        self.assertTrue(features.empty)
+
+    def test_nan_series(self):
+        with self.assertRaises(ValueError):
+            extract_features([[0.5, np.nan, 0.5]], ["X_hb"])
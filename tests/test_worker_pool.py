@@ -0,0 +1,32 @@
+import os
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+from util.worker_pool import WorkerPool
+
+
+def _exit_worker():
+    os._exit(1)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_restart(self):
+        with WorkerPool(2) as pool:
+            executor, future = pool.submit(abs, -1)
+            self.assertEqual(future.result(10), 1)
+
+            # a dead worker breaks the executor until it is replaced
+            _, died = pool.submit(_exit_worker)
+            with self.assertRaises(BrokenProcessPool):
+                died.result(10)
+            _, future = pool.submit(abs, -2)
+            with self.assertRaises(BrokenProcessPool):
+                future.result(10)
+
+            pool.restart(executor)
+            self.assertIsNot(pool.executor, executor)
+            replaced = pool.executor
+            # a second restart of the broken executor keeps its replacement
+            pool.restart(executor)
+            self.assertIs(pool.executor, replaced)
+            self.assertEqual(pool.submit(abs, -3)[1].result(10), 3)
@@ -4,34 +4,38 @@ import multiprocessing
 import os
 import queue
 import subprocess
+import traceback
 import warnings
 from datetime import datetime, timedelta
 from glob import glob
 from time import time
 
-import joblib
 import numpy as np
 import pandas as pd
 import psutil
+import xgboost as xgb
 
 # import wfdb
 from sklearn.model_selection import train_test_split
-from tqdm import tqdm
-from xgboost import XGBClassifier
 
 from driver import load_challenge_data
 from neurokit2_parallel import (
     ECG_LEAD_NAMES,
     KEYS_INTERVALRELATED,
     KEYS_TSFRESH,
-    wfdb_record_to_feature_dataframe,
 )
+from run_12ECG_classifier import extract_record_features
 from util import parse_fc_parameters
+from util.classifier import BoosterClassifier
+from util.cpus import available_cpus
 from util.elapsed_timer import ElapsedTimer
 from util.evaluate_12ECG_score import is_number, load_table
 from util.evaluation_helper import evaluate_score_batch
+from util.feature_cache import FeatureCache
+from util.feature_store import FeatureStore
 from util.log import configure_logging
-from util.raw_to_wfdb import convert_to_wfdb_record
+from util.model_bundle import save_model_bundle
+from util.resume_manifest import ResumeManifest
 
 
 def _get_fieldnames():
@@ -52,6 +56,8 @@ def feat_extract_process(
     input_queue: multiprocessing.JoinableQueue,
     output_queue: multiprocessing.JoinableQueue,
     fc_parameters: [None, dict],
+    feature_cache: [None, FeatureCache] = None,
+    feature_options: [None, dict] = None,
 ):
     while True:
         try:
@@ -63,43 +69,66 @@ def feat_extract_process(
             # parent process should respawn new workers in this edge case
             break
 
+        output_queue.put(("started", header_file_path))
+
         # for some reason, OS FileError (Too many files) is raised...
         # r = wfdb.rdrecord(header_file_path.rsplit(".hea")[0])
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
 
-            mat_fp = header_file_path.replace(".hea", ".mat")
-            data, header_data = load_challenge_data(mat_fp)
-            r = convert_to_wfdb_record(data, header_data)
+            try:
+                mat_fp = header_file_path.replace(".hea", ".mat")
+                data, header_data = load_challenge_data(mat_fp)
 
-            record_features, dx = wfdb_record_to_feature_dataframe(
-                r, fc_parameters=fc_parameters
-            )
+                record_features, dx = extract_record_features(
+                    data,
+                    header_data,
+                    fc_parameters=fc_parameters,
+                    feature_cache=feature_cache,
+                    feature_options=feature_options,
+                )
+            except Exception:
+                output_queue.put(("failed", header_file_path, traceback.format_exc()))
+                continue
 
             # turn dataframe record_features into dict flatten out the values (one key to one row)
             ecg_features = dict(
                 (k, v[0]) for (k, v) in record_features.to_dict().items()
             )
-            output_queue.put((header_file_path, ecg_features, dx))
+            output_queue.put(("completed", header_file_path, ecg_features, dx))
 
 
 def train_12ECG_classifier(
     input_directory,
     output_directory,
     labels_fp="dxs.txt",
-    features_fp="features.csv",
+    features_fp="features.h5",
     weights_file="evaluation-2020/weights.csv",
     early_stopping_rounds=20,
     experiments_to_run=1,  # 1 for challenge, 100 for paper
     evaluation_size=0,  # 0 for challenge, 0.15 for paper
     limit_features_to=1000,
+    feature_cache_fp=None,  # SQLite feature cache shared with inference, None to disable
+    feature_cache_max_bytes=8 * 1024 ** 3,
+    manifest_fp="manifest.jsonl",
+    retry_failed=False,  # re-run records whose feature extraction failed previously
+    fit_durations_fp="fit_durations.json",
+    heartbeat_template="best",  # "hb" features heartbeat, "best", "median" or "mean"
+    signal_resampling="poly",  # "sig" features resampling, "poly" or legacy "fft"
 ):
     logger = configure_logging()
 
     labels_fp = os.path.join(output_directory, labels_fp)
     features_fp = os.path.join(output_directory, features_fp)
+    manifest_fp = os.path.join(output_directory, manifest_fp)
+    fit_durations_fp = os.path.join(output_directory, fit_durations_fp)
     fieldnames = _get_fieldnames()
     fc_parameters = None
+    # saved with the models, so inference extracts features the same way
+    feature_options = {
+        "heartbeat_template": heartbeat_template,
+        "signal_resampling": signal_resampling,
+    }
 
     # HARD CODE IN THE IMPORTANCES RANK!
     importance_data = None
@@ -123,12 +152,12 @@ def train_12ECG_classifier(
 
     logger.info(f"Loading feature extraction result from '{labels_fp}'...")
     # check how many files have been processed already, allows feature extraction to be resumable
-    label_mapped_records = []
+    label_mapped_records = set()
     if os.path.isfile(labels_fp):
         with open(labels_fp, mode="r", newline="\n") as labelfile:
             for line in labelfile.readlines():
                 header_file_path, _ = json.loads(line)
-                label_mapped_records.append(header_file_path)
+                label_mapped_records.add(header_file_path)
         logger.info(f"Loaded {len(label_mapped_records)} from prior run.")
     else:
         logger.info("No labels file found.")
@@ -137,32 +166,50 @@ def train_12ECG_classifier(
             pass
 
     logger.info(f"Loading feature extraction result from '{features_fp}'...")
-    feature_mapped_records = []
+    legacy_features_fp = os.path.splitext(features_fp)[0] + ".csv"
+    if (
+        legacy_features_fp != features_fp
+        and os.path.isfile(legacy_features_fp)
+        and not os.path.isfile(features_fp)
+    ):
+        logger.info(f"Converting '{legacy_features_fp}' to '{features_fp}'...")
+        _convert_features_csv(legacy_features_fp, features_fp)
+
     if os.path.isfile(features_fp):
         # get fieldnames of existing records
-        with open(features_fp, "r", newline="\n") as csvfile:
-            reader = csv.reader(csvfile)
-            fieldnames = next(reader)
-
-        with open(features_fp, "r", newline="\n") as csvfile:
-            reader = csv.DictReader(csvfile, fieldnames=fieldnames)
-            next(reader)  # ignore header
-            with tqdm(reader) as t:
-                for row in t:
-                    feature_mapped_records.append(row["header_file"])
+        feature_store = FeatureStore(features_fp)
+        fieldnames = ["header_file",] + feature_store.fieldnames
     else:
         logger.info("No features file found.")
+        feature_store = FeatureStore(features_fp, fieldnames=fieldnames[1:])
+    feature_mapped_records = set(feature_store.header_files())
+    # reopened after the worker processes are forked
+    feature_store.close()
+
+    logger.info(f"Reconciling resume manifest '{manifest_fp}'...")
+    manifest = ResumeManifest(manifest_fp)
+    num_dropped = manifest.reconcile(label_mapped_records & feature_mapped_records)
+    num_failed = len(manifest.header_files(ResumeManifest.FAILED))
+    logger.info(
+        f"{len(manifest.header_files(ResumeManifest.COMPLETED))} completed, "
+        f"{num_failed} failed, {num_dropped} interrupted records from prior runs."
+    )
+    skip_states = (ResumeManifest.COMPLETED,)
+    if not retry_failed:
+        if num_failed:
+            logger.info(f"Skipping {num_failed} failed records (see retry_failed).")
+        skip_states += (ResumeManifest.FAILED,)
+
+    del label_mapped_records
+    del feature_mapped_records
 
     logger.info(f"Discovering ECG input files in '{input_directory}'...")
     process_header_files = tuple(
         hfp
         for hfp in glob(os.path.join(input_directory, "**/*.hea"), recursive=True)
-        if hfp not in label_mapped_records or hfp not in feature_mapped_records
+        if manifest.state(hfp) not in skip_states
     )
 
-    del label_mapped_records
-    del feature_mapped_records
-
     logger.info(
         "Number of ECG records remain to process: %d", len(process_header_files)
     )
@@ -174,7 +221,7 @@ def train_12ECG_classifier(
     output_queue = multiprocessing.JoinableQueue()
 
     # calculate CPUs used for feature extraction
-    num_cpus = len(os.sched_getaffinity(0))
+    num_cpus = available_cpus()
     logger.info("Number of available CPUs: %d", num_cpus)
 
     total_ram_bytes = psutil.virtual_memory().total
@@ -195,12 +242,24 @@ def train_12ECG_classifier(
         )
         num_cpus = ram_bottleneck_cpus
 
+    feature_cache = None
+    if feature_cache_fp:
+        logger.info(f"Using feature cache '{feature_cache_fp}'")
+        feature_cache = FeatureCache(feature_cache_fp, max_bytes=feature_cache_max_bytes)
+
     num_feature_extractor_procs = max(num_cpus, 1)
     feature_extractor_procs = []
     killed_extractor_procs = []
     for _ in range(num_feature_extractor_procs):
         p = multiprocessing.Process(
-            target=feat_extract_process, args=(input_queue, output_queue, fc_parameters)
+            target=feat_extract_process,
+            args=(
+                input_queue,
+                output_queue,
+                fc_parameters,
+                feature_cache,
+                feature_options,
+            ),
         )
         p.start()
         feature_extractor_procs.append(p)
@@ -211,73 +270,83 @@ def train_12ECG_classifier(
     out_log = None
     avg_records_per_sec = 0
 
-    # initialize the header if the file does not exist
-    if not os.path.isfile(features_fp):
-        with open(features_fp, "w", newline="\n") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-    with open(features_fp, "a", newline="\n") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        with open(labels_fp, "a") as labelfile:
-            while True:
-                try:
-                    header_file_path, f_dict, dxs = output_queue.get(True, 0.1)
+    feature_store = FeatureStore(features_fp)
+    with open(labels_fp, "a") as labelfile:
+        while True:
+            try:
+                status, header_file_path, *result = output_queue.get(True, 0.1)
+                output_queue.task_done()
+                if status == "started":
+                    manifest.mark_in_progress(header_file_path)
+                    continue
+                elif status == "failed":
+                    (error,) = result
+                    logger.warning(f"Failed to process {header_file_path}:\n{error}")
+                    manifest.mark_failed(header_file_path, error)
+                else:
+                    f_dict, dxs = result
+                    # label, then features, both on disk before the record is
+                    # completed. A record interrupted in between is redone
                     labelfile.write(json.dumps((header_file_path, dxs)) + "\n")
                     labelfile.flush()
-                    f_dict["header_file"] = header_file_path
-                    writer.writerow(f_dict)
-                    output_queue.task_done()
-                    processed_files_counter += 1
-                except queue.Empty:
-                    # When the output queue is empty and all workers are terminated
-                    # all files have been processed
-
-                    if input_queue.empty() and all(
-                        not p.is_alive() for p in feature_extractor_procs
-                    ):
-                        # input queue is empty and all children processes have exited
-                        break
-
-                    elif not input_queue.empty():
-                        # input queue is not empty, restart stopped workers
-                        num_feature_extractor_procs = len(feature_extractor_procs)
-                        for fe_proc_idx in range(num_feature_extractor_procs):
-                            p = feature_extractor_procs[fe_proc_idx]
-                            if p in killed_extractor_procs:
-                                continue
-                            if not p.is_alive():
-                                disp_str = (
-                                    f"{p.pid} (exitcode: {p.exitcode}) is not alive "
-                                    f"while input queue contains {input_queue.qsize()} tasks! "
-                                    "Restarting..."
-                                )
-                                logger.info(disp_str)
-                                p.join()
-                                killed_extractor_procs.append(p)
-                                p_new = multiprocessing.Process(
-                                    target=feat_extract_process,
-                                    args=(input_queue, output_queue),
-                                )
-                                p_new.start()
-                                feature_extractor_procs.append(p_new)
-
-                finally:
-                    out_cur = datetime.now()
-                    if out_log is None or out_cur - out_log > timedelta(seconds=5):
-                        start_delta = out_cur - out_start
-
-                        remaining_time, avg_records_per_sec = _eta_calculate(
-                            start_delta,
-                            processed_files_counter,
-                            len(process_header_files),
-                            avg_records_per_sec,
-                        )
-
-                        logger.info(
-                            f"Processed {processed_files_counter}/{len(process_header_files)} in {start_delta} (est {remaining_time} remain)"
-                        )
-                        out_log = out_cur
+                    feature_store.append(header_file_path, f_dict)
+                    manifest.mark_completed(header_file_path)
+                processed_files_counter += 1
+            except queue.Empty:
+                # When the output queue is empty and all workers are terminated
+                # all files have been processed
+
+                if input_queue.empty() and all(
+                    not p.is_alive() for p in feature_extractor_procs
+                ):
+                    # input queue is empty and all children processes have exited
+                    break
+
+                elif not input_queue.empty():
+                    # input queue is not empty, restart stopped workers
+                    num_feature_extractor_procs = len(feature_extractor_procs)
+                    for fe_proc_idx in range(num_feature_extractor_procs):
+                        p = feature_extractor_procs[fe_proc_idx]
+                        if p in killed_extractor_procs:
+                            continue
+                        if not p.is_alive():
+                            disp_str = (
+                                f"{p.pid} (exitcode: {p.exitcode}) is not alive "
+                                f"while input queue contains {input_queue.qsize()} tasks! "
+                                "Restarting..."
+                            )
+                            logger.info(disp_str)
+                            p.join()
+                            killed_extractor_procs.append(p)
+                            p_new = multiprocessing.Process(
+                                target=feat_extract_process,
+                                args=(
+                                    input_queue,
+                                    output_queue,
+                                    fc_parameters,
+                                    feature_cache,
+                                    feature_options,
+                                ),
+                            )
+                            p_new.start()
+                            feature_extractor_procs.append(p_new)
+
+            finally:
+                out_cur = datetime.now()
+                if out_log is None or out_cur - out_log > timedelta(seconds=5):
+                    start_delta = out_cur - out_start
+
+                    remaining_time, avg_records_per_sec = _eta_calculate(
+                        start_delta,
+                        processed_files_counter,
+                        len(process_header_files),
+                        avg_records_per_sec,
+                    )
+
+                    logger.info(
+                        f"Processed {processed_files_counter}/{len(process_header_files)} in {start_delta} (est {remaining_time} remain)"
+                    )
+                    out_log = out_cur
 
     out_cur = datetime.now()
     start_delta = out_cur - out_start
@@ -285,6 +354,8 @@ def train_12ECG_classifier(
         f"Finished processing {processed_files_counter}/{len(process_header_files)} in {start_delta}"
     )
 
+    manifest.close()
+
     # Close the queues
     input_queue.close()
     input_queue.join_thread()
@@ -302,9 +373,8 @@ def train_12ECG_classifier(
             mapped_records[header_file_path] = dxs
 
     logger.info(f"Loading features_df from '{features_fp}'")
-    features_df = pd.read_csv(
-        features_fp, header=0, names=fieldnames, index_col="header_file"
-    )
+    features_df = feature_store.to_dataframe()
+    feature_store.close()
     logger.info("Constructing labels array...")
     labels = [mapped_records[row[0]] for row in features_df.itertuples()]
 
@@ -347,26 +417,25 @@ def train_12ECG_classifier(
                 "train_records": train_features.index.to_list(),
                 "eval_records": eval_features.index.to_list(),
                 "field_names": features_df.columns.to_list(),
+                "feature_options": feature_options,
             }
 
-            for idx_sc, sc in enumerate(scored_codes):
-                _abbrv, dx = SNOMED_CODE_MAP[str(sc)]
-                logger.info(f"Training classifier for {dx} (code {sc})...")
-
-                sc, model = _train_label_classifier(
-                    sc,
-                    idx_sc,
-                    all_weights,
-                    train_features,
-                    train_labels,
-                    eval_features,
-                    eval_labels,
-                    scored_codes,
-                    early_stopping_rounds,
-                    num_gpus,
-                )
-
-                to_save_data[sc] = model
+            trained_models = _train_label_classifiers(
+                logger,
+                all_weights,
+                train_features,
+                train_labels,
+                eval_features,
+                eval_labels,
+                scored_codes,
+                early_stopping_rounds,
+                num_gpus,
+                SNOMED_CODE_MAP,
+                fit_durations_fp,
+            )
+            # keep the scored_codes order, it determines the output class order
+            for sc in scored_codes:
+                to_save_data[sc] = trained_models[sc]
 
             if eval_labels:
                 _display_metrics(logger, eval_features, eval_labels, to_save_data)
@@ -378,6 +447,30 @@ def train_12ECG_classifier(
         logger.info(f"Experiment {experiment_num} took {timer.duration:.2f} seconds")
 
 
+def _convert_features_csv(csv_fp, store_fp):
+    """Copy a features.csv from an earlier run into a FeatureStore"""
+    with open(csv_fp, "r", newline="\n") as csvfile:
+        fieldnames = next(csv.reader(csvfile))
+
+    # written in chunks, only replaces store_fp once complete
+    tmp_store_fp = f"{store_fp}.tmp"
+    if os.path.exists(tmp_store_fp):
+        os.remove(tmp_store_fp)
+    store_fieldnames = [f for f in fieldnames if f != "header_file"]
+    with FeatureStore(
+        tmp_store_fp, fieldnames=store_fieldnames, buffer_rows=256
+    ) as feature_store:
+        for chunk in pd.read_csv(
+            csv_fp,
+            index_col="header_file",
+            chunksize=feature_store.buffer_rows,
+            float_precision="round_trip",
+        ):
+            for header_file, row in zip(chunk.index, chunk.to_dict("records")):
+                feature_store.append(header_file, row)
+    os.replace(tmp_store_fp, store_fp)
+
+
 def _eta_calculate(
     start_delta,
     processed_files_counter,
@@ -399,9 +492,8 @@ def _eta_calculate(
     return timedelta(seconds=remaining_seconds_estimate), avg_records_per_sec
 
 
-def _train_label_classifier(
-    sc,
-    idx_sc,
+def _train_label_classifiers(
+    logger,
     all_weights,
     train_features,
     train_labels,
@@ -410,19 +502,80 @@ def _train_label_classifier(
     scored_codes,
     early_stopping_rounds,
     num_gpus,
+    snomed_code_map,
+    fit_durations_fp,
 ):
-    label_weights = all_weights[idx_sc]
+    """Train one classifier per scored code, one after another on a single training
+    and evaluation DMatrix. Only the labels and weights differ between classes, they
+    are swapped on the shared DMatrix between fits, and every fit uses all available
+    cores as xgboost threads.
+    Returns a dict of scored code to model.
+    """
+    n_jobs = available_cpus()
+
+    fit_durations = {}
+    if os.path.isfile(fit_durations_fp):
+        with open(fit_durations_fp) as f:
+            fit_durations = json.load(f)
+
+    # labels and sample weights of every class, shape (num_records, num_classes)
     train_labels, train_weights = _determine_sample_weights(
-        train_labels, scored_codes, label_weights
+        train_labels, scored_codes, all_weights
     )
-
     if eval_labels:
         eval_labels, eval_weights = _determine_sample_weights(
-            eval_labels, scored_codes, label_weights
+            eval_labels, scored_codes, all_weights
+        )
+    else:
+        eval_labels, eval_weights = None, None
+
+    train_dmatrix, eval_dmatrix = _build_dmatrices(
+        train_features, eval_features, n_jobs
+    )
+
+    logger.info(
+        f"Training {len(scored_codes)} classifiers with {n_jobs} threads each..."
+    )
+    trained_models = {}
+    for idx_sc, sc in enumerate(scored_codes):
+        with ElapsedTimer() as timer:
+            model = _fit_label_classifier(
+                train_dmatrix,
+                train_labels[:, idx_sc],
+                train_weights[:, idx_sc],
+                eval_dmatrix,
+                None if eval_labels is None else eval_labels[:, idx_sc],
+                None if eval_weights is None else eval_weights[:, idx_sc],
+                early_stopping_rounds,
+                num_gpus,
+                n_jobs,
+            )
+        _abbrv, dx = snomed_code_map[str(sc)]
+        logger.info(
+            f"Trained classifier for {dx} (code {sc}) in {timer.duration:.2f} seconds"
         )
+        trained_models[sc] = model
+        fit_durations[sc] = timer.duration
+
+    with open(fit_durations_fp, "w") as f:
+        json.dump(fit_durations, f)
+
+    return trained_models
 
+
+def _fit_label_classifier(
+    train_dmatrix,
+    train_labels,
+    train_weights,
+    eval_dmatrix,
+    eval_labels,
+    eval_weights,
+    early_stopping_rounds,
+    num_gpus,
+    n_jobs,
+):
     # try negative over positive https://machinelearningmastery.com/xgboost-for-imbalanced-classification/
-    pos_count = len([e for e in train_labels if e])
+    pos_count = int(np.count_nonzero(train_labels))
     pos_count = max(pos_count, 1)
     scale_pos_weight = (len(train_labels) - pos_count) / pos_count
 
@@ -432,61 +585,83 @@ def _train_label_classifier(
         tree_method = "gpu_hist"
         sampling_method = "gradient_based"
 
-    model = XGBClassifier(
-        booster="dart",  # gbtree, dart or gblinear
-        verbosity=0,
-        tree_method=tree_method,
-        sampling_method=sampling_method,
-        scale_pos_weight=scale_pos_weight,
-    )
-
-    eval_set = [
-        (train_features, train_labels),
-    ]
-    sample_weight_eval_set = [
-        train_weights,
+    params = {
+        "objective": "binary:logistic",
+        "booster": "dart",  # gbtree, dart or gblinear
+        "verbosity": 0,
+        "tree_method": tree_method,
+        "sampling_method": sampling_method,
+        "scale_pos_weight": scale_pos_weight,
+        "random_state": 0,
+        "n_jobs": n_jobs,
+    }
+
+    classes = np.unique(train_labels)
+    train_dmatrix.set_label(np.searchsorted(classes, train_labels))
+    train_dmatrix.set_weight(train_weights)
+
+    evals = [
+        (train_dmatrix, "validation_0"),
     ]
-    if eval_labels:
-        eval_set.append((eval_features, eval_labels))
-        sample_weight_eval_set.append(eval_weights)
-
-    model = model.fit(
-        train_features,
-        train_labels,
-        sample_weight=train_weights,
-        eval_set=eval_set,
-        sample_weight_eval_set=sample_weight_eval_set,
+    if eval_labels is not None:
+        eval_dmatrix.set_label(np.searchsorted(classes, eval_labels))
+        eval_dmatrix.set_weight(eval_weights)
+        evals.append((eval_dmatrix, "validation_1"))
+
+    booster = xgb.train(
+        params,
+        train_dmatrix,
+        num_boost_round=100,
+        evals=evals,
         early_stopping_rounds=early_stopping_rounds,
-        verbose=False,
+        verbose_eval=False,
     )
 
-    return sc, model
+    return BoosterClassifier(booster, classes, n_jobs=n_jobs)
+
+
+def _build_dmatrices(train_features, eval_features, n_jobs):
+    """The training and evaluation DMatrix, None without evaluation features"""
+    train_dmatrix = xgb.DMatrix(train_features, missing=np.nan, nthread=n_jobs)
+    eval_dmatrix = None
+    if len(eval_features):
+        eval_dmatrix = xgb.DMatrix(eval_features, missing=np.nan, nthread=n_jobs)
+    return train_dmatrix, eval_dmatrix
 
 
 def _determine_sample_weights(
-    data_set, scored_codes, label_weights, weight_threshold=0.5
+    data_set, scored_codes, all_weights, weight_threshold=0.5
 ):
-    """Using the scoring labels weights to increase the dataset size of positive labels
+    """Using the scoring labels weights to increase the dataset size of positive labels.
+    A record is a positive example of a class when one of its diagnoses has a scoring
+    weight against that class of at least weight_threshold, and is weighted by the
+    largest such weight. Negative examples have a weight of 1.
+    Returns (labels, weights) arrays of shape (num_records, num_classes)
     """
-    data_labels = []
-    sample_weights = []
-    for dt in data_set:
-        sample_weight = None
+    code_idx = dict((str(sc), i) for i, sc in enumerate(scored_codes))
+
+    # multi-hot encoding of the scored diagnoses as (record, code) coordinates
+    rows = []
+    cols = []
+    for idx_dt, dt in enumerate(data_set):
         for dx in dt:
-            if str(dx) in scored_codes:
-                _sample_weight = label_weights[scored_codes.index(str(dx))]
-                if _sample_weight < weight_threshold:
-                    continue
-                if sample_weight is None or _sample_weight > sample_weight:
-                    sample_weight = _sample_weight
-
-        if sample_weight is None:
-            # not a scored label, treat as a negative example (weight of 1)
-            sample_weight = 1.0
-            data_labels.append(False)
-        else:
-            data_labels.append(True)
-        sample_weights.append(sample_weight)
+            idx_dx = code_idx.get(str(dx))
+            if idx_dx is not None:
+                rows.append(idx_dt)
+                cols.append(idx_dx)
+
+    # weight of diagnosis (row) against class (col), below threshold ignored
+    all_weights = np.asarray(all_weights, dtype=np.float64)
+    dx_class_weights = np.where(
+        all_weights >= weight_threshold, all_weights, -np.inf
+    ).T
+
+    sample_weights = np.full((len(data_set), len(scored_codes)), -np.inf)
+    np.maximum.at(sample_weights, np.array(rows, dtype=int), dx_class_weights[cols])
+
+    data_labels = sample_weights > -np.inf
+    # not a scored label, treat as a negative example (weight of 1)
+    sample_weights[~data_labels] = 1.0
     return data_labels, sample_weights
 
 
@@ -546,7 +721,7 @@ def _save_experiment(logger, output_directory, to_save_data):
     logger.info("Saving model...")
 
     cur_sec = int(time())
-    filename = os.path.join(output_directory, f"finalized_model_{cur_sec}.sav")
-    joblib.dump(to_save_data, filename, protocol=0)
+    filename = os.path.join(output_directory, f"finalized_model_{cur_sec}")
+    save_model_bundle(filename, to_save_data)
 
     logger.info(f"Saved to {filename}")
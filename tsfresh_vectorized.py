@@ -0,0 +1,833 @@
+"""NumPy implementation of the tsfresh feature calculators.
+
+tsfresh.extract_features melts every series into a long format DataFrame,
+groups it by id and kind, and calls each feature calculator once per series.
+Here the calculators run directly on a (series x samples) array, one call for
+all series of the same length, e.g. the 12 leads of a record.
+
+Values and column names follow tsfresh 0.16. Calculators without a vectorized
+implementation below fall back to calling the tsfresh calculator per series.
+"""
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+from statsmodels.compat.scipy import _next_regular
+from tsfresh.feature_extraction import ComprehensiveFCParameters, feature_calculators
+from tsfresh.utilities.string_manipulation import convert_to_output_format
+
+# name -> vectorized calculator, (series x samples) array to one value per series
+_SIMPLE_CALCULATORS = {}
+# name -> vectorized calculator, (series x samples) array and list of parameters
+# to a list of (key, one value per series), in the order of the parameters
+_COMBINER_CALCULATORS = {}
+
+
+def _simple(f):
+    _SIMPLE_CALCULATORS[f.__name__] = f
+    return f
+
+
+def _combiner(f):
+    _COMBINER_CALCULATORS[f.__name__] = f
+    return f
+
+
+def extract_features(
+    series, kinds, default_fc_parameters=None, kind_to_fc_parameters=None, ids=None
+):
+    """Drop in replacement of tsfresh.extract_features.
+
+    series: (samples x kinds) array, or a sequence of one 1-D array per kind
+        when the series differ in length
+    kinds: name of each series, used as the feature name prefix
+    default_fc_parameters: tsfresh fc_parameters of kinds missing from
+        kind_to_fc_parameters, defaults to ComprehensiveFCParameters
+    ids: id of each series, e.g. the record, defaults to a single id 0
+
+    Returns a DataFrame with one row per id, like tsfresh.extract_features
+    """
+    if isinstance(series, np.ndarray) and series.ndim == 2:
+        series = series.T
+    series = [np.asarray(s, dtype=np.float64) for s in series]
+    if ids is None:
+        ids = [0] * len(series)
+    if not len(series) == len(kinds) == len(ids):
+        raise ValueError(
+            f"got {len(series)} series for {len(kinds)} kinds and {len(ids)} ids"
+        )
+    if any(np.isnan(s).any() for s in series):
+        raise ValueError("Column must not contain NaN values")
+
+    if default_fc_parameters is None:
+        default_fc_parameters = ComprehensiveFCParameters()
+
+    by_length = defaultdict(list)
+    for sample_id, kind, s in zip(ids, kinds, series):
+        if len(s) == 0:
+            continue
+        if kind_to_fc_parameters and kind in kind_to_fc_parameters:
+            fc_parameters = kind_to_fc_parameters[kind]
+        else:
+            fc_parameters = default_fc_parameters
+        by_length[len(s)].append((sample_id, kind, s, fc_parameters))
+
+    features = defaultdict(dict)
+    for group in by_length.values():
+        for sample_id, feature_name, value in _extract_group(group):
+            features[sample_id][feature_name] = value
+
+    columns = sorted(set().union(*features.values()))
+    if not columns:
+        return pd.DataFrame()
+
+    # features an id does not have are nan, as in the pivot tsfresh does
+    index = sorted(features)
+    feature_df = pd.DataFrame(
+        np.array(
+            [[features[i].get(c, np.nan) for c in columns] for i in index],
+            dtype=np.float64,
+        ),
+        index=pd.Index(index, name="id"),
+        columns=pd.Index(columns, name="variable"),
+    )
+    return feature_df
+
+
+def _extract_group(group):
+    """Features of a list of (id, kind, series, fc_parameters), all series of one length.
+    Yields (id, feature name, value).
+    """
+    xt = np.stack([s for _, _, s, _ in group])
+
+    # rows of xt that use each calculator, and the union of their parameters
+    calculator_rows = defaultdict(list)
+    calculator_params = defaultdict(dict)
+    for row, (_, _, _, fc_parameters) in enumerate(group):
+        for name, param_list in fc_parameters.items():
+            calculator_rows[name].append(row)
+            for param in param_list or ():
+                calculator_params[name][convert_to_output_format(param)] = param
+
+    for name, rows in calculator_rows.items():
+        params = calculator_params[name]
+        if name in _SIMPLE_CALCULATORS:
+            func = _SIMPLE_CALCULATORS[name]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                if params:
+                    results = {
+                        param_key: (param_key, func(xt[rows], **param))
+                        for param_key, param in params.items()
+                    }
+                else:
+                    results = {None: ("", func(xt[rows]))}
+        elif name in _COMBINER_CALCULATORS:
+            param_keys = list(params)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                combined = _COMBINER_CALCULATORS[name](
+                    xt[rows], [params[k] for k in param_keys]
+                )
+            results = dict(zip(param_keys, combined))
+        else:
+            yield from _extract_fallback(name, [group[row] for row in rows])
+            continue
+
+        for i, row in enumerate(rows):
+            sample_id, kind, _, fc_parameters = group[row]
+            param_list = fc_parameters[name]
+            if param_list:
+                param_keys = [convert_to_output_format(p) for p in param_list]
+            else:
+                param_keys = [None]
+            for param_key in param_keys:
+                key, values = results[param_key]
+                feature_name = f"{kind}__{name}"
+                if key:
+                    feature_name += f"__{key}"
+                yield sample_id, feature_name, values[i]
+
+
+def _extract_fallback(name, group):
+    """Calls the tsfresh calculator on each series, as tsfresh does"""
+    func = getattr(feature_calculators, name)
+    for sample_id, kind, s, fc_parameters in group:
+        param_list = fc_parameters[name]
+        if getattr(func, "input", False) == "pd.Series":
+            x = pd.Series(s)
+            index_type = getattr(func, "index_type", None)
+            if index_type is not None and not isinstance(x.index, index_type):
+                # tsfresh skips these with a warning
+                continue
+        else:
+            x = s
+
+        if func.fctype == "combiner":
+            result = func(x, param=param_list)
+        elif param_list:
+            result = [(convert_to_output_format(p), func(x, **p)) for p in param_list]
+        else:
+            result = [("", func(x))]
+
+        for key, value in result:
+            feature_name = f"{kind}__{name}"
+            if key:
+                feature_name += f"__{key}"
+            yield sample_id, feature_name, value
+
+
+def _linregress(y):
+    """scipy.stats.linregress(range(n), y) of each row of y"""
+    n = y.shape[1]
+    x = np.arange(n, dtype=np.float64)
+    xmean = np.mean(x)
+    ymean = np.mean(y, axis=1)
+    xm = x - xmean
+    ym = y - ymean[:, None]
+    ssxm = np.dot(xm, xm) / n
+    # not np.dot, so each row is summed the same however many rows there are
+    ssxym = np.sum(ym * xm, axis=1) / n
+    ssym = np.einsum("ij,ij->i", ym, ym) / n
+
+    r_num = ssxym
+    r_den = np.sqrt(ssxm * ssym)
+    r = np.where(r_den == 0.0, 0.0, r_num / r_den)
+    r = np.clip(r, -1.0, 1.0)
+
+    df = n - 2
+    slope = r_num / ssxm
+    intercept = ymean - slope * xmean
+    if n == 2:
+        pvalue = np.where(y[:, 0] == y[:, 1], 1.0, 0.0)
+        stderr = np.zeros(len(y))
+    else:
+        TINY = 1.0e-20
+        t = r * np.sqrt(df / ((1.0 - r + TINY) * (1.0 + r + TINY)))
+        pvalue = 2 * scipy.stats.t.sf(np.abs(t), df)
+        stderr = np.sqrt((1 - r ** 2) * ssym / ssxm / df)
+    return {
+        "slope": slope,
+        "intercept": intercept,
+        "rvalue": r,
+        "pvalue": pvalue,
+        "stderr": stderr,
+    }
+
+
+def _acf(xt, nlags):
+    """statsmodels acf(x, unbiased=True, nlags=nlags) of each row, fft for long series"""
+    n = xt.shape[1]
+    nlags = min(nlags, n - 1)
+    xo = xt - np.mean(xt, axis=1)[:, None]
+    if n > 1250:
+        Frf = np.fft.fft(xo, n=_next_regular(2 * n + 1), axis=1)
+        acov = np.fft.ifft(Frf * np.conjugate(Frf), axis=1)[:, : nlags + 1].real
+    else:
+        acov = np.stack(
+            [
+                np.einsum("ij,ij->i", xo[:, lag:], xo[:, : n - lag])
+                for lag in range(nlags + 1)
+            ],
+            axis=1,
+        )
+    acov /= n - np.arange(acov.shape[1])
+    return acov / acov[:, :1]
+
+
+def _sorted_quantile(sorted_xt, q):
+    """pandas quantile of sorted rows, as pd.qcut computes its bins"""
+    idx = q * (sorted_xt.shape[1] - 1)
+    if idx % 1 == 0:
+        return sorted_xt[:, int(idx)]
+    below = sorted_xt[:, int(idx)]
+    return below + (sorted_xt[:, int(idx) + 1] - below) * (idx % 1)
+
+
+def _reoccurring(xt):
+    """Sorted rows, with masks of the first of each unique value and of values seen more than once"""
+    s = np.sort(xt, axis=1)
+    same_as_next = s[:, 1:] == s[:, :-1]
+    first = np.ones(s.shape, dtype=bool)
+    first[:, 1:] = ~same_as_next
+    reoccurring = np.zeros(s.shape, dtype=bool)
+    reoccurring[:, :-1] |= same_as_next
+    reoccurring[:, 1:] |= same_as_next
+    return s, first, reoccurring
+
+
+def _longest_strike(mask):
+    """Length of the longest run of True in each row"""
+    counts = np.cumsum(mask, axis=1)
+    run_starts = np.maximum.accumulate(np.where(mask, 0, counts), axis=1)
+    return np.max(counts - run_starts, axis=1)
+
+
+@_simple
+def variance_larger_than_standard_deviation(xt):
+    y = np.var(xt, axis=1)
+    return y > np.sqrt(y)
+
+
+@_simple
+def ratio_beyond_r_sigma(xt, r):
+    deviation = np.abs(xt - np.mean(xt, axis=1)[:, None])
+    return np.sum(deviation > r * np.std(xt, axis=1)[:, None], axis=1) / xt.shape[1]
+
+
+@_simple
+def large_standard_deviation(xt, r):
+    return np.std(xt, axis=1) > (r * (np.max(xt, axis=1) - np.min(xt, axis=1)))
+
+
+@_combiner
+def symmetry_looking(xt, param):
+    mean_median_difference = np.abs(np.mean(xt, axis=1) - np.median(xt, axis=1))
+    max_min_difference = np.max(xt, axis=1) - np.min(xt, axis=1)
+    return [
+        (f"r_{r['r']}", mean_median_difference < (r["r"] * max_min_difference))
+        for r in param
+    ]
+
+
+@_simple
+def has_duplicate_max(xt):
+    return np.sum(xt == np.max(xt, axis=1)[:, None], axis=1) >= 2
+
+
+@_simple
+def has_duplicate_min(xt):
+    return np.sum(xt == np.min(xt, axis=1)[:, None], axis=1) >= 2
+
+
+@_simple
+def has_duplicate(xt):
+    s = np.sort(xt, axis=1)
+    return np.any(s[:, 1:] == s[:, :-1], axis=1)
+
+
+@_simple
+def sum_values(xt):
+    return np.sum(xt, axis=1)
+
+
+@_combiner
+def agg_autocorrelation(xt, param):
+    max_maxlag = max(config["maxlag"] for config in param)
+    if xt.shape[1] == 1:
+        a = np.zeros((len(xt), 1))
+    else:
+        a = _acf(xt, max_maxlag)[:, 1:]
+        # constant series have no autocorrelation
+        a[np.abs(np.var(xt, axis=1)) < 10 ** -10] = 0
+    return [
+        (
+            f'f_agg_"{config["f_agg"]}"__maxlag_{config["maxlag"]}',
+            getattr(np, config["f_agg"])(a[:, : int(config["maxlag"])], axis=1),
+        )
+        for config in param
+    ]
+
+
+@_simple
+def abs_energy(xt):
+    return np.einsum("ij,ij->i", xt, xt)
+
+
+@_simple
+def cid_ce(xt, normalize):
+    if normalize:
+        s = np.std(xt, axis=1)[:, None]
+        # constant series are 0
+        xt = np.where(s != 0, (xt - np.mean(xt, axis=1)[:, None]) / s, 0.0)
+    d = np.diff(xt, axis=1)
+    return np.sqrt(np.einsum("ij,ij->i", d, d))
+
+
+@_simple
+def mean_abs_change(xt):
+    return np.mean(np.abs(np.diff(xt, axis=1)), axis=1)
+
+
+@_simple
+def mean_change(xt):
+    n = xt.shape[1]
+    if n <= 1:
+        return np.full(len(xt), np.nan)
+    return (xt[:, -1] - xt[:, 0]) / (n - 1)
+
+
+@_simple
+def mean_second_derivative_central(xt):
+    n = xt.shape[1]
+    if n <= 2:
+        return np.full(len(xt), np.nan)
+    return (xt[:, -1] - xt[:, -2] - xt[:, 1] + xt[:, 0]) / (2 * (n - 2))
+
+
+@_simple
+def median(xt):
+    return np.median(xt, axis=1)
+
+
+@_simple
+def mean(xt):
+    return np.mean(xt, axis=1)
+
+
+@_simple
+def length(xt):
+    return np.full(len(xt), xt.shape[1])
+
+
+@_simple
+def standard_deviation(xt):
+    return np.std(xt, axis=1)
+
+
+@_simple
+def variation_coefficient(xt):
+    m = np.mean(xt, axis=1)
+    return np.where(m != 0, np.std(xt, axis=1) / m, np.nan)
+
+
+@_simple
+def variance(xt):
+    return np.var(xt, axis=1)
+
+
+def _zero_out_fperr(a):
+    # pandas nanops treats moments this small as floating point error
+    return np.where(np.abs(a) < 1e-14, 0, a)
+
+
+def _central_moment_sums(xt):
+    adjusted = xt - (np.sum(xt, axis=1) / xt.shape[1])[:, None]
+    adjusted2 = adjusted ** 2
+    return adjusted, adjusted2
+
+
+@_simple
+def skewness(xt):
+    # pd.Series.skew
+    count = np.float64(xt.shape[1])
+    adjusted, adjusted2 = _central_moment_sums(xt)
+    m2 = _zero_out_fperr(np.sum(adjusted2, axis=1))
+    m3 = _zero_out_fperr(np.sum(adjusted2 * adjusted, axis=1))
+    result = (count * (count - 1) ** 0.5 / (count - 2)) * (m3 / m2 ** 1.5)
+    result = np.where(m2 == 0, 0, result)
+    if count < 3:
+        result[:] = np.nan
+    return result
+
+
+@_simple
+def kurtosis(xt):
+    # pd.Series.kurtosis
+    count = np.float64(xt.shape[1])
+    _, adjusted2 = _central_moment_sums(xt)
+    adjusted4 = adjusted2 ** 2
+    m2 = np.sum(adjusted2, axis=1)
+    m4 = np.sum(adjusted4, axis=1)
+
+    adj = 3 * (count - 1) ** 2 / ((count - 2) * (count - 3))
+    numer = count * (count + 1) * (count - 1) * m4
+    denom = (count - 2) * (count - 3) * m2 ** 2
+
+    numer = _zero_out_fperr(numer)
+    denom = _zero_out_fperr(denom)
+    result = np.where(denom == 0, 0, numer / denom - adj)
+    if count < 4:
+        result[:] = np.nan
+    return result
+
+
+@_simple
+def absolute_sum_of_changes(xt):
+    return np.sum(np.abs(np.diff(xt, axis=1)), axis=1)
+
+
+@_simple
+def longest_strike_below_mean(xt):
+    return _longest_strike(xt < np.mean(xt, axis=1)[:, None])
+
+
+@_simple
+def longest_strike_above_mean(xt):
+    return _longest_strike(xt > np.mean(xt, axis=1)[:, None])
+
+
+@_simple
+def count_above_mean(xt):
+    return np.sum(xt > np.mean(xt, axis=1)[:, None], axis=1)
+
+
+@_simple
+def count_below_mean(xt):
+    return np.sum(xt < np.mean(xt, axis=1)[:, None], axis=1)
+
+
+@_simple
+def last_location_of_maximum(xt):
+    return 1.0 - np.argmax(xt[:, ::-1], axis=1) / xt.shape[1]
+
+
+@_simple
+def first_location_of_maximum(xt):
+    return np.argmax(xt, axis=1) / xt.shape[1]
+
+
+@_simple
+def last_location_of_minimum(xt):
+    return 1.0 - np.argmin(xt[:, ::-1], axis=1) / xt.shape[1]
+
+
+@_simple
+def first_location_of_minimum(xt):
+    return np.argmin(xt, axis=1) / xt.shape[1]
+
+
+@_simple
+def percentage_of_reoccurring_datapoints_to_all_datapoints(xt):
+    _, first, reoccurring = _reoccurring(xt)
+    return np.sum(first & reoccurring, axis=1) / np.sum(first, axis=1)
+
+
+@_simple
+def percentage_of_reoccurring_values_to_all_values(xt):
+    _, _, reoccurring = _reoccurring(xt)
+    return np.sum(reoccurring, axis=1) / xt.shape[1]
+
+
+@_simple
+def sum_of_reoccurring_values(xt):
+    s, first, reoccurring = _reoccurring(xt)
+    return np.sum(np.where(first & reoccurring, s, 0), axis=1)
+
+
+@_simple
+def sum_of_reoccurring_data_points(xt):
+    s, _, reoccurring = _reoccurring(xt)
+    return np.sum(np.where(reoccurring, s, 0), axis=1)
+
+
+@_simple
+def ratio_value_number_to_time_series_length(xt):
+    _, first, _ = _reoccurring(xt)
+    return np.sum(first, axis=1) / xt.shape[1]
+
+
+@_combiner
+def fft_coefficient(xt, param):
+    assert (
+        min([config["coeff"] for config in param]) >= 0
+    ), "Coefficients must be positive or zero."
+    assert {config["attr"] for config in param} <= {
+        "imag",
+        "real",
+        "abs",
+        "angle",
+    }, 'Attribute must be "real", "imag", "angle" or "abs"'
+
+    fft = np.fft.rfft(xt, axis=1)
+
+    def complex_agg(x, agg):
+        if agg == "real":
+            return x.real
+        elif agg == "imag":
+            return x.imag
+        elif agg == "abs":
+            return np.abs(x)
+        elif agg == "angle":
+            return np.angle(x, deg=True)
+
+    return [
+        (
+            f'attr_"{config["attr"]}"__coeff_{config["coeff"]}',
+            complex_agg(fft[:, config["coeff"]], config["attr"])
+            if config["coeff"] < fft.shape[1]
+            else np.full(len(xt), np.nan),
+        )
+        for config in param
+    ]
+
+
+@_combiner
+def fft_aggregated(xt, param):
+    assert {config["aggtype"] for config in param} <= {
+        "centroid",
+        "variance",
+        "skew",
+        "kurtosis",
+    }, 'Attribute must be "centroid", "variance", "skew", "kurtosis"'
+
+    fft_abs = np.abs(np.fft.rfft(xt, axis=1))
+    index = np.arange(fft_abs.shape[1], dtype=float)
+    total = np.sum(fft_abs, axis=1)
+    moments = [None] + [
+        np.sum(fft_abs * index ** moment, axis=1) / total for moment in range(1, 5)
+    ]
+    centroid = moments[1]
+    variance = moments[2] - centroid ** 2
+
+    calculation = {
+        "centroid": centroid,
+        "variance": variance,
+        "skew": np.where(
+            variance < 0.5,
+            np.nan,
+            (moments[3] - 3 * centroid * variance - centroid ** 3) / variance ** 1.5,
+        ),
+        "kurtosis": np.where(
+            variance < 0.5,
+            np.nan,
+            (
+                moments[4]
+                - 4 * centroid * moments[3]
+                + 6 * moments[2] * centroid ** 2
+                - 3 * centroid
+            )
+            / variance ** 2,
+        ),
+    }
+    return [
+        (f'aggtype_"{config["aggtype"]}"', calculation[config["aggtype"]])
+        for config in param
+    ]
+
+
+@_simple
+def number_peaks(xt, n):
+    x_reduced = xt[:, n:-n]
+    res = None
+    for i in range(1, n + 1):
+        result_first = x_reduced > np.roll(xt, i, axis=1)[:, n:-n]
+        if res is None:
+            res = result_first
+        else:
+            res &= result_first
+        res &= x_reduced > np.roll(xt, -i, axis=1)[:, n:-n]
+    return np.sum(res, axis=1)
+
+
+@_combiner
+def index_mass_quantile(xt, param):
+    abs_x = np.abs(xt)
+    s = np.sum(abs_x, axis=1)
+    mass_centralized = np.cumsum(abs_x, axis=1) / s[:, None]
+    return [
+        (
+            f"q_{config['q']}",
+            np.where(
+                s == 0,
+                np.nan,
+                (np.argmax(mass_centralized >= config["q"], axis=1) + 1) / xt.shape[1],
+            ),
+        )
+        for config in param
+    ]
+
+
+@_combiner
+def linear_trend(xt, param):
+    lin_reg = _linregress(xt)
+    return [(f'attr_"{config["attr"]}"', lin_reg[config["attr"]]) for config in param]
+
+
+@_simple
+def change_quantiles(xt, ql, qh, isabs, f_agg):
+    if ql >= qh:
+        return np.zeros(len(xt))
+
+    div = np.diff(xt, axis=1)
+    if isabs:
+        div = np.abs(div)
+
+    # pd.qcut(x, [ql, qh], labels=False) == 0
+    s = np.sort(xt, axis=1)
+    q_low = _sorted_quantile(s, ql)[:, None]
+    q_high = _sorted_quantile(s, qh)[:, None]
+    bin_cat_0 = (xt >= q_low) & (xt <= q_high)
+    ind = (bin_cat_0 & np.roll(bin_cat_0, 1, axis=1))[:, 1:]
+    count = np.sum(ind, axis=1)
+
+    if f_agg in ("mean", "var", "std"):
+        agg_mean = np.sum(np.where(ind, div, 0), axis=1) / count
+        if f_agg == "mean":
+            result = agg_mean
+        else:
+            result = (
+                np.sum(np.where(ind, (div - agg_mean[:, None]) ** 2, 0), axis=1)
+                / count
+            )
+            if f_agg == "std":
+                result = np.sqrt(result)
+    else:
+        aggregator = getattr(np, f_agg)
+        result = np.array(
+            [aggregator(d[i]) if i.any() else 0 for d, i in zip(div, ind)]
+        )
+
+    # qcut raises when ql and qh are effectively equal, e.g. too categorical
+    return np.where((count == 0) | (q_low[:, 0] == q_high[:, 0]), 0, result)
+
+
+@_simple
+def time_reversal_asymmetry_statistic(xt, lag):
+    n = xt.shape[1]
+    if 2 * lag >= n:
+        return np.zeros(len(xt))
+    num_products = n - 2 * lag
+    one_lag = np.roll(xt, -lag, axis=1)
+    two_lag = np.roll(xt, 2 * -lag, axis=1)
+    return np.mean(
+        (two_lag * two_lag * one_lag - one_lag * xt * xt)[:, :num_products], axis=1
+    )
+
+
+@_simple
+def c3(xt, lag):
+    n = xt.shape[1]
+    if 2 * lag >= n:
+        return np.zeros(len(xt))
+    num_products = n - 2 * lag
+    return np.mean(
+        (np.roll(xt, 2 * -lag, axis=1) * np.roll(xt, -lag, axis=1) * xt)[
+            :, :num_products
+        ],
+        axis=1,
+    )
+
+
+@_simple
+def binned_entropy(xt, max_bins):
+    # np.histogram(x, bins=max_bins) of each row
+    first_edge = np.min(xt, axis=1)
+    last_edge = np.max(xt, axis=1)
+    constant = first_edge == last_edge
+    first_edge = np.where(constant, first_edge - 0.5, first_edge)
+    last_edge = np.where(constant, last_edge + 0.5, last_edge)
+    bin_edges = np.linspace(first_edge, last_edge, max_bins + 1, axis=1)
+
+    norm = max_bins / (last_edge - first_edge)
+    indices = ((xt - first_edge[:, None]) * norm[:, None]).astype(np.intp)
+    indices[indices == max_bins] -= 1
+    indices[xt < np.take_along_axis(bin_edges, indices, axis=1)] -= 1
+    increment = (xt >= np.take_along_axis(bin_edges, indices + 1, axis=1)) & (
+        indices != max_bins - 1
+    )
+    indices[increment] += 1
+
+    rows = np.arange(len(xt))[:, None]
+    hist = np.bincount(
+        (rows * max_bins + indices).ravel(), minlength=len(xt) * max_bins
+    ).reshape(len(xt), max_bins)
+
+    probs = hist / xt.shape[1]
+    probs[probs == 0] = 1.0
+    return -np.sum(probs * np.log(probs), axis=1)
+
+
+@_simple
+def autocorrelation(xt, lag):
+    n = xt.shape[1]
+    if n < lag:
+        return np.full(len(xt), np.nan)
+    x_mean = np.mean(xt, axis=1)[:, None]
+    sum_product = np.sum((xt[:, : (n - lag)] - x_mean) * (xt[:, lag:] - x_mean), axis=1)
+    v = np.var(xt, axis=1)
+    return np.where(np.isclose(v, 0), np.nan, sum_product / ((n - lag) * v))
+
+
+@_simple
+def quantile(xt, q):
+    return np.quantile(xt, q, axis=1)
+
+
+@_simple
+def number_crossing_m(xt, m):
+    positive = xt > m
+    return np.sum(positive[:, 1:] != positive[:, :-1], axis=1)
+
+
+@_simple
+def maximum(xt):
+    return np.max(xt, axis=1)
+
+
+@_simple
+def minimum(xt):
+    return np.min(xt, axis=1)
+
+
+@_simple
+def value_count(xt, value):
+    if np.isnan(value):
+        return np.sum(np.isnan(xt), axis=1)
+    return np.sum(xt == value, axis=1)
+
+
+@_simple
+def range_count(xt, min, max):
+    return np.sum((xt >= min) & (xt < max), axis=1)
+
+
+@_combiner
+def agg_linear_trend(xt, param):
+    n = xt.shape[1]
+    calculated_agg = {}
+    res = []
+    for config in param:
+        chunk_len = config["chunk_len"]
+        f_agg = config["f_agg"]
+        attr = config["attr"]
+        key = f'attr_"{attr}"__chunk_len_{chunk_len}__f_agg_"{f_agg}"'
+        if chunk_len >= n:
+            res.append((key, np.full(len(xt), np.nan)))
+            continue
+
+        if (f_agg, chunk_len) not in calculated_agg:
+            # pad the last chunk with nan, ignored by the nan aggregations
+            num_chunks = int(np.ceil(n / chunk_len))
+            chunks = np.pad(
+                xt,
+                ((0, 0), (0, num_chunks * chunk_len - n)),
+                constant_values=np.nan,
+            ).reshape(len(xt), num_chunks, chunk_len)
+            aggregated = getattr(np, f"nan{f_agg}")(chunks, axis=2)
+            calculated_agg[(f_agg, chunk_len)] = _linregress(aggregated)
+        res.append((key, calculated_agg[(f_agg, chunk_len)][attr]))
+    return res
+
+
+@_combiner
+def energy_ratio_by_chunks(xt, param):
+    full_series_energy = np.sum(xt ** 2, axis=1)
+    res = []
+    for config in param:
+        num_segments = config["num_segments"]
+        segment_focus = config["segment_focus"]
+        assert segment_focus < num_segments
+        assert num_segments > 0
+
+        segment = np.array_split(xt, num_segments, axis=1)[segment_focus]
+        res.append(
+            (
+                f"num_segments_{num_segments}__segment_focus_{segment_focus}",
+                np.where(
+                    full_series_energy == 0,
+                    np.nan,
+                    np.sum(segment ** 2.0, axis=1) / full_series_energy,
+                ),
+            )
+        )
+    return res
+
+
+@_simple
+def count_above(xt, t):
+    return np.sum(xt >= t, axis=1) / xt.shape[1]
+
+
+@_simple
+def count_below(xt, t):
+    return np.sum(xt <= t, axis=1) / xt.shape[1]
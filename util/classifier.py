@@ -0,0 +1,145 @@
+import numpy as np
+import xgboost as xgb
+
+from .evaluate_12ECG_score import is_number
+
+# feature extraction options of models saved before they were recorded with the
+# model, see neurokit2_parallel.FEATURE_OPTIONS
+LEGACY_FEATURE_OPTIONS = {"signal_resampling": "fft"}
+
+
+class BoosterClassifier:
+    """Binary classifier around a trained xgboost Booster.
+
+    Exposes the subset of the XGBClassifier interface used for inference, so
+    models trained with xgb.train on a shared DMatrix are drop in replacements
+    for the scikit-learn wrapper models.
+    """
+
+    def __init__(self, booster, classes, n_jobs=None, missing=np.nan):
+        self._Booster = booster
+        self.classes_ = np.asarray(classes)
+        self.n_classes_ = len(self.classes_)
+        self.n_jobs = n_jobs
+        self.missing = missing
+        self.objective = "binary:logistic"
+
+        # only set by early stopping
+        for attr in ("best_score", "best_iteration", "best_ntree_limit"):
+            if hasattr(booster, attr):
+                setattr(self, attr, getattr(booster, attr))
+
+    def get_booster(self):
+        return self._Booster
+
+    def predict(self, data, ntree_limit=None, validate_features=True):
+        class_probs = self.predict_proba(
+            data, ntree_limit=ntree_limit, validate_features=validate_features
+        )[:, 1]
+        column_indexes = np.repeat(0, class_probs.shape[0])
+        column_indexes[class_probs > 0.5] = 1
+        return self.classes_[np.minimum(column_indexes, self.n_classes_ - 1)]
+
+    def predict_proba(self, data, ntree_limit=None, validate_features=True):
+        test_dmatrix = xgb.DMatrix(data, missing=self.missing, nthread=self.n_jobs)
+        if ntree_limit is None:
+            ntree_limit = getattr(self, "best_ntree_limit", 0)
+        classone_probs = self._Booster.predict(
+            test_dmatrix, ntree_limit=ntree_limit, validate_features=validate_features
+        )
+        classzero_probs = 1.0 - classone_probs
+        return np.vstack((classzero_probs, classone_probs)).transpose()
+
+
+class MultiClassPredictor:
+    """All per-class models of a trained model behind one predictor.
+
+    Features are converted to a DMatrix once per call and each class booster
+    predicts the positive class probability once, labels are derived from
+    those probabilities with per-class thresholds. The thresholds reproduce
+    the predict() decisions of the wrapped models.
+    """
+
+    def __init__(
+        self,
+        field_names,
+        classes,
+        boosters,
+        ntree_limits,
+        thresholds,
+        n_jobs=None,
+        missing=np.nan,
+        feature_options=None,
+    ):
+        """boosters: xgb.Booster or path to a saved booster, paths are loaded on first use
+        feature_options: the feature extraction options the models were trained with
+        """
+        self.field_names = list(field_names)
+        self.feature_options = dict(feature_options or {})
+        self.classes = tuple(str(c) for c in classes)
+        self.ntree_limits = list(ntree_limits)
+        self.thresholds = np.array(thresholds, dtype=np.float64)
+        self.n_jobs = n_jobs
+        self.missing = missing
+        self._boosters = list(boosters)
+
+    @classmethod
+    def from_models(cls, models, **kwargs):
+        """models: dict of scored code to classifier, "field_names" to the feature
+        columns and "feature_options" to the feature extraction options, when known
+        """
+        classes = []
+        boosters = []
+        ntree_limits = []
+        thresholds = []
+        for class_val, model in models.items():
+            if not is_number(class_val):
+                continue
+            classes.append(str(class_val))
+            boosters.append(model.get_booster())
+            ntree_limits.append(getattr(model, "best_ntree_limit", 0))
+            thresholds.append(_decision_threshold(model.classes_))
+
+        kwargs.setdefault(
+            "feature_options", models.get("feature_options", LEGACY_FEATURE_OPTIONS)
+        )
+        return cls(
+            models["field_names"], classes, boosters, ntree_limits, thresholds, **kwargs
+        )
+
+    @property
+    def boosters(self):
+        return [self._get_booster(idx) for idx in range(len(self._boosters))]
+
+    def predict_proba(self, features):
+        """features: DataFrame with the field_names columns
+        Returns positive class probabilities, shape (num_records, num_classes)
+        """
+        dmatrix = xgb.DMatrix(features, missing=self.missing, nthread=self.n_jobs)
+        scores = np.empty((dmatrix.num_row(), len(self.classes)), dtype=np.float32)
+        for idx, ntree_limit in enumerate(self.ntree_limits):
+            scores[:, idx] = self._get_booster(idx).predict(
+                dmatrix, ntree_limit=ntree_limit
+            )
+        return scores
+
+    def predict(self, features):
+        """Returns (labels, scores), both of shape (num_records, num_classes)"""
+        scores = self.predict_proba(features)
+        return scores > self.thresholds, scores
+
+    def _get_booster(self, idx):
+        booster = self._boosters[idx]
+        if not isinstance(booster, xgb.Booster):
+            booster = xgb.Booster(model_file=booster)
+            self._boosters[idx] = booster
+        return booster
+
+
+def _decision_threshold(model_classes):
+    # models fit on a single class can only predict that class,
+    # probabilities are within [0, 1] so these thresholds never/always pass
+    model_classes = list(model_classes)
+    if len(model_classes) == 1:
+        return -1.0 if model_classes[0] else 1.0
+    return 0.5
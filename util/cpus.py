@@ -0,0 +1,9 @@
+import os
+
+
+def available_cpus():
+    """number of CPUs this process may run on, all of them where the OS cannot tell"""
+    if hasattr(os, "sched_getaffinity"):
+        # Linux only, respects taskset and container CPU sets
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
@@ -0,0 +1,178 @@
+import functools
+import hashlib
+import importlib
+import importlib.util
+import json
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+
+# bump to invalidate every cache entry, e.g. when the cached values change format.
+# Changes to the feature extraction code and its dependencies change
+# extraction_version instead
+CACHE_KEY_VERSION = 2
+
+# modules whose code determines the extracted features
+EXTRACTION_MODULES = (
+    "neurokit2_parallel",
+    "tsfresh_vectorized",
+    "util.raw_to_wfdb",
+)
+# packages whose version determines the extracted features
+EXTRACTION_PACKAGES = ("neurokit2", "tsfresh", "numpy", "scipy", "pandas")
+
+
+@functools.lru_cache(maxsize=None)
+def extraction_version():
+    """Hash of the source of EXTRACTION_MODULES and versions of EXTRACTION_PACKAGES,
+    any change to the feature extraction code or its dependencies changes it
+    """
+    h = hashlib.sha256()
+    for module in EXTRACTION_MODULES:
+        with open(importlib.util.find_spec(module).origin, "rb") as f:
+            h.update(f.read())
+    for package in EXTRACTION_PACKAGES:
+        h.update(f"{package}=={importlib.import_module(package).__version__}".encode())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """Persistent SQLite cache of extracted record features.
+
+    Keys are content hashes of the record signal, header and the fc_parameters
+    selection (see record_key). When the stored values exceed max_bytes, the
+    least recently used entries are evicted, by the clock() time of their last
+    access.
+
+    Safe to share between processes, each process opens its own connection.
+    """
+
+    def __init__(self, cache_fp, max_bytes=1024 ** 3, clock=time.time):
+        self.cache_fp = cache_fp
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # connections cannot be pickled, reopen lazily in the receiving process
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.cache_fp, timeout=60)
+            self._pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS features ("
+                "key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS features_last_access ON features (last_access)"
+            )
+            # running total of the stored value sizes, kept up to date by put and
+            # _evict so neither has to sum the table, summed once for older caches
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta (name, value) "
+                "SELECT 'total_bytes', COALESCE(SUM(size), 0) FROM features"
+            )
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def record_key(data, header_data, fc_parameters, feature_options=None):
+        """Hash of the raw signal bytes, header lines, feature selection, extraction
+        options and the extraction_version
+        """
+        data = np.ascontiguousarray(data)
+        h = hashlib.sha256()
+        h.update(str(CACHE_KEY_VERSION).encode())
+        h.update(extraction_version().encode())
+        h.update(str((data.dtype.str, data.shape)).encode())
+        h.update(data.tobytes())
+        h.update("".join(header_data).encode())
+        h.update(json.dumps(fc_parameters, sort_keys=True, default=str).encode())
+        h.update(json.dumps(feature_options or {}, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns the cached value, or None on a cache miss"""
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT value FROM features WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE features SET last_access = ? WHERE key = ?", (self.clock(), key)
+            )
+        return pickle.loads(row[0])
+
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.conn:
+            # the first write locks the database, so the total cannot go stale
+            self.conn.execute(
+                "UPDATE meta SET value = value + ? - COALESCE("
+                "(SELECT size FROM features WHERE key = ?), 0) "
+                "WHERE name = 'total_bytes'",
+                (len(blob), key),
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO features (key, value, size, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(blob), len(blob), self.clock()),
+            )
+            self._evict()
+
+    def total_bytes(self):
+        """Size of the stored values"""
+        return self.conn.execute(
+            "SELECT value FROM meta WHERE name = 'total_bytes'"
+        ).fetchone()[0]
+
+    def _evict(self):
+        excess_bytes = self.total_bytes() - self.max_bytes
+        if excess_bytes <= 0:
+            return
+
+        evict_keys = []
+        evict_bytes = 0
+        # least recently used first, along the last_access index
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM features ORDER BY last_access"
+        ):
+            evict_keys.append((key,))
+            evict_bytes += size
+            if evict_bytes >= excess_bytes:
+                break
+        self.conn.executemany("DELETE FROM features WHERE key = ?", evict_keys)
+        self.conn.execute(
+            "UPDATE meta SET value = value - ? WHERE name = 'total_bytes'",
+            (evict_bytes,),
+        )
+
+    def __contains__(self, key):
+        row = self.conn.execute(
+            "SELECT 1 FROM features WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+        self._pid = None
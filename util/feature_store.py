@@ -0,0 +1,128 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+
+class FeatureStore:
+    """Append-only HDF5 store of record feature vectors.
+
+    Layout:
+        fieldnames   (num_features,)              feature column names
+        header_file  (num_records,)               record header file paths
+        features     (num_records, num_features)  float64 feature matrix
+
+    The datasets are stored in HDF5 chunks of chunk_rows. Appended rows are
+    written and flushed to disk every buffer_rows rows, by default on every
+    append. A crash then loses no appended record. It can only interrupt the
+    record being written, which is redone on resume. With a larger buffer_rows
+    (bulk loads), a crash loses the buffered rows and can leave the file
+    unreadable. Call flush() or close() to persist the buffer. Loading reads the
+    matrix in one call and wraps it in a DataFrame without copying.
+    """
+
+    def __init__(self, store_fp, fieldnames=None, chunk_rows=256, buffer_rows=1):
+        self.store_fp = store_fp
+        self.chunk_rows = chunk_rows
+        self.buffer_rows = buffer_rows
+        self._h5 = h5py.File(store_fp, "a")
+
+        if "fieldnames" in self._h5:
+            self.fieldnames = [_decode(f) for f in self._h5["fieldnames"][()]]
+            if fieldnames is not None and list(fieldnames) != self.fieldnames:
+                raise ValueError(
+                    f"fieldnames do not match those stored in '{store_fp}'"
+                )
+        else:
+            if fieldnames is None:
+                raise ValueError(f"fieldnames required to create '{store_fp}'")
+            self.fieldnames = list(fieldnames)
+            num_features = len(self.fieldnames)
+            self._h5.create_dataset(
+                "fieldnames",
+                data=np.array(self.fieldnames, dtype=object),
+                dtype=h5py.string_dtype(),
+            )
+            self._h5.create_dataset(
+                "header_file",
+                shape=(0,),
+                maxshape=(None,),
+                chunks=(chunk_rows,),
+                dtype=h5py.string_dtype(),
+            )
+            self._h5.create_dataset(
+                "features",
+                shape=(0, num_features),
+                maxshape=(None, num_features),
+                chunks=(chunk_rows, num_features),
+                dtype=np.float64,
+            )
+            self._h5.flush()
+
+        self._field_idx = dict((f, i) for i, f in enumerate(self.fieldnames))
+        self._buffer_header_files = []
+        self._buffer_rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._h5["header_file"].shape[0] + len(self._buffer_header_files)
+
+    def append(self, header_file, features):
+        """features: dict of fieldname to value, missing fields are stored as NaN"""
+        row = np.full(len(self.fieldnames), np.nan)
+        for k, v in features.items():
+            try:
+                row[self._field_idx[k]] = v
+            except KeyError:
+                raise ValueError(f"'{k}' is not in the store fieldnames")
+
+        self._buffer_header_files.append(header_file)
+        self._buffer_rows.append(row)
+        if len(self._buffer_rows) >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        if self._buffer_rows:
+            header_files = self._h5["header_file"]
+            features = self._h5["features"]
+            num_records = header_files.shape[0]
+            num_new = len(self._buffer_rows)
+
+            features.resize(num_records + num_new, axis=0)
+            features[num_records:] = np.vstack(self._buffer_rows)
+            header_files.resize(num_records + num_new, axis=0)
+            header_files[num_records:] = np.array(
+                self._buffer_header_files, dtype=object
+            )
+
+            self._buffer_header_files = []
+            self._buffer_rows = []
+        self._h5.flush()
+
+    def header_files(self):
+        """Header file paths of all stored records, in insertion order"""
+        stored = [_decode(hf) for hf in self._h5["header_file"][()]]
+        return stored + self._buffer_header_files
+
+    def to_dataframe(self):
+        """All stored records as a DataFrame indexed by header_file"""
+        self.flush()
+        features = self._h5["features"][()]
+        index = pd.Index(self.header_files(), name="header_file")
+        return pd.DataFrame(features, index=index, columns=self.fieldnames, copy=False)
+
+    def close(self):
+        if self._h5.id.valid:
+            self.flush()
+            self._h5.close()
+
+
+def _decode(value):
+    # h5py>=3 returns variable length strings as bytes
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
@@ -0,0 +1,107 @@
+import json
+import os
+import shutil
+
+from .classifier import LEGACY_FEATURE_OPTIONS, MultiClassPredictor
+from .evaluate_12ECG_score import is_number
+
+BUNDLE_FORMAT_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+RECORDS_FILENAME = "records.json"
+
+# model dict entries that are neither class models nor metrics
+_RECORD_KEYS = ("train_records", "eval_records")
+_OPTION_KEYS = ("field_names", "feature_options")
+
+
+def is_model_bundle(path):
+    return os.path.isfile(os.path.join(path, MANIFEST_FILENAME))
+
+
+def save_model_bundle(bundle_dir, models):
+    """Write a trained model dict as a model bundle directory.
+
+    Layout:
+        manifest.json   format version, field names, feature extraction options,
+                        metrics and per-class booster file, ntree limit and
+                        decision threshold
+        records.json    train and eval record header files
+        <code>.bin      native xgboost binary booster of each scored code
+
+    models: dict of scored code to classifier, "field_names", "feature_options", the
+    record lists and metric values, as assembled by train_12ECG_classifier
+    The bundle is written to a temporary directory and renamed into place.
+    """
+    predictor = MultiClassPredictor.from_models(models)
+
+    tmp_dir = bundle_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    classes = []
+    for sc, booster, ntree_limit, threshold in zip(
+        predictor.classes,
+        predictor.boosters,
+        predictor.ntree_limits,
+        predictor.thresholds,
+    ):
+        booster_fn = f"{sc}.bin"
+        booster.save_model(os.path.join(tmp_dir, booster_fn))
+        classes.append(
+            {
+                "code": sc,
+                "booster": booster_fn,
+                "ntree_limit": int(ntree_limit),
+                "threshold": float(threshold),
+            }
+        )
+
+    metrics = dict(
+        (k, float(v))
+        for k, v in models.items()
+        if not is_number(k) and k not in _OPTION_KEYS and k not in _RECORD_KEYS
+    )
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "field_names": predictor.field_names,
+        "feature_options": predictor.feature_options,
+        "metrics": metrics,
+        "classes": classes,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    records = dict((k, list(models.get(k, []))) for k in _RECORD_KEYS)
+    with open(os.path.join(tmp_dir, RECORDS_FILENAME), "w") as f:
+        json.dump(records, f)
+
+    os.rename(tmp_dir, bundle_dir)
+
+
+def load_model_manifest(bundle_dir):
+    with open(os.path.join(bundle_dir, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise ValueError(
+            f"'{bundle_dir}' has bundle format version {manifest.get('format_version')},"
+            f" expected {BUNDLE_FORMAT_VERSION}"
+        )
+    return manifest
+
+
+def load_model_bundle(bundle_dir, n_jobs=None):
+    """MultiClassPredictor of a model bundle, only the manifest is read up front,
+    each class booster is loaded on first prediction.
+    """
+    manifest = load_model_manifest(bundle_dir)
+    classes = manifest["classes"]
+    return MultiClassPredictor(
+        manifest["field_names"],
+        [c["code"] for c in classes],
+        [os.path.join(bundle_dir, c["booster"]) for c in classes],
+        [c["ntree_limit"] for c in classes],
+        [c["threshold"] for c in classes],
+        n_jobs=n_jobs,
+        feature_options=manifest.get("feature_options", LEGACY_FEATURE_OPTIONS),
+    )
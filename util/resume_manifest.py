@@ -0,0 +1,108 @@
+import json
+import os
+
+
+class ResumeManifest:
+    """Persistent per-record feature extraction state, for resumable training.
+
+    States are appended to a JSON lines file as they change and replayed into
+    a dict on load, so lookups are constant time. reconcile() compacts the file.
+    """
+
+    COMPLETED = "completed"
+    FAILED = "failed"
+    IN_PROGRESS = "in_progress"
+
+    def __init__(self, manifest_fp):
+        self.manifest_fp = manifest_fp
+        self.states = {}
+        self.details = {}
+
+        if os.path.isfile(manifest_fp):
+            with open(manifest_fp, "r") as manifest_file:
+                for line in manifest_file:
+                    try:
+                        header_file, state, detail = json.loads(line)
+                    except ValueError:
+                        # partially written line from an interrupted run
+                        continue
+                    self._set(header_file, state, detail)
+
+        self._manifest_file = open(manifest_fp, "a")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, header_file):
+        return header_file in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def state(self, header_file):
+        return self.states.get(header_file)
+
+    def header_files(self, state):
+        return [hf for hf, hf_state in self.states.items() if hf_state == state]
+
+    def mark_in_progress(self, header_file):
+        self._mark(header_file, self.IN_PROGRESS)
+
+    def mark_completed(self, header_file):
+        self._mark(header_file, self.COMPLETED)
+
+    def mark_failed(self, header_file, error=None):
+        self._mark(header_file, self.FAILED, error)
+
+    def reconcile(self, completed_header_files):
+        """Make the manifest agree with the persisted extraction results.
+
+        completed_header_files: records present in both the labels file and the feature store
+        Completed entries missing from the results and in progress entries left
+        by an interrupted run are dropped so they are processed again.
+        Returns the number of dropped entries.
+        """
+        completed_header_files = set(completed_header_files)
+        num_dropped = 0
+        for header_file, state in tuple(self.states.items()):
+            if state == self.FAILED:
+                continue
+            if state == self.IN_PROGRESS or header_file not in completed_header_files:
+                self._set(header_file, None)
+                num_dropped += 1
+
+        for header_file in completed_header_files:
+            self._set(header_file, self.COMPLETED)
+
+        self._compact()
+        return num_dropped
+
+    def close(self):
+        if not self._manifest_file.closed:
+            self._manifest_file.close()
+
+    def _mark(self, header_file, state, detail=None):
+        self._manifest_file.write(json.dumps((header_file, state, detail)) + "\n")
+        self._manifest_file.flush()
+        self._set(header_file, state, detail)
+
+    def _set(self, header_file, state, detail=None):
+        if state is None:
+            self.states.pop(header_file, None)
+            self.details.pop(header_file, None)
+        else:
+            self.states[header_file] = state
+            self.details[header_file] = detail
+
+    def _compact(self):
+        self._manifest_file.close()
+        tmp_fp = self.manifest_fp + ".tmp"
+        with open(tmp_fp, "w") as manifest_file:
+            for header_file, state in self.states.items():
+                detail = self.details.get(header_file)
+                manifest_file.write(json.dumps((header_file, state, detail)) + "\n")
+        os.replace(tmp_fp, self.manifest_fp)
+        self._manifest_file = open(self.manifest_fp, "a")
@@ -0,0 +1,68 @@
+import concurrent.futures
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+
+class WorkerPool:
+    """ProcessPoolExecutor of warm workers, replaced whole when a worker hangs or dies.
+
+    The executor can neither stop a hung task nor replace a worker that died (it
+    breaks, failing every pending future with BrokenProcessPool), so restart()
+    terminates its workers and starts a new executor. Every task of the replaced
+    executor is lost.
+    """
+
+    def __init__(self, num_workers, initializer=None, initargs=()):
+        self.num_workers = num_workers
+        self._initializer = initializer
+        self._initargs = initargs
+        self._lock = threading.Lock()
+        self.executor = self._start()
+
+    def _start(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            self.num_workers, initializer=self._initializer, initargs=self._initargs
+        )
+
+    def submit(self, func, *args):
+        """Returns (executor, future), the executor to restart if the task hangs or
+        breaks it
+        """
+        executor = self.executor
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool as e:
+            # broken by a task whose future has not been looked at yet
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        return executor, future
+
+    def restart(self, executor):
+        """Replaces executor, several tasks may see the same executor break and only
+        the first restart replaces it
+        """
+        with self._lock:
+            if executor is not self.executor:
+                return
+            _terminate(executor)
+            executor.shutdown()
+            self.executor = self._start()
+
+    def close(self, terminate=False):
+        """terminate: stop the running tasks rather than wait for them"""
+        if terminate:
+            _terminate(self.executor)
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # interrupted, the workers may ignore SIGINT
+        self.close(terminate=exc_type is not None)
+
+
+def _terminate(executor):
+    # the executor sees its workers die, fails their futures and stops
+    for p in list(executor._processes.values()):
+        p.terminate()